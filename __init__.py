@@ -1,4 +1,4 @@
-from .auto_lip_sync import language_settings
+from .lip_sync_core import language_settings
 
 def start():
     from . import auto_lip_sync
@@ -0,0 +1,5 @@
+import sys
+
+from .lip_sync_core import main
+
+sys.exit(main())
@@ -0,0 +1,206 @@
+'''
+Name: align_cache
+
+Description: Content addressed cache of MFA results. A TextGrid is stored under a hash of the audio bytes, the
+normalized transcript, the lexicon, the acoustic model and the MFA version, so re-keying a clip after a pose change
+skips MFA entirely. The loudness envelope of a clip (see audio.compute_envelope) is stored next to it as a .npy file
+under a key of the audio bytes and the envelope settings, and the last run of every clip (which transcript it was
+aligned with last, see incremental) as a small .run.json record under a key of the audio bytes and the MFA setup.
+The cache folder can live on a network share and be used by several artists at once: entries are written with an
+atomic rename and the least recently used ones are evicted when the folder grows past its size limit. The folder is
+walked for that when a running estimate of its size passes the limit, or every EVICT_EVERY puts to catch what others
+wrote, not on every put.
+'''
+import os
+import re
+import json
+import shutil
+import hashlib
+import unicodedata
+
+CACHE_VERSION = "1"
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# Puts between walks of the cache folder while the size estimate stays under the limit, other artists sharing the
+# folder grow it too
+EVICT_EVERY = 64
+# Eviction goes down to this share of the limit, so a full cache isn't walked again on the next put
+EVICT_TO = 0.9
+
+# (path, size, mtime) -> sha256, so the lexicon and model are only hashed again when they change
+_file_hashes = {}
+
+
+def hash_file(path):
+    stat = os.stat(path)
+    stamp = (path, stat.st_size, stat.st_mtime_ns)
+    digest = _file_hashes.get(stamp)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        digest = _file_hashes[stamp] = sha.hexdigest()
+    return digest
+
+
+def normalize_transcript(text):
+    text = unicodedata.normalize("NFC", text).lstrip("\ufeff")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def alignment_key(sound_path, transcript, settings):
+    # transcript is the decoded text, see lip_sync_core.read_transcript
+    sha = hashlib.sha256()
+    sha.update(CACHE_VERSION.encode("utf-8"))
+    sha.update(hash_file(sound_path).encode("utf-8"))
+    sha.update(normalize_transcript(transcript).encode("utf-8"))
+    for path in (settings["lexicon"], settings["model"]):
+        sha.update(hash_file(path).encode("utf-8") if os.path.exists(path) else path.encode("utf-8"))
+    sha.update(settings["mfa_version"].encode("utf-8"))
+    return sha.hexdigest()
+
+
+def envelope_key(sound_path, fps, smoothing):
+    sha = hashlib.sha256()
+    sha.update("envelope{}".format(CACHE_VERSION).encode("utf-8"))
+    sha.update(hash_file(sound_path).encode("utf-8"))
+    sha.update("{!r}|{!r}".format(float(fps), float(smoothing)).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def run_key(sound_path, settings):
+    # Same audio and MFA setup, any transcript
+    sha = hashlib.sha256()
+    sha.update("run{}".format(CACHE_VERSION).encode("utf-8"))
+    sha.update(hash_file(sound_path).encode("utf-8"))
+    for path in (settings["lexicon"], settings["model"]):
+        sha.update(hash_file(path).encode("utf-8") if os.path.exists(path) else path.encode("utf-8"))
+    sha.update(settings["mfa_version"].encode("utf-8"))
+    return sha.hexdigest()
+
+
+def get_default_cache_dir():
+    from .lip_sync_core import USER_SCRIPT_DIR
+    return os.environ.get("AUTO_LIP_SYNC_CACHE") or os.path.join(USER_SCRIPT_DIR, "alignment_cache")
+
+
+class AlignmentCache(object):
+
+    def __init__(self, folder=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.folder = folder or get_default_cache_dir()
+        self.max_bytes = max_bytes
+        # Size of the folder as of the last walk plus what this process put since, None until the first walk
+        self._size = None
+        self._puts = 0
+
+    def entry_path(self, key, ext=".TextGrid"):
+        return os.path.join(self.folder, key[:2], key + ext)
+
+    def get(self, key, ext=".TextGrid"):
+        # Returns the cached file path or None. A hit refreshes the entry's mtime for the LRU eviction.
+        path = self.entry_path(key, ext)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def temp_entry_path(self, key, ext):
+        path = self.entry_path(key, ext)
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        return path, "{}.{}.tmp".format(path, os.getpid())
+
+    def put(self, key, textgrid_path):
+        path, temp_path = self.temp_entry_path(key, ".TextGrid")
+        shutil.copyfile(textgrid_path, temp_path)
+        os.replace(temp_path, path)
+        self.added(path)
+        return path
+
+    def get_envelope(self, key):
+        import numpy as np
+        path = self.get(key, ".npy")
+        if path is None:
+            return None
+        try:
+            return np.load(path)
+        except (OSError, ValueError):
+            return None
+
+    def put_envelope(self, key, envelope):
+        import numpy as np
+        path, temp_path = self.temp_entry_path(key, ".npy")
+        with open(temp_path, "wb") as f:
+            np.save(f, envelope)
+        os.replace(temp_path, path)
+        self.added(path)
+        return path
+
+    def get_run(self, key):
+        path = self.get(key, ".run.json")
+        if path is None:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put_run(self, key, record):
+        path, temp_path = self.temp_entry_path(key, ".run.json")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+        return path
+
+    def entries(self):
+        # (mtime, size, path) of every cached TextGrid, envelope and run record
+        found = []
+        for root, dirs, files in os.walk(self.folder):
+            for file in files:
+                if not file.endswith((".TextGrid", ".npy", ".run.json")):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, stat.st_size, path))
+        return found
+
+    def added(self, path):
+        # Only walks the folder when the estimate goes over the limit or every EVICT_EVERY puts, not on every put
+        self._puts += 1
+        if self._size is not None:
+            try:
+                self._size += os.path.getsize(path)
+            except OSError:
+                pass
+        if self._size is None or self._size > self.max_bytes or self._puts >= EVICT_EVERY:
+            self.evict()
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        self._puts = 0
+        self._size = total
+        if total <= self.max_bytes:
+            return 0
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                # Another artist evicted it first
+                pass
+            total -= size
+        self._size = total
+        return removed
+
+    def clear(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,280 @@
+'''
+Name: audio
+
+Description: Audio conditioning for MFA. Source WAVs of any common PCM or float layout (48 kHz stereo 24-bit VO
+included) are converted to the 16 kHz, mono, 16-bit files MFA expects while they are staged. The header is checked
+first so a bad file fails before MFA is started, and the sample data is read through a memory map in fixed size
+chunks, so long recordings are never loaded into memory as a whole. Files that already match are copied as they are.
+
+The conversion needs numpy, which ships with mayapy 2022 and later.
+'''
+import os
+import wave
+import shutil
+import struct
+from collections import namedtuple
+
+TARGET_RATE = 16000
+CHUNK_FRAMES = 1 << 16
+FILTER_TAPS = 127
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+WavInfo = namedtuple("WavInfo", ["format_tag", "channels", "sample_rate", "bits", "block_align", "data_offset", "frame_count"])
+
+
+class AudioError(ValueError):
+    pass
+
+
+def read_wav_header(path):
+    # Walks the RIFF chunks up to the data chunk and returns a WavInfo. Raises AudioError for anything MFA can't use.
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            if riff[:4] == b"RF64":
+                raise AudioError("{} is an RF64 file, export it as a regular WAV".format(path))
+            raise AudioError("{} is not a WAV file".format(path))
+
+        fmt = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise AudioError("{} has no {} chunk".format(path, "data" if fmt else "fmt"))
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+            if chunk_id == b"fmt ":
+                fmt = f.read(chunk_size)
+                if len(fmt) < 16:
+                    raise AudioError("{} has a truncated fmt chunk".format(path))
+                f.seek(chunk_size % 2, 1)
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise AudioError("{} has its data chunk before the fmt chunk".format(path))
+                data_offset = f.tell()
+                break
+            else:
+                # Chunks are padded to an even size
+                f.seek(chunk_size + chunk_size % 2, 1)
+
+    format_tag, channels, sample_rate, byte_rate, block_align, bits = struct.unpack("<HHIIHH", fmt[:16])
+    if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        # The real format is the first two bytes of the sub format GUID
+        format_tag = struct.unpack("<H", fmt[24:26])[0]
+
+    if format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+        raise AudioError("{} is compressed (format 0x{:04x}), only PCM and float WAVs are supported".format(path, format_tag))
+    if format_tag == WAVE_FORMAT_PCM and bits not in (8, 16, 24, 32):
+        raise AudioError("{} has an unsupported sample size of {} bits".format(path, bits))
+    if format_tag == WAVE_FORMAT_IEEE_FLOAT and bits not in (32, 64):
+        raise AudioError("{} has an unsupported float sample size of {} bits".format(path, bits))
+    if not channels or not sample_rate:
+        raise AudioError("{} has {} channels at {} Hz".format(path, channels, sample_rate))
+    if block_align != channels * bits // 8:
+        raise AudioError("{} has a block align of {}, expected {}".format(path, block_align, channels * bits // 8))
+
+    # Recorders that were stopped early leave the data size at 0 or 0xFFFFFFFF, the file size is what counts
+    data_size = min(chunk_size, file_size - data_offset)
+    frame_count = data_size // block_align
+    if not frame_count:
+        raise AudioError("{} contains no audio".format(path))
+    return WavInfo(format_tag, channels, sample_rate, bits, block_align, data_offset, frame_count)
+
+
+def needs_conditioning(info, sample_rate=TARGET_RATE):
+    return not (info.format_tag == WAVE_FORMAT_PCM and info.channels == 1 and info.bits == 16 and info.sample_rate == sample_rate)
+
+
+def decode_frames(raw, info, np):
+    # raw is a uint8 array of whole frames, returns float32 samples in [-1, 1] shaped (frames, channels)
+    if info.format_tag == WAVE_FORMAT_IEEE_FLOAT:
+        samples = raw.view("<f4" if info.bits == 32 else "<f8").astype(np.float32)
+    elif info.bits == 8:
+        samples = (raw.astype(np.float32) - 128.0) / 128.0
+    elif info.bits == 16:
+        samples = raw.view("<i2").astype(np.float32) / 32768.0
+    elif info.bits == 24:
+        triplets = raw.reshape(-1, 3).astype(np.int32)
+        values = triplets[:, 0] | (triplets[:, 1] << 8) | (triplets[:, 2] << 16)
+        samples = ((values ^ 0x800000) - 0x800000).astype(np.float32) / 8388608.0
+    else:
+        samples = (raw.view("<i4") / 2147483648.0).astype(np.float32)
+    return samples.reshape(-1, info.channels)
+
+
+def lowpass_filter(source_rate, target_rate, np, taps=FILTER_TAPS):
+    # Windowed sinc anti-alias filter with its cutoff a little below the lower Nyquist frequency
+    cutoff = 0.45 * min(source_rate, target_rate) / float(source_rate)
+    n = np.arange(taps) - (taps - 1) / 2.0
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.blackman(taps)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+class StreamResampler(object):
+    # Resamples a mono float32 stream chunk by chunk. Downsampling runs the anti-alias filter first. Output sample n
+    # sits at input position n * source_rate / target_rate, computed in integers so long files don't drift.
+
+    def __init__(self, source_rate, target_rate, np):
+        self.np = np
+        self.source_rate = source_rate
+        self.target_rate = target_rate
+        self.kernel = lowpass_filter(source_rate, target_rate, np) if target_rate < source_rate else None
+        self.delay = (len(self.kernel) - 1) // 2 if self.kernel is not None else 0
+        # Filter input history, starts as silence so the first samples are filtered like the rest
+        self.history = np.zeros(len(self.kernel) - 1 if self.kernel is not None else 0, dtype=np.float32)
+        self.skip = self.delay
+        # Last filtered sample of the previous chunk and its index in the filtered stream
+        self.previous = np.zeros(1, dtype=np.float32)
+        self.base = 0
+        self.next_output = 0
+
+    def filter(self, samples):
+        if self.kernel is None:
+            return samples
+        padded = self.np.concatenate((self.history, samples))
+        self.history = padded[len(padded) - len(self.history):]
+        filtered = self.np.convolve(padded, self.kernel, mode="valid").astype(self.np.float32)
+        # Drop the filter's group delay from the start of the stream
+        if self.skip:
+            dropped = min(self.skip, len(filtered))
+            filtered = filtered[dropped:]
+            self.skip -= dropped
+        return filtered
+
+    def interpolate(self, filtered, final=False):
+        np = self.np
+        if not len(filtered) and not final:
+            return filtered
+        # extended[0] is the sample at index base - 1
+        extended = np.concatenate((self.previous, filtered))
+        last_index = self.base + len(filtered) - 1
+        # Outputs need the sample after their position, except at the very end of the stream
+        limit = last_index if final else last_index - 1
+        output_count = ((limit + 1) * self.target_rate - 1) // self.source_rate + 1 - self.next_output
+        if output_count <= 0:
+            result = np.zeros(0, dtype=np.float32)
+        else:
+            n = np.arange(self.next_output, self.next_output + output_count, dtype=np.int64)
+            position = n * self.source_rate
+            index = position // self.target_rate
+            fraction = (position % self.target_rate).astype(np.float32) / self.target_rate
+            local = index - (self.base - 1)
+            following = np.minimum(local + 1, len(extended) - 1)
+            result = extended[local] * (1 - fraction) + extended[following] * fraction
+            self.next_output += output_count
+        if len(filtered):
+            self.previous = filtered[-1:]
+            self.base = last_index + 1
+        return result
+
+    def process(self, samples):
+        if self.source_rate == self.target_rate:
+            return samples
+        return self.interpolate(self.filter(samples))
+
+    def flush(self):
+        # Pushes the samples still inside the filter through and returns the last output samples
+        if self.source_rate == self.target_rate:
+            return self.np.zeros(0, dtype=self.np.float32)
+        tail = self.filter(self.np.zeros(self.delay, dtype=self.np.float32))
+        return self.interpolate(tail, final=True)
+
+
+def iter_mono_chunks(path, info, np, chunk_frames=CHUNK_FRAMES):
+    # Yields the clip as float32 mono chunks of chunk_frames samples, read through a memory map
+    data = np.memmap(path, dtype=np.uint8, mode="r", offset=info.data_offset, shape=(info.frame_count * info.block_align,))
+    try:
+        for start in range(0, info.frame_count, chunk_frames):
+            end = min(start + chunk_frames, info.frame_count)
+            raw = np.asarray(data[start * info.block_align:end * info.block_align])
+            yield decode_frames(raw, info, np).mean(axis=1, dtype=np.float32)
+    finally:
+        del data
+
+
+def convert_wav(source_path, target_path, info, sample_rate=TARGET_RATE, chunk_frames=CHUNK_FRAMES):
+    import numpy as np
+
+    # Source frames covered by the output, the resampler's flush stops at the same point
+    expected_frames = (info.frame_count * sample_rate) // info.sample_rate
+    resampler = StreamResampler(info.sample_rate, sample_rate, np)
+    written = 0
+    with wave.open(target_path, "wb") as target:
+        target.setnchannels(1)
+        target.setsampwidth(2)
+        target.setframerate(sample_rate)
+
+        def write(samples):
+            samples = samples[:max(0, expected_frames - written)]
+            pcm = np.clip(np.rint(samples * 32767.0), -32768, 32767).astype("<i2")
+            target.writeframes(pcm.tobytes())
+            return len(pcm)
+
+        for mono in iter_mono_chunks(source_path, info, np, chunk_frames):
+            written += write(resampler.process(mono))
+        written += write(resampler.flush())
+    return written
+
+
+def condition_wav(source_path, target_path, sample_rate=TARGET_RATE):
+    # Writes a 16-bit mono copy of source_path at sample_rate to target_path and returns its WavInfo
+    info = read_wav_header(source_path)
+    if not needs_conditioning(info, sample_rate):
+        shutil.copy(source_path, target_path)
+        return info
+    try:
+        import numpy
+    except ImportError:
+        raise AudioError("{} is {} Hz, {} channel, {}-bit. Converting it needs numpy, or convert it to {} Hz mono "
+                         "16-bit by hand".format(source_path, info.sample_rate, info.channels, info.bits, sample_rate))
+    print("Converting {} ({} Hz, {} channel, {}-bit) to {} Hz mono 16-bit".format(
+        os.path.basename(source_path), info.sample_rate, info.channels, info.bits, sample_rate))
+    convert_wav(source_path, target_path, info, sample_rate)
+    return info
+
+
+def frame_rms(path, fps, chunk_frames=CHUNK_FRAMES):
+    # RMS level of every animation frame of the clip, frame k covers [k / fps, (k + 1) / fps). The squared samples
+    # are summed with a running cumulative sum that is only sampled at the frame boundaries, so every chunk is handled
+    # with a few vectorized calls whatever the frame length is.
+    import numpy as np
+
+    info = read_wav_header(path)
+    frame_total = int(np.ceil(info.frame_count * fps / float(info.sample_rate)))
+    boundaries = np.minimum(np.rint(np.arange(frame_total + 1) * info.sample_rate / float(fps)).astype(np.int64), info.frame_count)
+    # Sum of the squared samples before each boundary
+    energy = np.zeros(frame_total + 1, dtype=np.float64)
+
+    total = 0.0
+    start = 0
+    next_boundary = 1
+    for mono in iter_mono_chunks(path, info, np, chunk_frames):
+        end = start + len(mono)
+        running = np.cumsum(np.square(mono, dtype=np.float64))
+        stop = np.searchsorted(boundaries, end, side="right")
+        if stop > next_boundary:
+            energy[next_boundary:stop] = total + running[boundaries[next_boundary:stop] - start - 1]
+            next_boundary = stop
+        total += running[-1]
+        start = end
+
+    lengths = np.maximum(np.diff(boundaries), 1)
+    return np.sqrt(np.diff(energy) / lengths).astype(np.float32)
+
+
+def compute_envelope(path, fps, smoothing=0.08, chunk_frames=CHUNK_FRAMES):
+    # Per frame loudness in [0, 1] for keying a jaw or intensity channel. The RMS is smoothed with a Hann window of
+    # `smoothing` seconds and scaled so the loud parts of the clip (95th percentile) reach 1.
+    import numpy as np
+
+    levels = frame_rms(path, fps, chunk_frames)
+    width = int(round(smoothing * fps))
+    if width > 1 and len(levels) > 1:
+        window = np.hanning(width + 2)[1:-1]
+        levels = np.convolve(levels, window / window.sum(), mode="same")
+    peak = np.percentile(levels, 95) if len(levels) else 0
+    if peak <= 0:
+        return np.zeros(len(levels), dtype=np.float32)
+    return np.clip(levels / peak, 0.0, 1.0).astype(np.float32)
@@ -14,138 +14,30 @@ import auto_lip_sync
 auto_lip_sync.start()
 
 '''
-import shutil
 import os
 import sys
-import json
-import subprocess
+import time
 import webbrowser
+import multiprocessing
 import traceback
-import re
 
 from maya import OpenMaya, OpenMayaUI, mel, cmds
 from shiboken2 import wrapInstance
 from collections import OrderedDict 
 from PySide2 import QtCore, QtGui, QtWidgets
 
-# Import Textgrid. If the module doesn't exist let the user decide if they want to download the dependencies zip.
-try:
-    import textgrid
-except ImportError:
-    traceback.print_exc()
-    confirm = cmds.confirmDialog(title="Missing dependencies", message="To be able to run this tool you need to download the required dependencies. Do you want go to the download page?", button=["Yes","Cancel"], defaultButton="Yes", cancelButton="Cancel", dismissString="Cancel")
-    if confirm == "Yes":
-        webbrowser.open_new("https://github.com/joaen/maya-auto-lip-sync#dependencies")
-    else:
-        pass
-
-# Language settings for English and Chinese with different MFA versions
-language_settings = {
-    "English": {
-        "lexicon": os.path.join(cmds.internalVar(userScriptDir=True), "librispeech-lexicon.txt"),
-        "model": os.path.join(cmds.internalVar(userScriptDir=True), "montreal-forced-aligner/pretrained_models/english.zip"),
-        "mfa_version": "v1.0.1",
-        "mfa_path": os.path.join(cmds.internalVar(userScriptDir=True), "montreal-forced-aligner/bin"),
-        "mfa_align_cmd": "mfa_align.exe",
-        "mfa_train_cmd": "mfa_train_and_align.exe",
-        "phone_dict": {
-            "AA0": "AI", "AA1": "AI", "AA2": "AI", "AE0": "AI", "AE1": "AI", "AE2": "AI", 
-            "AH0": "AI", "AH1": "AI", "AH2": "AI", "AO0": "AI", "AO1": "AI", "AO2": "AI",
-            "AW0": "WQ", "AW1": "WQ", "AW2": "WQ", "AY0": "AI", "AY1": "AI", "AY2": "AI",
-            "EH0": "E", "EH1": "E", "EH2": "E", "ER0": "O", "ER1": "O", "ER2": "O", "EY0": "E",
-            "EY1": "E", "EY2": "E", "IH0": "AI", "IH1": "AI", "IH2": "AI", "IY0": "E", "IY1": "E",
-            "IY2": "E", "OW0": "O", "OW1": "O", "OW2": "O", "OY0": "O", "OY1": "O", "OY2": "O",
-            "UH0": "U", "UH1": "U", "UH2": "U", "UW0": "U", "UW1": "U", "UW2": "U", "B": "MBP",
-            "CH": "etc", "D": "etc", "DH": "etc", "F": "FV", "G": "etc", "HH": "E", "JH": "E",
-            "K": "etc", "L": "L", "M": "MBP", "N": "etc", "NG": "etc", "P": "MBP", "R": "etc",
-            "S": "etc", "SH": "etc", "T": "etc", "TH": "etc", "V": "FV", "W": "WQ", "Y": "E",
-            "Z": "E", "ZH": "etc", "sil": "rest", "None": "rest", "sp": "rest", "spn": "rest", "": "rest"
-        },
-        "phone_path_dict": OrderedDict([
-            ("AI", ""),
-            ("O", ""),
-            ("E", ""),
-            ("U", ""),
-            ("etc", ""),
-            ("L", ""),
-            ("WQ", ""),
-            ("MBP", ""),
-            ("FV", ""),
-            ("rest", "")
-        ])
-    },
-    "Chinese": {
-        "lexicon": os.path.join(cmds.internalVar(userScriptDir=True), "MFA_3.2.3/mandarin_china_mfa3.0.0.dict"),
-        "model": os.path.join(cmds.internalVar(userScriptDir=True), "MFA_3.2.3/mandarin_mfa v3.0.0.zip"),
-        "mfa_version": "v3.2.3",
-        "mfa_path": r"D:\Users\Eric\miniconda3\envs\mfa-323",
-        "mfa_align_cmd": "python.exe",
-        "mfa_train_cmd": "python.exe",
-        "phone_dict": {
-            # Basic vowels with tones
-            "a": "AI", "a˥": "AI", "a˥˩": "AI", "a˧": "AI", "a˧˥": "AI", "a˨˩˦": "AI", "a˩": "AI",
-            "e": "E", "e˥": "E", "e˥˩": "E", "e˧": "E", "e˧˥": "E", "e˨˩˦": "E", "e˩": "E",
-            "i": "E", "i˥": "E", "i˥˩": "E", "i˧": "E", "i˧˥": "E", "i˨˩˦": "E", "i˩": "E",
-            "o": "O", "o˥": "O", "o˥˩": "O", "o˧": "O", "o˧˥": "O", "o˨˩˦": "O", "o˩": "O",
-            "u": "U", "u˥": "U", "u˥˩": "U", "u˧": "U", "u˧˥": "U", "u˨˩˦": "U", "u˩": "U",
-            "y": "U", "y˥": "U", "y˥˩": "U", "y˧": "U", "y˧˥": "U", "y˨˩˦": "U", "y˩": "U",  # ü sound
-            "ə": "E", "ə˥": "E", "ə˥˩": "E", "ə˧": "E", "ə˧˥": "E", "ə˨˩˦": "E", "ə˩": "E",
-            
-            # Diphthongs with tones
-            "aj": "AI", "aj˥": "AI", "aj˥˩": "AI", "aj˧": "AI", "aj˧˥": "AI", "aj˨˩˦": "AI", "aj˩": "AI",
-            "aw": "WQ", "aw˥": "WQ", "aw˥˩": "WQ", "aw˧": "WQ", "aw˧˥": "WQ", "aw˨˩˦": "WQ", "aw˩": "WQ",
-            "ej": "E", "ej˥": "E", "ej˥˩": "E", "ej˧": "E", "ej˧˥": "E", "ej˨˩˦": "E", "ej˩": "E",
-            "ow": "O", "ow˥": "O", "ow˥˩": "O", "ow˧": "O", "ow˧˥": "O", "ow˨˩˦": "O", "ow˩": "O",
-            
-            # Consonants
-            "p": "MBP", "pʰ": "MBP", "pʲ": "MBP", "pʷ": "MBP",
-            "t": "L", "tʰ": "L", "tʲ": "L", "tʷ": "L",
-            "k": "GK", "kʰ": "GK", "kʷ": "GK",
-            "b": "MBP", "d": "L", "g": "GK",
-            
-            # Fricatives and affricates
-            "f": "FV", "s": "ZCS", "x": "ZCS", "xʷ": "ZCS",
-            "ɕ": "ZCS", "ɕʷ": "ZCS", "ʂ": "ZCS",
-            "ts": "ZCS", "tsʰ": "ZCS",
-            "tɕ": "JQ", "tɕʰ": "JQ", "tɕʷ": "JQ",
-            "ʈʂ": "ZH", "ʈʂʰ": "ZH",
-            
-            # Nasals and liquids
-            "m": "MBP", "mʲ": "MBP", "m̩": "MBP", "m̩˥": "MBP", "m̩˥˩": "MBP", "m̩˧": "MBP", "m̩˧˥": "MBP", "m̩˨˩˦": "MBP",
-            "n": "L", "n̩˥˩": "L", "n̩˧˥": "L", "n̩˨˩˦": "L",
-            "ŋ": "GK", "ŋ̍": "GK", "ŋ̍˥˩": "GK", "ŋ̍˧˥": "GK", "ŋ̍˨˩˦": "GK",
-            "l": "L", "ɲ": "L", "ʎ": "L",
-            
-            # Glides and approximants
-            "j": "E", "w": "WQ", "ɥ": "U", "ɻ": "ZH",
-            
-            # Syllabic consonants
-            "z̩": "ZCS", "z̩˥": "ZCS", "z̩˥˩": "ZCS", "z̩˧": "ZCS", "z̩˧˥": "ZCS", "z̩˨˩˦": "ZCS", "z̩˩": "ZCS",
-            "ʐ": "ZH", "ʐ̩": "ZH", "ʐ̩˥": "ZH", "ʐ̩˥˩": "ZH", "ʐ̩˧": "ZH", "ʐ̩˧˥": "ZH", "ʐ̩˨˩˦": "ZH", "ʐ̩˩": "ZH",
-            
-            # Glottal stop
-            "ʔ": "rest",
-            
-            # Special symbols
-            "sil": "rest", "None": "rest", "sp": "rest", "spn": "rest", "<eps>": "rest", "": "rest"
-        },
-        "phone_path_dict": OrderedDict([
-            ("MBP", ""),
-            ("FV", ""),
-            ("L", ""),
-            ("GK", ""),
-            ("JQ", ""),
-            ("ZH", ""),
-            ("ZCS", ""),
-            ("AI", ""),
-            ("O", ""),
-            ("E", ""),
-            ("U", ""),
-            ("WQ", ""),
-            ("rest", "")
-        ])
-    }
-}
+from . import lip_sync_core
+from . import maya_keys
+from .pose_library import list_poses, is_library_path, load_library, pack_pose_folder, pose_reference, PoseLibraryError, LIBRARY_EXTENSION
+from .lip_sync_core import language_settings
+from .language_packs import LanguagePackError
+from .align_cache import AlignmentCache, alignment_key
+from .incremental import remember_run
+from . import tracks
+from . import scene_pass
+from .job_queue import JobQueue
+from .mfa_runner import mfa_stage_name
+from .tracing import tracer
 
 class PoseConnectWidget(QtWidgets.QWidget):
     def __init__(self, label, parent=None):
@@ -176,22 +68,51 @@ class PoseConnectWidget(QtWidgets.QWidget):
         self.save_pose_combo.clear()
 
 
+class MfaWorker(QtCore.QThread):
+    # Runs MFA off the UI thread so Maya stays interactive while a clip is aligning
+    line_received = QtCore.Signal(str)
+    progress_changed = QtCore.Signal(int)
+
+    def __init__(self, mfa_process, parent=None):
+        super(MfaWorker, self).__init__(parent)
+        self.mfa_process = mfa_process
+        self.return_code = None
+
+    def run(self):
+        try:
+            self.mfa_process.start()
+        except OSError:
+            traceback.print_exc()
+            return
+        for stream, line in self.mfa_process.lines():
+            self.line_received.emit(line)
+            self.progress_changed.emit(self.mfa_process.progress)
+        self.return_code = self.mfa_process.wait()
+
+    def cancel(self):
+        self.mfa_process.cancel()
+
+    @property
+    def cancelled(self):
+        return self.mfa_process.cancelled
+
+
 class LipSyncDialog(QtWidgets.QDialog):
 
     WINDOW_TITLE = "Auto lip sync"
-    PYTHON_VERSION = float(re.search(r'\d+\.\d+', sys.version).group())
 
     USER_SCRIPT_DIR = cmds.internalVar(userScriptDir=True)
     OUTPUT_FOLDER_PATH = USER_SCRIPT_DIR+"output"
     INPUT_FOLDER_PATH = USER_SCRIPT_DIR+"input"
-    
-    MFA_PATH = USER_SCRIPT_DIR+"montreal-forced-aligner/bin"
-    if os.path.exists(MFA_PATH) == False:
-        cmds.confirmDialog(title="Path doesn't exsist!", message="This path doesn't exsist: "+MFA_PATH)
+    TRACE_FOLDER_PATH = USER_SCRIPT_DIR+"traces"
+    LEXICON_FOLDER_PATH = USER_SCRIPT_DIR+"lexicon"
+    # Share of the progress bar each part of a job fills: staging up to 5, MFA up to 85, keying the rest
+    ALIGN_PROGRESS = (5, 85)
     
     def __init__(self):
         # Initialize instance variables first!
         self.current_language = "English"
+        self.check_dependencies()
         self.LEXICON_PATH = language_settings[self.current_language]["lexicon"]
         self.LANGUAGE_PATH = language_settings[self.current_language]["model"]
         self.phone_dict = language_settings[self.current_language]["phone_dict"]
@@ -204,6 +125,15 @@ class LipSyncDialog(QtWidgets.QDialog):
         self.text_file_path = ""
         self.pose_folder_path = ""
         self.active_controls = []
+        self.pending_jobs = []
+        self.current_job = None
+        self.mfa_worker = None
+        self.mfa_span = None
+        self.mfa_stage_span = None
+        self.mfa_progress = 0
+        self.p_dialog = None
+        self.alignment_cache = AlignmentCache()
+        self.last_plan = None
 
         main_window = OpenMayaUI.MQtUtil.mainWindow()
         if sys.version_info.major < 3:
@@ -214,6 +144,11 @@ class LipSyncDialog(QtWidgets.QDialog):
         super(LipSyncDialog, self).__init__(maya_main_window)
 
         self.widget_list = []
+        # The pose dropdowns of every language shown so far, and the languages whose dropdowns missed a refresh
+        self.pose_widget_sets = {}
+        self.stale_pose_widgets = set()
+        # Refreshes the pose dropdowns when another artist saves into the open pose library
+        self.pose_library_watcher = QtCore.QFileSystemWatcher(self)
         self.counter = 0
         self.maya_color_list = [13, 18, 14, 17]
         self.setWindowTitle(self.WINDOW_TITLE)
@@ -236,10 +171,26 @@ class LipSyncDialog(QtWidgets.QDialog):
         self.text_filepath_button.setIcon(QtGui.QIcon(":fileOpen.png"))
         self.text_filepath_line.setText(self.text_file_path)
 
+        self.jaw_attr_label = QtWidgets.QLabel("Jaw from audio:")
+        self.jaw_attr_line = QtWidgets.QLineEdit()
+        self.jaw_attr_line.setPlaceholderText("jaw_ctrl.rotateZ")
+        self.jaw_attr_line.setToolTip("Key this attribute from the loudness of the sound clip, leave empty to skip")
+        self.jaw_closed_spin = QtWidgets.QDoubleSpinBox()
+        self.jaw_closed_spin.setRange(-1000, 1000)
+        self.jaw_closed_spin.setToolTip("Value at silence")
+        self.jaw_open_spin = QtWidgets.QDoubleSpinBox()
+        self.jaw_open_spin.setRange(-1000, 1000)
+        self.jaw_open_spin.setValue(1)
+        self.jaw_open_spin.setToolTip("Value at full loudness")
+
         self.pose_folder_label = QtWidgets.QLabel("Pose folder:")
         self.pose_filepath_line = QtWidgets.QLineEdit()
         self.pose_filepath_button = QtWidgets.QPushButton()
         self.pose_filepath_button.setIcon(QtGui.QIcon(":fileOpen.png"))
+        self.pose_library_button = QtWidgets.QPushButton("Library")
+        self.pose_library_button.setToolTip("Use a pose library file (" + LIBRARY_EXTENSION + ") instead of a pose folder")
+        self.pack_poses_button = QtWidgets.QPushButton("Pack")
+        self.pack_poses_button.setToolTip("Write the pose files of the pose folder into one library file and use it")
         self.pose_refresh_button = QtWidgets.QPushButton()
         self.pose_refresh_button.setIcon(QtGui.QIcon(":refresh.png"))
         self.pose_filepath_line.setText(self.pose_folder_path)
@@ -251,6 +202,15 @@ class LipSyncDialog(QtWidgets.QDialog):
         self.help_button.setFixedWidth(25)
         self.help_button.setToolTip("Open the README web page")
         self.load_pose_button = QtWidgets.QPushButton("Load pose")
+        self.apply_plan_button = QtWidgets.QPushButton("Apply plan")
+        self.apply_plan_button.setToolTip("Key a plan or viseme track file written by the auto_lip_sync command line tool")
+        self.submit_job_button = QtWidgets.QPushButton("Submit")
+        self.submit_job_button.setToolTip("Queue the clip for the background workers (python -m auto_lip_sync.job_queue worker), "
+                                          "they write its plan next to the sound for Apply plan")
+        self.scene_pass_button = QtWidgets.QPushButton("Scene pass")
+        self.scene_pass_button.setToolTip("Align the clips of several characters from a scene json and key all their rigs in one undo step")
+        self.export_track_button = QtWidgets.QPushButton("Export track")
+        self.export_track_button.setToolTip("Write the viseme timing and per frame weights of the last generated clip for a game engine")
         self.close_button = QtWidgets.QPushButton("Close")
 
         self.separator_line = QtWidgets.QFrame(parent=None)
@@ -259,12 +219,39 @@ class LipSyncDialog(QtWidgets.QDialog):
 
         self.language_label = QtWidgets.QLabel("Language:")
         self.language_combo = QtWidgets.QComboBox()
-        self.language_combo.addItems(["English", "Chinese"])
+        self.language_combo.addItems(list(language_settings))
+        self.language_combo.setCurrentText(self.current_language)
+        self.warm_worker_checkbox = QtWidgets.QCheckBox("Keep MFA loaded")
+        self.warm_worker_checkbox.setToolTip("Align on a background MFA 3.x worker that keeps the model and lexicon loaded between runs")
+        self.warm_worker_checkbox.setEnabled(not language_settings[self.current_language]["mfa_version"].startswith("v1"))
+        self.blend_checkbox = QtWidgets.QCheckBox("Blend visemes")
+        self.blend_checkbox.setToolTip("Blend into each viseme before it is spoken and out of it afterwards instead of holding hard poses")
+        self.long_audio_checkbox = QtWidgets.QCheckBox("Long take")
+        self.long_audio_checkbox.setToolTip("Split the clip at its pauses and align the pieces in parallel, for recordings longer than a minute or two")
+        self.incremental_checkbox = QtWidgets.QCheckBox("Re-key edits only")
+        self.incremental_checkbox.setToolTip("If this sound was generated before with another transcript, only align and re-key the edited parts")
+        self.min_hold_label = QtWidgets.QLabel("Min hold:")
+        self.min_hold_spin = QtWidgets.QSpinBox()
+        self.min_hold_spin.setRange(1, 12)
+        self.min_hold_spin.setValue(lip_sync_core.MIN_HOLD_FRAMES)
+        self.min_hold_spin.setSuffix(" f")
+        self.min_hold_spin.setToolTip("Frames a viseme is held at least, shorter visemes are absorbed by the one before")
+        self.trace_checkbox = QtWidgets.QCheckBox("Write trace")
+        self.trace_checkbox.setToolTip("Time every stage and write a Chrome trace json per clip to the traces folder in the scripts folder")
 
     def create_ui_layout(self):
         language_row = QtWidgets.QHBoxLayout()
         language_row.addWidget(self.language_label)
         language_row.addWidget(self.language_combo)
+        language_row.addWidget(self.warm_worker_checkbox)
+        language_row.addWidget(self.blend_checkbox)
+
+        options_row = QtWidgets.QHBoxLayout()
+        options_row.addWidget(self.long_audio_checkbox)
+        options_row.addWidget(self.incremental_checkbox)
+        options_row.addWidget(self.min_hold_label)
+        options_row.addWidget(self.min_hold_spin)
+        options_row.addWidget(self.trace_checkbox)
 
         sound_input_row = QtWidgets.QHBoxLayout()
         sound_input_row.addWidget(self.sound_text_label)
@@ -276,10 +263,18 @@ class LipSyncDialog(QtWidgets.QDialog):
         text_input_row.addWidget(self.text_filepath_line)
         text_input_row.addWidget(self.text_filepath_button)
 
+        jaw_row = QtWidgets.QHBoxLayout()
+        jaw_row.addWidget(self.jaw_attr_label)
+        jaw_row.addWidget(self.jaw_attr_line)
+        jaw_row.addWidget(self.jaw_closed_spin)
+        jaw_row.addWidget(self.jaw_open_spin)
+
         pose_input_row = QtWidgets.QHBoxLayout()
         pose_input_row.addWidget(self.pose_folder_label)
         pose_input_row.addWidget(self.pose_filepath_line)
         pose_input_row.addWidget(self.pose_filepath_button)
+        pose_input_row.addWidget(self.pose_library_button)
+        pose_input_row.addWidget(self.pack_poses_button)
         pose_input_row.addWidget(self.pose_refresh_button)
         
         pose_buttons_row = QtWidgets.QHBoxLayout()
@@ -288,22 +283,24 @@ class LipSyncDialog(QtWidgets.QDialog):
 
         bottom_buttons_row = QtWidgets.QHBoxLayout()
         bottom_buttons_row.addWidget(self.generate_keys_button)
+        bottom_buttons_row.addWidget(self.submit_job_button)
+        bottom_buttons_row.addWidget(self.apply_plan_button)
+        bottom_buttons_row.addWidget(self.scene_pass_button)
+        bottom_buttons_row.addWidget(self.export_track_button)
         bottom_buttons_row.addWidget(self.close_button)
         bottom_buttons_row.addWidget(self.help_button)
 
         # Add connection between pose file and phoneme
-        pose_widget_layout = QtWidgets.QVBoxLayout()
-        for key in list(self.phone_path_dict.keys()):
-            pose_connect_widget = PoseConnectWidget(key)
-            pose_widget_layout.addWidget(pose_connect_widget)
-            pose_connect_widget.set_text(self.get_pose_paths())
-            self.widget_list.append(pose_connect_widget)
+        pose_widget_layout = self.pose_widget_layout = QtWidgets.QVBoxLayout()
+        self.show_pose_widgets(self.current_language)
             
         main_layout = QtWidgets.QVBoxLayout(self)
         main_layout.setContentsMargins(10, 10, 10, 10)
         main_layout.addLayout(language_row)
         main_layout.addLayout(sound_input_row)
         main_layout.addLayout(text_input_row)
+        main_layout.addLayout(jaw_row)
+        main_layout.addLayout(options_row)
         main_layout.addWidget(self.separator_line)
         main_layout.addLayout(pose_input_row)
         main_layout.addLayout(pose_buttons_row)
@@ -315,20 +312,67 @@ class LipSyncDialog(QtWidgets.QDialog):
         self.sound_filepath_button.clicked.connect(self.input_sound_dialog)
         self.text_filepath_button.clicked.connect(self.input_text_dialog)
         self.pose_filepath_button.clicked.connect(self.pose_folder_dialog)
+        self.pose_library_button.clicked.connect(self.pose_library_dialog)
+        self.pack_poses_button.clicked.connect(self.pack_poses_dialog)
+        self.pose_filepath_line.editingFinished.connect(self.pose_source_edited)
+        self.pose_library_watcher.fileChanged.connect(self.on_pose_library_changed)
         self.save_pose_button.clicked.connect(self.save_pose_dialog)
         self.load_pose_button.clicked.connect(self.load_pose_dialog)
         self.pose_refresh_button.clicked.connect(self.refresh_pose_widgets)
         self.close_button.clicked.connect(self.close_window)
         self.generate_keys_button.clicked.connect(self.generate_animation)
+        self.apply_plan_button.clicked.connect(self.apply_plan_dialog)
+        self.submit_job_button.clicked.connect(self.submit_job)
+        self.scene_pass_button.clicked.connect(self.scene_pass_dialog)
+        self.export_track_button.clicked.connect(self.export_track_dialog)
         self.help_button.clicked.connect(self.open_readme)
         self.language_combo.currentTextChanged.connect(self.update_language)
 
     def pose_folder_dialog(self):
         folder_path = QtWidgets.QFileDialog.getExistingDirectory(self, "Select pose folder path", "")
         if folder_path:
-            self.pose_filepath_line.setText(folder_path)
-            self.pose_folder_path = folder_path
-            self.refresh_pose_widgets()
+            self.set_pose_source(folder_path)
+
+    def pose_library_dialog(self):
+        file_path = QtWidgets.QFileDialog.getOpenFileName(self, "Select pose library", "", "Pose library (*{})".format(LIBRARY_EXTENSION))
+        if file_path[0]:
+            self.set_pose_source(file_path[0])
+
+    def pack_poses_dialog(self):
+        if not self.pose_folder_path or is_library_path(self.pose_folder_path):
+            cmds.warning("Select a pose folder to pack first.")
+            return
+        file_path = QtWidgets.QFileDialog.getSaveFileName(self, "Pack poses", self.pose_folder_path + LIBRARY_EXTENSION,
+                                                          "Pose library (*{})".format(LIBRARY_EXTENSION))
+        if not file_path[0]:
+            return
+        try:
+            count = pack_pose_folder(self.pose_folder_path, file_path[0])
+        except (OSError, ValueError) as e:
+            cmds.warning("Could not pack the poses: {}".format(e))
+            return
+        print("Packed {} poses into {}".format(count, file_path[0]))
+        self.set_pose_source(file_path[0])
+
+    def pose_source_edited(self):
+        if self.pose_filepath_line.text() != self.pose_folder_path:
+            self.set_pose_source(self.pose_filepath_line.text())
+
+    def set_pose_source(self, path):
+        # A pose folder or library file, only a library is watched since a folder is listed again on refresh
+        self.pose_filepath_line.setText(path)
+        self.pose_folder_path = path
+        if self.pose_library_watcher.files():
+            self.pose_library_watcher.removePaths(self.pose_library_watcher.files())
+        if is_library_path(path) and os.path.exists(path):
+            self.pose_library_watcher.addPath(path)
+        self.refresh_pose_widgets()
+
+    def on_pose_library_changed(self, path):
+        # Saving swaps in a new file, which ends the watch on the old one
+        if os.path.exists(path) and path not in self.pose_library_watcher.files():
+            self.pose_library_watcher.addPath(path)
+        self.refresh_pose_widgets()
 
     def input_sound_dialog(self):
         file_path = QtWidgets.QFileDialog.getOpenFileName(self, "Select sound clip", "", "Wav (*.wav);;All files (*.*)")
@@ -337,297 +381,523 @@ class LipSyncDialog(QtWidgets.QDialog):
             self.sound_clip_path = file_path[0]
 
     def save_pose_dialog(self):
+        if is_library_path(self.pose_folder_path):
+            name, accepted = QtWidgets.QInputDialog.getText(self, "Save pose", "Pose name in {}:".format(os.path.basename(self.pose_folder_path)))
+            if accepted and name.strip():
+                self.save_pose(pose_reference(self.pose_folder_path, name.strip()))
+                print("Saved pose {} to {}".format(name.strip(), self.pose_folder_path))
+                self.refresh_pose_widgets()
+            return
         file_path = QtWidgets.QFileDialog.getSaveFileName(self, "Save pose file", self.pose_folder_path, "Pose file (*.json);;All files (*.*)")
         if file_path[0]:
             self.save_pose(file_path[0])
             print("Saved pose: "+file_path[0])
 
     def load_pose_dialog(self):
+        if is_library_path(self.pose_folder_path):
+            try:
+                names = load_library(self.pose_folder_path).names()
+            except (OSError, PoseLibraryError) as e:
+                cmds.warning(str(e))
+                return
+            name, accepted = QtWidgets.QInputDialog.getItem(self, "Load pose", "Pose:", names, 0, False)
+            if accepted and name:
+                self.load_pose(pose_reference(self.pose_folder_path, name))
+                print("Loaded pose {} from {}".format(name, self.pose_folder_path))
+            return
         file_path = QtWidgets.QFileDialog.getOpenFileName(self, "Save pose file", self.pose_folder_path, "Pose file (*.json);;All files (*.*)")
         if file_path[0]:
             self.load_pose(file_path[0])
             print("Loaded pose: "+file_path[0])
 
+    def apply_plan_dialog(self):
+        file_path = QtWidgets.QFileDialog.getOpenFileName(self, "Apply keyframe plan", "", "Plan or track file (*.json *.npz *.csv);;All files (*.*)")
+        if file_path[0]:
+            self.apply_plan_file(file_path[0])
+            print("Applied plan: "+file_path[0])
+
+    def scene_pass_dialog(self):
+        file_path = QtWidgets.QFileDialog.getOpenFileName(self, "Key a scene", "", "Scene assignments (*.json);;All files (*.*)")
+        if file_path[0]:
+            self.run_scene_pass(file_path[0])
+
+    def run_scene_pass(self, scene_path):
+        # Blocks Maya while the clips align, a scene pass is one MFA run per language followed by a single keying pass
+        if self.current_job is not None:
+            cmds.warning("Wait for the queued clips to finish first.")
+            return
+        tracer.reset(enabled=self.trace_checkbox.isChecked())
+        blend = lip_sync_core.default_blend_settings() if self.blend_checkbox.isChecked() else None
+        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+        try:
+            keyed, assigned = scene_pass.run_scene_pass(scene_path, self.USER_SCRIPT_DIR, cache=self.alignment_cache, blend=blend,
+                                                        on_line=print, min_hold=self.min_hold_spin.value())
+        except lip_sync_core.LipSyncError as e:
+            cmds.warning(str(e))
+            return
+        finally:
+            QtWidgets.QApplication.restoreOverrideCursor()
+            if tracer.enabled:
+                self.write_trace({"sound": scene_path})
+        print("Keyed {} of {} characters from {}".format(keyed, assigned, scene_path))
+
+    def export_track_dialog(self):
+        if not self.last_plan:
+            cmds.warning("Generate keyframes for a clip first.")
+            return
+        file_path = QtWidgets.QFileDialog.getSaveFileName(self, "Export viseme track", "", "Numpy archive (*.npz);;Json (*.json);;Csv (*.csv)")
+        if file_path[0]:
+            self.export_track(file_path[0])
+            print("Exported track: "+file_path[0])
+
+    def export_track(self, track_path):
+        plan = self.last_plan
+        settings = language_settings[plan["language"]]
+        track = tracks.build_track(plan["keys"], maya_keys.get_fps(), plan["language"], settings["phone_dict"],
+                                   list(plan["phone_path_dict"]), plan["blend"], sound=plan["sound"])
+        try:
+            tracks.write_track(track_path, track)
+        except tracks.TrackError as e:
+            cmds.error(str(e))
+
     def input_text_dialog(self):
         file_path = QtWidgets.QFileDialog.getOpenFileName(self, "Select dialog transcript", "", "Text (*.txt);;All files (*.*)")
         if file_path[0]:
             self.text_filepath_line.setText(file_path[0])
             self.text_file_path = file_path[0]
 
-    def find_textgrid_file(self):
-        path = self.OUTPUT_FOLDER_PATH
-        textgrid_file = ""
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                if file.endswith(".TextGrid"):
-                    textgrid_file = root+"/"+file
-        return textgrid_file
+    def check_dependencies(self):
+        # Only the MFA of the language the dialog opens with, other languages are checked when a clip uses them
+        try:
+            language_settings.check(self.current_language)
+        except LanguagePackError as e:
+            cmds.confirmDialog(title="Path doesn't exsist!", message=str(e))
+
+    def find_textgrid_file(self, clip_name=None):
+        return lip_sync_core.find_textgrid_file(self.OUTPUT_FOLDER_PATH, clip_name)
 
     def open_readme(self):
         webbrowser.open_new("https://github.com/joaen/maya_auto_lip_sync/blob/main/README.md")
 
     def generate_animation(self):
-        number_of_operations = 12
-        current_operation = 0
-        p_dialog = QtWidgets.QProgressDialog("Analyzing the input data and generating keyframes...", "Cancel", 0, number_of_operations, self)
-        p_dialog.setWindowFlags(p_dialog.windowFlags() ^ QtCore.Qt.WindowCloseButtonHint)
-        p_dialog.setWindowFlags(p_dialog.windowFlags() ^ QtCore.Qt.WindowContextHelpButtonHint)
-        p_dialog.setWindowTitle("Progress...")
-        p_dialog.setValue(0)
-        p_dialog.setWindowModality(QtCore.Qt.WindowModal)
-        p_dialog.show()
-        QtCore.QCoreApplication.processEvents()
-
-        self.create_clean_input_folder()
+        # Snapshot the inputs so the user can set up and queue the next clip while this one is aligning
         self.update_phone_paths()
-        p_dialog.setValue(current_operation + 1)
+        job = {
+            "sound": self.sound_clip_path,
+            "text": self.text_file_path,
+            "language": self.current_language,
+            "phone_dict": self.phone_dict,
+            "phone_path_dict": OrderedDict(self.phone_path_dict),
+            "warm": self.warm_worker_checkbox.isEnabled() and self.warm_worker_checkbox.isChecked(),
+            "jaw_attr": self.jaw_attr_line.text().strip(),
+            "jaw_range": (self.jaw_closed_spin.value(), self.jaw_open_spin.value()),
+            "blend": lip_sync_core.default_blend_settings() if self.blend_checkbox.isChecked() else None,
+            "long": self.long_audio_checkbox.isChecked(),
+            "incremental": self.incremental_checkbox.isChecked(),
+            "min_hold": self.min_hold_spin.value(),
+            "trace": self.trace_checkbox.isChecked(),
+        }
+        self.pending_jobs.append(job)
+        if self.current_job is None:
+            self.start_next_job()
+        else:
+            print(f"Queued {os.path.basename(job['sound'])} ({len(self.pending_jobs)} waiting)")
+            self.update_progress_label()
 
+    def submit_job(self):
+        # Same settings as Generate keyframes, as command line arguments for the worker
+        self.update_phone_paths()
+        if not os.path.exists(self.sound_clip_path) or not os.path.exists(self.text_file_path):
+            cmds.warning("Select a sound clip and a transcript first.")
+            return
+        args = ["--language", self.current_language, "--fps", str(maya_keys.get_fps()), "--min-hold", str(self.min_hold_spin.value())]
+        if self.blend_checkbox.isChecked():
+            args.append("--blend")
+        if self.long_audio_checkbox.isChecked():
+            args.append("--long")
+        jaw_attr = self.jaw_attr_line.text().strip()
+        if jaw_attr:
+            args += ["--jaw-attr", jaw_attr, "--jaw-range", str(self.jaw_closed_spin.value()), str(self.jaw_open_spin.value())]
+        plan_path = os.path.splitext(self.sound_clip_path)[0] + ".plan.json"
         try:
-            self.import_sound()
-        except:
+            queue = JobQueue()
+            job_id = queue.submit(self.sound_clip_path, self.text_file_path, plan_path, args, pose_map=OrderedDict(self.phone_path_dict))
+        except OSError as e:
+            cmds.warning("Could not queue the clip: {}".format(e))
+            return
+        print("Queued {} as job {} in {}, the plan will be written to {}".format(os.path.basename(self.sound_clip_path), job_id,
+                                                                               queue.folder, plan_path))
+
+    def start_next_job(self):
+        if not self.pending_jobs:
+            return
+        job = self.current_job = self.pending_jobs.pop(0)
+
+        self.p_dialog = QtWidgets.QProgressDialog("", "Cancel", 0, 100, self)
+        self.p_dialog.setWindowFlags(self.p_dialog.windowFlags() ^ QtCore.Qt.WindowContextHelpButtonHint)
+        self.p_dialog.setWindowTitle("Progress...")
+        self.p_dialog.setWindowModality(QtCore.Qt.NonModal)
+        self.p_dialog.setAutoClose(False)
+        self.p_dialog.setAutoReset(False)
+        self.p_dialog.setValue(0)
+        self.update_progress_label()
+        self.p_dialog.show()
+
+        tracer.reset(enabled=job["trace"])
+        job["span"] = tracer.begin("generate animation", sound=job["sound"], language=job["language"])
+
+        # Skip MFA if this audio and transcript were aligned before with the same lexicon and model
+        settings = language_settings[job["language"]]
+        try:
+            transcript = lip_sync_core.read_transcript(job["text"])
+            with tracer.span("cache lookup"):
+                job["cache_key"] = alignment_key(job["sound"], transcript, settings)
+                cached_path = self.alignment_cache.get(job["cache_key"])
+        except (OSError, lip_sync_core.LipSyncError):
             traceback.print_exc()
-            cmds.warning("Could not import sound file.")
-        p_dialog.setValue(current_operation + 1)
+            self.finish_job()
+            return
+        job["transcript"] = transcript
+        if cached_path:
+            print("Using cached alignment: " + cached_path)
+            remember_run(self.alignment_cache, job["sound"], transcript, settings, job["cache_key"])
+            self.key_job(job, cached_path)
+            self.finish_job()
+            return
+
+        # Switching to a language is allowed without its MFA, only a clip that has to be aligned needs it
+        try:
+            language_settings.check(job["language"])
+        except LanguagePackError as e:
+            cmds.warning(str(e))
+            self.finish_job()
+            return
+
+        # An edited transcript of a clip generated before only sends the edited spans to MFA
+        if job["incremental"]:
+            job["edits"] = lip_sync_core.plan_realignment(self.alignment_cache, job["sound"], transcript, settings)
+        checked_text = " ".join(segment.text for segment in job["edits"][1]) if job.get("edits") else transcript
+
+        # Catch words the lexicon can't pronounce before MFA spends minutes on the clip
+        try:
+            preflight = lip_sync_core.preflight_transcript(checked_text, settings, self.USER_SCRIPT_DIR, allow_oov=True)
+        except lip_sync_core.LipSyncError as e:
+            cmds.warning(str(e))
+            self.finish_job()
+            return
+        if preflight.oov and not self.confirm_oov(job, preflight):
+            self.finish_job()
+            return
+
+        try:
+            with tracer.span("stage input"):
+                if job.get("edits"):
+                    self.delete_input_folder()
+                    spoken = [segment for segment in job["edits"][1] if segment.text]
+                    if spoken:
+                        lip_sync_core.stage_edits(job["sound"], spoken, self.INPUT_FOLDER_PATH)
+                    job["name"] = os.path.splitext(os.path.basename(job["sound"]))[0]
+                elif job["long"]:
+                    self.delete_input_folder()
+                    job["segments"] = lip_sync_core.stage_long_audio(job["sound"], transcript, self.INPUT_FOLDER_PATH)
+                    job["name"] = os.path.splitext(os.path.basename(job["sound"]))[0]
+                else:
+                    job["name"] = self.create_clean_input_folder(job["sound"], job["text"])
+                job["warm"] = lip_sync_core.use_warm_worker(job["warm"], preflight)
+                if not job["warm"]:
+                    settings = lip_sync_core.lexicon_settings(settings, preflight, self.LEXICON_FOLDER_PATH)
+        except lip_sync_core.LipSyncError as e:
+            cmds.warning(str(e))
+            self.finish_job()
+            return
+        except Exception:
+            traceback.print_exc()
+            self.finish_job()
+            return
+        self.set_progress(self.ALIGN_PROGRESS[0])
+        if job.get("edits") and not spoken:
+            # Only deletions, nothing to align
+            self.finish_alignment(job)
+            self.finish_job()
+            return
 
         # Run force aligner
-        print(f"[DEBUG] Running MFA for language: {self.current_language}")
-        print(f"[DEBUG] Using LEXICON_PATH: {self.LEXICON_PATH}")
-        print(f"[DEBUG] Using LANGUAGE_PATH: {self.LANGUAGE_PATH}")
-        print("MFA_PATH:", self.MFA_PATH)
+        print(f"[DEBUG] Running MFA for language: {job['language']}")
         print("INPUT_FOLDER_PATH:", self.INPUT_FOLDER_PATH)
         print("OUTPUT_FOLDER_PATH:", self.OUTPUT_FOLDER_PATH)
-        print("Command to run:")
-        
-        # Use different MFA versions based on language
-        if self.current_language == "English":
-            # MFA 1.0.1 command format
-            mfa_cmd = os.path.join(self.current_mfa_path, self.current_mfa_align_cmd)
-            command = '"{}" "{}" "{}" "{}" "{}"'.format(
-                mfa_cmd,
-                self.INPUT_FOLDER_PATH,
-                self.LEXICON_PATH,
-                self.LANGUAGE_PATH,
-                self.OUTPUT_FOLDER_PATH
-            )
-        else:
-            # MFA 3.2.3 command format for Chinese
-            mfa_cmd = os.path.join(self.current_mfa_path, self.current_mfa_align_cmd)
-            # Set environment variables for MFA 3.2.3
-            env = os.environ.copy()
-            env['PATH'] = os.path.join(self.current_mfa_path, 'Library', 'bin') + os.pathsep + env.get('PATH', '')
-            
-            command = '"{}" -m montreal_forced_aligner.command_line.mfa align "{}" "{}" "{}" "{}"'.format(
-                mfa_cmd,
-                self.INPUT_FOLDER_PATH,
-                self.LEXICON_PATH,
-                self.LANGUAGE_PATH,
-                self.OUTPUT_FOLDER_PATH
-            )
-        print("Running command:", command)  # For debugging
-        
-        # Use environment variables for Chinese MFA 3.2.3
-        if self.current_language == "Chinese":
-            process = subprocess.Popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                shell=True,
-                env=env
-            )
+        # A long take or a set of edited spans is a corpus of segments, MFA aligns them with one job per core
+        segmented = job["long"] or bool(job.get("edits"))
+        num_jobs = multiprocessing.cpu_count() if segmented else None
+        mfa_process = lip_sync_core.create_aligner_process(settings, self.INPUT_FOLDER_PATH, self.OUTPUT_FOLDER_PATH, num_jobs,
+                                                           warm=job["warm"] and not segmented)
+        self.mfa_worker = MfaWorker(mfa_process, self)
+        self.mfa_worker.line_received.connect(print)
+        self.mfa_worker.progress_changed.connect(self.on_mfa_progress)
+        self.mfa_worker.finished.connect(self.on_alignment_finished)
+        self.p_dialog.canceled.connect(self.mfa_worker.cancel)
+        self.mfa_progress = 0
+        self.mfa_span = tracer.begin("mfa", language=job["language"], warm=job["warm"])
+        self.mfa_stage_span = tracer.begin("mfa " + mfa_stage_name(0))
+        self.mfa_worker.start()
+
+    def confirm_oov(self, job, preflight):
+        text = "{} has {} words the {} lexicon doesn't have:\n\n{}\n\nMFA aligns them as noise. Align anyway?".format(
+            os.path.basename(job["text"]), len(preflight.oov), job["language"], ", ".join(preflight.oov))
+        answer = QtWidgets.QMessageBox.question(self, "Words missing from the lexicon", text)
+        return answer == QtWidgets.QMessageBox.Yes
+
+    def set_progress(self, value, label=None):
+        # Keying runs on the UI thread, let the dialog repaint before the next stage blocks it
+        if not self.p_dialog:
+            return
+        if label:
+            self.p_dialog.setLabelText(label)
+        self.p_dialog.setValue(value)
+        QtWidgets.QApplication.processEvents(QtCore.QEventLoop.ExcludeUserInputEvents)
+
+    def on_mfa_progress(self, progress):
+        # MFA's own 0-100 fills the alignment share of the bar
+        if progress == self.mfa_progress:
+            return
+        self.mfa_progress = progress
+        self.mfa_stage_span = tracer.switch(self.mfa_stage_span, "mfa " + mfa_stage_name(progress))
+        low, high = self.ALIGN_PROGRESS
+        if self.p_dialog:
+            self.p_dialog.setValue(low + (high - low) * progress // 100)
+
+    def update_progress_label(self):
+        if self.p_dialog and self.current_job:
+            text = "Aligning {}...".format(os.path.basename(self.current_job["sound"]))
+            if self.pending_jobs:
+                text += " ({} queued)".format(len(self.pending_jobs))
+            self.p_dialog.setLabelText(text)
+
+    def on_alignment_finished(self):
+        job = self.current_job
+        tracer.end(self.mfa_stage_span)
+        tracer.end(self.mfa_span, return_code=self.mfa_worker.return_code)
+        self.mfa_span = self.mfa_stage_span = None
+        if self.mfa_worker.cancelled:
+            print(f"Cancelled alignment of {job['sound']}")
         else:
-            process = subprocess.Popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                shell=True
-            )
-        
-        for line in process.stdout:
-            if line.strip():
-                current_operation += 1
-                p_dialog.setValue(current_operation)
-                print(line)
-
-        for line in process.stderr:
-            if line.strip():
-                print(line)
-    
-        process.wait()
+            self.finish_alignment(job)
+        self.finish_job()
 
+    def finish_alignment(self, job):
+        # Puts the segments back together if the clip was aligned in pieces, caches the result and keys it
+        windows = None
         try:
-            self.create_keyframes()
+            if job.get("segments"):
+                lip_sync_core.stitch_long_audio(job["segments"], self.OUTPUT_FOLDER_PATH, job["name"])
+            if job.get("edits"):
+                textgrid_path, windows = lip_sync_core.splice_realignment(job["edits"][0], job["edits"][1], self.OUTPUT_FOLDER_PATH, job["name"])
+        except lip_sync_core.LipSyncError as e:
+            # Half a timeline would key over the clip's previous animation, leave the rig as it is
+            cmds.warning("{} {} is not keyed.".format(e, os.path.basename(job["sound"])))
+            return
+        # Only this clip's TextGrid, never another one left in the output folder
+        textgrid_path = self.find_textgrid_file(job["name"])
+        if not textgrid_path:
+            cmds.warning("MFA produced no TextGrid for {}, it is not keyed.".format(job["sound"]))
+            return
+        self.alignment_cache.put(job["cache_key"], textgrid_path)
+        remember_run(self.alignment_cache, job["sound"], job["transcript"], language_settings[job["language"]], job["cache_key"])
+        self.key_job(job, textgrid_path, windows)
+
+    def key_job(self, job, textgrid_path, windows=None):
+        self.set_progress(self.ALIGN_PROGRESS[1], "Keying {}...".format(os.path.basename(job["sound"])))
+        try:
+            with tracer.span("import sound"):
+                self.import_sound(job["sound"])
+        except:
+            traceback.print_exc()
+            cmds.warning("Could not import sound file.")
+        envelope = None
+        if job.get("jaw_attr"):
+            try:
+                with tracer.span("envelope"):
+                    envelope = lip_sync_core.envelope_plan(job["sound"], job["jaw_attr"], maya_keys.get_fps(), *job["jaw_range"], cache=self.alignment_cache)
+            except Exception:
+                traceback.print_exc()
+                cmds.warning("Could not compute the loudness envelope, {} is not keyed.".format(job["jaw_attr"]))
+        try:
+            keys = self.create_keyframes(job["phone_dict"], job["phone_path_dict"], textgrid_path, envelope, job.get("blend"), windows,
+                                         job["min_hold"])
+            self.last_plan = {"keys": keys, "language": job["language"], "phone_path_dict": job["phone_path_dict"],
+                              "blend": job.get("blend"), "sound": os.path.abspath(job["sound"])}
             print("Successfully generated keyframes.")
-            p_dialog.setValue(number_of_operations)
-            p_dialog.close()
         except:
             traceback.print_exc()
-            p_dialog.setValue(number_of_operations)
-            p_dialog.close()
-        
+
+    def finish_job(self):
         self.delete_input_folder()
+        job = self.current_job
+        if job and tracer.enabled:
+            tracer.end(job.pop("span", None))
+            self.write_trace(job)
+        if self.p_dialog:
+            self.p_dialog.setValue(100)
+            self.p_dialog.close()
+            self.p_dialog.deleteLater()
+            self.p_dialog = None
+        if self.mfa_worker:
+            self.mfa_worker.deleteLater()
+            self.mfa_worker = None
+        self.current_job = None
+        self.start_next_job()
+
+    def write_trace(self, job):
+        name = os.path.splitext(os.path.basename(job["sound"]))[0]
+        trace_path = os.path.join(self.TRACE_FOLDER_PATH, "{}_{}.json".format(name, time.strftime("%Y%m%d_%H%M%S")))
+        try:
+            tracer.write(trace_path)
+            print(f"[DEBUG] Timings: {tracer.summary()}")
+            print(f"[DEBUG] Wrote trace to {trace_path}")
+        except OSError:
+            traceback.print_exc()
+        tracer.reset(enabled=False)
+
+    def cancel_jobs(self):
+        self.pending_jobs = []
+        if self.mfa_worker:
+            self.mfa_worker.cancel()
+            self.mfa_worker.wait()
 
-    def import_sound(self):
-        cmds.sound(file=self.sound_clip_path, name="SoundFile")
+    def import_sound(self, sound_path=None):
+        sound_node = maya_keys.import_sound(sound_path or self.sound_clip_path)
         gPlayBackSlider = mel.eval("$tmpVar=$gPlayBackSlider")
-        cmds.timeControl( gPlayBackSlider, edit=True, sound="SoundFile")
+        cmds.timeControl( gPlayBackSlider, edit=True, sound=sound_node)
 
     def delete_input_folder(self):
-        try:
-            shutil.rmtree(self.INPUT_FOLDER_PATH)
-            shutil.rmtree(self.OUTPUT_FOLDER_PATH)
-        except:
-            pass
-
-    def create_clean_input_folder(self):
+        lip_sync_core.delete_folders(self.INPUT_FOLDER_PATH, self.OUTPUT_FOLDER_PATH, self.LEXICON_FOLDER_PATH)
 
+    def create_clean_input_folder(self, sound_path=None, text_path=None):
         self.delete_input_folder()
+        try:
+            return lip_sync_core.stage_input(sound_path or self.sound_clip_path, text_path or self.text_file_path, self.INPUT_FOLDER_PATH)
+        except lip_sync_core.LipSyncError as e:
+            cmds.error(str(e))
 
-        # Create folder
-        os.mkdir(self.INPUT_FOLDER_PATH)
-        sound_source = self.sound_clip_path
-        text_source = self.text_file_path
-        destination = self.INPUT_FOLDER_PATH
-
-        # Copy sound file
-        shutil.copy(sound_source, destination)
-        
-        # Copy and encode text file with UTF-8
-        sound_name = ""
-        for file in os.listdir(destination):
-            if file.endswith(".wav"):
-                sound_name = file.split(".")[0]
-        
-        # Try different encodings
-        encodings = ['utf-8', 'gb18030', 'big5', 'gbk']
-        text_content = None
-        
-        for enc in encodings:
-            try:
-                with open(text_source, 'r', encoding=enc) as source_file:
-                    text_content = source_file.read()
-                break  # If successful, break the loop
-            except UnicodeDecodeError:
-                continue
-        
-        if text_content is None:
-            cmds.error("Could not decode the text file with any of the supported encodings. Please ensure the file is encoded in UTF-8, GB18030, Big5, or GBK.")
-            return
-        
-        # Write the text file in UTF-8
-        target_path = os.path.join(destination, sound_name + ".txt")
-        with open(target_path, 'w', encoding='utf-8') as target_file:
-            target_file.write(text_content)
-
-    def create_keyframes(self):
-        print("[DEBUG] Entered create_keyframes")
-        textgrid_path = self.find_textgrid_file()
+    def create_keyframes(self, phone_dict=None, phone_path_dict=None, textgrid_path=None, envelope=None, blend=None, windows=None,
+                         min_hold=lip_sync_core.MIN_HOLD_FRAMES):
         print(f"[DEBUG] TextGrid path: {textgrid_path}")
 
         if not textgrid_path:
             cmds.error("No TextGrid file found. This usually means the Montreal Forced Aligner failed to run. Please check that:")
             cmds.error("1. Montreal Forced Aligner is properly installed")
-            cmds.error("2. Input audio file is 16kHz, single channel WAV format")
+            cmds.error("2. Input audio file is an uncompressed WAV file")
             cmds.error("3. Input text file is properly formatted")
             return
 
-        if not os.path.exists(textgrid_path):
-            cmds.error(f"TextGrid file not found at: {textgrid_path}")
-            return
-
         try:
-            print("[DEBUG] Loading TextGrid file")
-            tg = textgrid.TextGrid.fromFile(textgrid_path)
-            print(f"[DEBUG] TextGrid loaded. Number of tiers: {len(tg)}")
-            iterations = len(tg[1])
-            print(f"[DEBUG] Number of intervals in phones tier: {iterations}")
-
-            for i in range(iterations):
-                min_time = str(tg[1][i].minTime)
-                max_time = str(tg[1][i].maxTime)
-                phone = tg[1][i].mark
-
-                key_value = self.phone_dict.get(phone)
-                pose_path = None
-                for k in self.phone_path_dict:
-                    if key_value in k:
-                        pose_path = self.phone_path_dict.get(k)
-                print(f"[DEBUG] Interval {i}: {min_time}-{max_time}, phone: {phone}, key_value: {key_value}, pose_path: {pose_path}")
-
-                if not pose_path or not os.path.exists(pose_path):
-                    print(f"[ERROR] Skipping phone '{phone}' (key_value: {key_value}) - no valid pose path.")
-                    continue
-
-                self.load_pose(pose_path)
-                cmds.setKeyframe(self.active_controls, time=[min_time+"sec", max_time+"sec"])
-                cmds.keyTangent(self.active_controls, inTangentType="spline", outTangentType="spline")
-            print("[DEBUG] Finished creating keyframes")
+            intervals = lip_sync_core.read_phone_intervals(textgrid_path)
+            print(f"[DEBUG] Number of intervals in phones tier: {len(intervals)}")
         except Exception as e:
-            print(f"[DEBUG] Exception in create_keyframes: {e}")
             cmds.error(f"Error reading TextGrid file: {str(e)}")
             return
 
-    def save_pose(self, pose_path):
-        controllers = cmds.ls(sl=True)
-        controller_dict = OrderedDict()
-        attr_dict = OrderedDict()
-
-        for ctrl in controllers:
-            keyable_attr_list = cmds.listAttr(ctrl, keyable=True, unlocked=True)
+        phone_index = lip_sync_core.PhoneIndex(phone_dict or self.phone_dict, phone_path_dict or self.phone_path_dict)
+        keys = lip_sync_core.compute_keyframe_plan(intervals, phone_index)
+        if phone_index.summary():
+            print("[WARNING] " + phone_index.summary().replace("\n", "\n[WARNING] "))
+        keys = lip_sync_core.compact_keyframe_plan(keys, maya_keys.get_fps(), min_hold)
+        self.set_progress(90)
+        self.apply_keyframe_plan(keys, envelope, blend, windows)
+        return keys
+
+    def apply_keyframe_plan(self, keys, envelope=None, blend=None, windows=None):
+        curves = maya_keys.apply_keyframe_plan(keys, envelope, blend, windows)
+        self.active_controls = list(OrderedDict.fromkeys(name.split(".")[0] for name in curves))
+
+    def apply_plan_file(self, plan_path):
+        if tracks.is_track_file(plan_path):
+            self.apply_track_file(plan_path)
+            return
+        try:
+            plan = lip_sync_core.read_plan(plan_path)
+        except lip_sync_core.LipSyncError as e:
+            cmds.error(str(e))
+            return
 
-            for attr in keyable_attr_list:
-                attr_value = cmds.getAttr(ctrl+"."+attr)
-                attr_dict[attr] = attr_value
+        if plan.get("sound") and os.path.exists(plan["sound"]):
+            self.sound_clip_path = plan["sound"]
+            self.sound_filepath_line.setText(self.sound_clip_path)
+            self.import_sound()
+        self.apply_keyframe_plan(plan["keys"], plan.get("envelope"), plan.get("blend"), plan.get("windows"))
 
-            controller_dict[ctrl] = attr_dict
-            attr_dict = {}
-        save_path = pose_path
+    def apply_track_file(self, track_path):
+        # Keys the track with the poses currently assigned in the dialog
+        try:
+            track = tracks.read_track(track_path)
+        except (OSError, ValueError) as e:
+            cmds.error(str(e))
+            return
+        if track.header.get("language") != self.current_language:
+            cmds.warning("The track was made for {}, the dialog is set to {}".format(track.header.get("language"), self.current_language))
+        if track.header.get("sound") and os.path.exists(track.header["sound"]):
+            self.import_sound(track.header["sound"])
+        self.update_phone_paths()
+        curves = maya_keys.apply_track(track, self.phone_path_dict)
+        self.active_controls = list(OrderedDict.fromkeys(name.split(".")[0] for name in curves))
 
-        with open(save_path, "w", encoding='utf-8') as jsonFile:
-            json.dump(controller_dict, jsonFile, indent=4, ensure_ascii=False)
+    def save_pose(self, pose_path):
+        maya_keys.save_pose(pose_path, cmds.ls(sl=True))
 
     def load_pose(self, file_path):
-        with open(file_path, 'r', encoding='utf-8') as f:
-            pose_data = json.load(f)
-        self.active_controls = []
-
-        if self.PYTHON_VERSION < 3:
-            for ctrl, input in pose_data.iteritems():
-                for attr, value in input.iteritems():
-                    cmds.setAttr(ctrl+"."+attr, value)
-                self.active_controls.append(ctrl)
-        else:
-            for ctrl, input in pose_data.items():
-                for attr, value in input.items():
-                    cmds.setAttr(ctrl+"."+attr, value)
-                self.active_controls.append(ctrl)
+        pose = maya_keys.load_pose(file_path)
+        self.active_controls = list(pose.controls)
 
     def get_pose_paths(self):
-        pose_list = []
-        folder_path = self.pose_folder_path
-        try:
-            for file in os.listdir(folder_path):
-                if file.endswith(".json"):
-                    pose_list.append(folder_path+"/"+file)
-            return pose_list
-        except:
-            return pose_list
+        return list_poses(self.pose_folder_path)
 
     def refresh_pose_widgets(self):
+        # One listing of the folder or library for all dropdowns, the hidden ones of other languages refresh when shown
+        pose_paths = self.get_pose_paths()
         for w in self.widget_list:
             w.clear_box()
-            w.set_text(self.get_pose_paths())
+            w.set_text(pose_paths)
+        self.stale_pose_widgets = set(self.pose_widget_sets) - {self.current_language}
+
+    def show_pose_widgets(self, language):
+        # Every language keeps its dropdowns, switching back shows them again with the poses picked before
+        for widget in self.widget_list:
+            widget.hide()
+        widgets = self.pose_widget_sets.get(language)
+        if widgets is None:
+            widgets = self.pose_widget_sets[language] = []
+            pose_paths = self.get_pose_paths()
+            for key in language_settings[language]["phone_path_dict"]:
+                pose_connect_widget = PoseConnectWidget(key)
+                self.pose_widget_layout.addWidget(pose_connect_widget)
+                pose_connect_widget.set_text(pose_paths)
+                widgets.append(pose_connect_widget)
+        else:
+            for widget in widgets:
+                widget.show()
+        self.widget_list = widgets
+        if language in self.stale_pose_widgets:
+            self.stale_pose_widgets.discard(language)
+            self.refresh_pose_widgets()
 
     def update_phone_paths(self):
         for index, key in enumerate(self.phone_path_dict):
             self.phone_path_dict[key] = self.widget_list[index].get_text()
 
     def close_window(self):
+        self.cancel_jobs()
         self.close()
         self.deleteLater()
 
     def update_language(self, language):
         print(f"[DEBUG] Switching language to: {language}")
-        settings = language_settings[language]
+        try:
+            settings = language_settings[language]
+        except LanguagePackError as e:
+            cmds.warning(str(e))
+            self.language_combo.blockSignals(True)
+            self.language_combo.setCurrentText(self.current_language)
+            self.language_combo.blockSignals(False)
+            return
         self.current_language = language
         self.LEXICON_PATH = settings["lexicon"]
         self.LANGUAGE_PATH = settings["model"]
@@ -637,31 +907,13 @@ class LipSyncDialog(QtWidgets.QDialog):
         self.current_mfa_path = settings["mfa_path"]
         self.current_mfa_align_cmd = settings["mfa_align_cmd"]
         self.current_mfa_train_cmd = settings["mfa_train_cmd"]
+        self.warm_worker_checkbox.setEnabled(not settings["mfa_version"].startswith("v1"))
         print(f"[DEBUG] LEXICON_PATH set to: {self.LEXICON_PATH}")
         print(f"[DEBUG] LANGUAGE_PATH set to: {self.LANGUAGE_PATH}")
         print(f"[DEBUG] MFA Version: {settings['mfa_version']}")
         print(f"[DEBUG] MFA Path: {self.current_mfa_path}")
         print(f"[DEBUG] MFA Commands: {self.current_mfa_align_cmd}, {self.current_mfa_train_cmd}")
-        
-        # Clear and rebuild the pose widgets with new phoneme categories
-        for widget in self.widget_list:
-            widget.deleteLater()
-        self.widget_list.clear()
-        
-        # Rebuild pose widgets with new phoneme categories
-        # Find the main layout and get the pose widget layout (6th item in main layout)
-        main_layout = self.layout()
-        if main_layout and main_layout.count() >= 7:
-            pose_widget_layout = main_layout.itemAt(6).layout()  # pose_widget_layout is the 7th item
-            if pose_widget_layout:
-                for key in list(self.phone_path_dict.keys()):
-                    pose_connect_widget = PoseConnectWidget(key)
-                    pose_widget_layout.addWidget(pose_connect_widget)
-                    pose_connect_widget.set_text(self.get_pose_paths())
-                    self.widget_list.append(pose_connect_widget)
-        
-        # Refresh the pose widgets to show current paths
-        self.refresh_pose_widgets()
+        self.show_pose_widgets(language)
 
 
 def start():
@@ -0,0 +1,287 @@
+'''
+Name: batch
+
+Description: Batch corpus mode. Stages a whole folder (or manifest) of wav/txt pairs as one MFA corpus, aligns it in
+a single MFA run with parallel jobs and writes one keyframe plan per clip. Run under mayapy with --apply-scenes to key
+each plan straight into the scene listed for its clip in the manifest.
+
+Usage (from the folder that contains the auto_lip_sync folder):
+
+python -m auto_lip_sync.batch episode_vo/ -o episode_plans/ --language Chinese --jobs 8 --pose-map poses.json
+mayapy -m auto_lip_sync.batch manifest.json -o episode_plans/ --pose-map poses.json --apply-scenes
+
+A manifest is a json list of clips: [{"sound": "vo/line_001.wav", "text": "vo/line_001.txt", "scene": "shots/sh010.ma",
+"speaker": "hero"}, ...]. "scene" and "speaker" are optional, relative paths are resolved from the manifest's folder.
+'''
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+from collections import OrderedDict
+
+from . import lip_sync_core
+from .lip_sync_core import language_settings, LipSyncError
+from .language_packs import LanguagePackError
+from .lexicon import Preflight
+from .align_cache import AlignmentCache, alignment_key
+from . import tracks
+
+
+def find_clip_pairs(folder):
+    # Every wav with a txt or lab transcript of the same name
+    clips = []
+    for file in sorted(os.listdir(folder)):
+        name, ext = os.path.splitext(file)
+        if ext.lower() != ".wav":
+            continue
+        for text_ext in (".txt", ".lab"):
+            text_path = os.path.join(folder, name + text_ext)
+            if os.path.exists(text_path):
+                clips.append({"sound": os.path.join(folder, file), "text": text_path})
+                break
+        else:
+            print("[WARNING] No transcript for {}, skipping it".format(file))
+    return clips
+
+
+def read_manifest(manifest_path):
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    root = os.path.dirname(os.path.abspath(manifest_path))
+    clips = []
+    for entry in entries:
+        clip = dict(entry)
+        for key in ("sound", "text", "scene"):
+            if clip.get(key):
+                clip[key] = os.path.join(root, clip[key])
+        clips.append(clip)
+    return clips
+
+
+def load_clips(source):
+    if os.path.isdir(source):
+        return find_clip_pairs(source)
+    return read_manifest(source)
+
+
+def assign_clip_names(clips):
+    # Gives every clip a unique name in the corpus and stores it in clip["name"]
+    used_names = set()
+    for clip in clips:
+        base_name = os.path.splitext(os.path.basename(clip["sound"]))[0]
+        name = base_name
+        suffix = 2
+        while name in used_names:
+            name = "{}_{}".format(base_name, suffix)
+            suffix += 1
+        used_names.add(name)
+        clip["name"] = name
+    return clips
+
+
+def stage_corpus(clips, input_folder):
+    # Returns the clips that were staged, clips with unusable audio are reported and left out. MFA hands out its jobs
+    # by speaker folder, so a clip without a speaker gets a folder of its own instead of all of them sharing one job.
+    os.makedirs(input_folder)
+    staged = []
+    for clip in clips:
+        folder = os.path.join(input_folder, clip.get("speaker") or clip["name"])
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+        try:
+            lip_sync_core.stage_clip(clip["sound"], clip["text"], folder, clip["name"])
+        except LipSyncError as e:
+            print("[ERROR] {}".format(e))
+            continue
+        staged.append(clip)
+    return staged
+
+
+def preflight_corpus(clips, settings, work_dir=None, allow_oov=False):
+    # Checks every transcript against the lexicon, see lip_sync_core.preflight_transcript. Returns the clips that can
+    # be aligned and one Preflight with the lexicon words and G2P pronunciations all of them need, clips with unknown
+    # words are reported and left out.
+    checked = []
+    extra = OrderedDict()
+    words = set()
+    for clip in clips:
+        try:
+            preflight = lip_sync_core.preflight_transcript(lip_sync_core.read_transcript(clip["text"]), settings, work_dir, allow_oov)
+        except LipSyncError as e:
+            print("[ERROR] {}: {}".format(clip["text"], e))
+            continue
+        extra.update(preflight.extra)
+        words.update(preflight.words)
+        checked.append(clip)
+    return checked, Preflight([], [], extra, words)
+
+
+def align_corpus(clips, language, work_dir=None, num_jobs=None, on_line=None, cache=None, allow_oov=False):
+    # Runs one MFA pass over all clips and returns {clip name: phone intervals}. Clips MFA failed on are left out.
+    # With an AlignmentCache only the clips that aren't cached yet go to MFA.
+    settings = language_settings[language]
+    assign_clip_names(clips)
+
+    results = {}
+    to_align = []
+    for clip in clips:
+        cached_path = None
+        if cache is not None:
+            # A transcript or sound that can't be read fails this clip, not the batch
+            try:
+                clip["cache_key"] = alignment_key(clip["sound"], lip_sync_core.read_transcript(clip["text"]), settings)
+            except (OSError, LipSyncError) as e:
+                print("[ERROR] {}: {}".format(clip["text"], e))
+                continue
+            cached_path = cache.get(clip["cache_key"])
+        if cached_path:
+            results[clip["name"]] = lip_sync_core.read_phone_intervals(cached_path)
+        else:
+            to_align.append(clip)
+    if cache is not None:
+        print("{} of {} clips found in the alignment cache".format(len(results), len(clips)))
+
+    if to_align:
+        work_dir = work_dir or lip_sync_core.USER_SCRIPT_DIR
+        input_folder = os.path.join(work_dir, "batch_input")
+        output_folder = os.path.join(work_dir, "batch_output")
+        lexicon_folder = os.path.join(work_dir, "batch_lexicon")
+        to_align, preflight = preflight_corpus(to_align, settings, work_dir, allow_oov)
+        lip_sync_core.delete_folders(input_folder, output_folder, lexicon_folder)
+        try:
+            to_align = stage_corpus(to_align, input_folder)
+            if to_align:
+                run_settings = lip_sync_core.lexicon_settings(settings, preflight, lexicon_folder)
+                lip_sync_core.run_mfa(run_settings, input_folder, output_folder, on_line, num_jobs or multiprocessing.cpu_count())
+            textgrid_files = lip_sync_core.find_textgrid_files(output_folder)
+            for clip in to_align:
+                textgrid_path = textgrid_files.get(clip["name"])
+                if textgrid_path:
+                    if cache is not None:
+                        cache.put(clip["cache_key"], textgrid_path)
+                    results[clip["name"]] = lip_sync_core.read_phone_intervals(textgrid_path)
+        finally:
+            lip_sync_core.delete_folders(input_folder, output_folder, lexicon_folder)
+
+    return OrderedDict((clip["name"], results[clip["name"]]) for clip in clips if clip["name"] in results)
+
+
+def write_clip_plans(clips, results, language, phone_path_dict, output_folder, envelope_options=None, cache=None, blend=None,
+                     track_options=None, schedule_options=None):
+    # Writes <clip name>.plan.json for every aligned clip and returns the plan paths.
+    # envelope_options (attr, fps, low, high) adds a loudness channel to every plan, see lip_sync_core.envelope_plan.
+    # blend is stored in every plan as its coarticulation timings, see blending.default_blend_settings.
+    # track_options (extension, fps) also writes a viseme track <clip name>.<extension> per clip, see tracks.build_track.
+    # schedule_options (fps, min hold frames) compiles every plan into a frame snapped schedule, see schedule.
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    phone_index = lip_sync_core.PhoneIndex(language_settings[language]["phone_dict"], phone_path_dict)
+    plan_paths = []
+    for clip in clips:
+        intervals = results.get(clip["name"])
+        if intervals is None:
+            print("[ERROR] MFA produced no TextGrid for {}".format(clip["sound"]))
+            continue
+        keys = lip_sync_core.compute_keyframe_plan(intervals, phone_index)
+        if schedule_options:
+            keys = lip_sync_core.compact_keyframe_plan(keys, *schedule_options)
+        extra = {"scene": clip.get("scene", "")}
+        if blend:
+            extra["blend"] = blend
+        if envelope_options:
+            try:
+                extra["envelope"] = lip_sync_core.envelope_plan(clip["sound"], *envelope_options, cache=cache)
+            except LipSyncError as e:
+                print("[ERROR] {}".format(e))
+        plan_path = os.path.join(output_folder, clip["name"] + ".plan.json")
+        lip_sync_core.write_plan(plan_path, keys, language, os.path.abspath(clip["sound"]), os.path.abspath(clip["text"]), **extra)
+        plan_paths.append(plan_path)
+        if track_options:
+            extension, fps = track_options
+            track = tracks.build_track(keys, fps, language, language_settings[language]["phone_dict"], list(phone_path_dict),
+                                       blend, sound=os.path.abspath(clip["sound"]))
+            tracks.write_track(os.path.join(output_folder, clip["name"] + "." + extension), track)
+    if phone_index.summary():
+        print(phone_index.summary())
+    return plan_paths
+
+
+def apply_plans_to_scenes(plan_paths):
+    # mayapy only: opens the scene of every plan, keys it and saves it
+    import maya.standalone
+    maya.standalone.initialize()
+    from maya import cmds
+    from . import maya_keys
+
+    for plan_path in plan_paths:
+        plan = lip_sync_core.read_plan(plan_path)
+        if not plan.get("scene"):
+            print("[WARNING] {} has no scene, skipping it".format(plan_path))
+            continue
+        cmds.file(plan["scene"], open=True, force=True)
+        cmds.sound(file=plan["sound"], name="SoundFile")
+        maya_keys.apply_keyframe_plan(plan["keys"], plan.get("envelope"), plan.get("blend"), plan.get("windows"))
+        cmds.file(save=True, force=True)
+        print("Keyed {}".format(plan["scene"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="auto_lip_sync.batch", description="Align a folder or manifest of wav/txt pairs in one MFA run.")
+    parser.add_argument("source", help="Folder with wav/txt pairs or a json manifest")
+    parser.add_argument("-o", "--output", required=True, help="Folder to write the keyframe plans to")
+    parser.add_argument("-l", "--language", default="English", choices=sorted(language_settings))
+    parser.add_argument("-j", "--jobs", type=int, help="Number of parallel MFA jobs (default: number of cores)")
+    parser.add_argument("-p", "--pose-map", help="Json file mapping visemes to pose files")
+    parser.add_argument("-w", "--work-dir", help="Folder used for the MFA corpus and output folders")
+    parser.add_argument("--cache-dir", help="Alignment cache folder (default: $AUTO_LIP_SYNC_CACHE or alignment_cache in the script dir)")
+    parser.add_argument("--no-cache", action="store_true", help="Always run MFA and don't store the results")
+    parser.add_argument("--allow-oov", action="store_true", help="Also align clips with words the lexicon can't pronounce")
+    parser.add_argument("--jaw-attr", help="Key this control.attr from the loudness of each clip, e.g. jaw_ctrl.rotateZ")
+    parser.add_argument("--jaw-range", type=float, nargs=2, default=(0.0, 1.0), metavar=("CLOSED", "OPEN"),
+                        help="Values of --jaw-attr at silence and at full loudness (default: 0 1)")
+    parser.add_argument("--fps", type=float, default=24.0, help="Frame rate the plans are snapped to and of the loudness keys (default: 24)")
+    parser.add_argument("--min-hold", type=int, default=lip_sync_core.MIN_HOLD_FRAMES,
+                        help="Frames a viseme is held at least, shorter ones go to the viseme before (default: 1)")
+    parser.add_argument("--keep-intervals", action="store_true", help="Key every MFA interval as it is instead of the compiled schedule")
+    parser.add_argument("--blend", action="store_true", help="Blend neighbouring visemes (coarticulation) when the plans are keyed")
+    parser.add_argument("--track-format", choices=["npz", "json", "csv"], help="Also export a viseme track per clip at --fps")
+    parser.add_argument("--apply-scenes", action="store_true", help="Key every plan into its manifest scene (mayapy only)")
+    args = parser.parse_args(argv)
+
+    try:
+        language_settings.check(args.language)
+    except LanguagePackError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 1
+    phone_path_dict = OrderedDict(language_settings[args.language]["phone_path_dict"])
+    if args.pose_map:
+        with open(args.pose_map, 'r', encoding='utf-8') as f:
+            phone_path_dict.update(json.load(f))
+
+    clips = load_clips(args.source)
+    if not clips:
+        print("Error: no clips found in {}".format(args.source), file=sys.stderr)
+        return 1
+
+    try:
+        cache = None if args.no_cache else AlignmentCache(args.cache_dir)
+        results = align_corpus(clips, args.language, args.work_dir, args.jobs, cache=cache, allow_oov=args.allow_oov)
+    except LipSyncError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 1
+
+    envelope_options = (args.jaw_attr, args.fps) + tuple(args.jaw_range) if args.jaw_attr else None
+    blend = lip_sync_core.default_blend_settings() if args.blend else None
+    track_options = (args.track_format, args.fps) if args.track_format else None
+    schedule_options = None if args.keep_intervals else (args.fps, args.min_hold)
+    plan_paths = write_clip_plans(clips, results, args.language, phone_path_dict, args.output, envelope_options, cache, blend,
+                                  track_options, schedule_options)
+    print("Wrote {} of {} plans to {}".format(len(plan_paths), len(clips), args.output))
+    if args.apply_scenes:
+        apply_plans_to_scenes(plan_paths)
+    return 0 if len(plan_paths) == len(clips) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,433 @@
+'''
+Name: benchmark
+
+Description: Benchmark suite for the keying pipeline. The real code paths (TextGrid reading, plan building,
+maya_keys keying, pose saving and loading and the pose folder listing) run against FakeMaya, a stand-in for
+maya.cmds, maya.mel and maya.OpenMaya that keeps the rig in dicts and counts and times every command. Inputs are
+generated: TextGrids of 1k to 200k intervals with English or Chinese phones, and pose libraries of 10 to 500 controls.
+
+Every case reports wall time (best of --repeat runs), Maya calls per interval and the peak Python memory. The results
+are written as json, and --baseline compares them with an earlier run and exits with 1 when a case got slower by more
+than --max-regression, so a build can fail on a keying throughput regression.
+
+Usage (from the folder that contains the auto_lip_sync folder, no Maya needed):
+
+python -m auto_lip_sync.benchmark --quick -o baseline.json
+python -m auto_lip_sync.benchmark --quick -o current.json --baseline baseline.json --max-regression 0.25
+'''
+import os
+import sys
+import gc
+import json
+import time
+import types
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from collections import Counter, OrderedDict
+
+RESULTS_VERSION = 1
+INTERVAL_COUNTS = (1000, 10000, 50000, 200000)
+QUICK_INTERVAL_COUNTS = (1000, 10000)
+CONTROL_COUNTS = (10, 100, 500)
+QUICK_CONTROL_COUNTS = (10, 100)
+KEYING_CONTROLS = 20
+MOUTH_CONTROLS = 8
+# Cases faster than this are timer noise and aren't compared with the baseline
+MIN_COMPARE_SECONDS = 0.01
+POSE_ATTRS = ("translateX", "translateY", "translateZ", "rotateX", "rotateY", "rotateZ", "scaleX", "scaleY", "scaleZ", "visibility")
+ATTR_TYPES = {"translate": "doubleLinear", "rotate": "doubleAngle"}
+
+
+class FakeMaya(object):
+    # Stand-in for the Maya commands the tool uses. Attribute values, anim curves and connections live in dicts, every
+    # command is counted and timed in calls and seconds.
+
+    COMMANDS = ("getAttr", "setAttr", "listAttr", "listConnections", "createNode", "connectAttr", "keyTangent", "copyKey",
+                "pasteKey", "delete", "undoInfo", "refresh", "warning", "error", "ls", "sound", "timeControl", "select")
+
+    def __init__(self, fps=24.0):
+        self.fps = fps
+        self.cmds = types.ModuleType("maya.cmds")
+        for name in self.COMMANDS:
+            setattr(self.cmds, name, self.counted(name, getattr(self, "cmd_" + name)))
+        self.mel = types.ModuleType("maya.mel")
+        self.mel.eval = self.counted("mel.eval", self.mel_eval)
+        self.open_maya = types.ModuleType("maya.OpenMaya")
+        self.open_maya_ui = types.ModuleType("maya.OpenMayaUI")
+        self.reset()
+
+    def reset(self):
+        self.calls = Counter()
+        self.seconds = Counter()
+        self.values = {}
+        self.controls = OrderedDict()
+        self.sources = {}
+        self.curves = {}
+        self.selection = []
+
+    def counted(self, name, function):
+        def command(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.calls[name] += 1
+                self.seconds[name] += time.perf_counter() - start
+        return command
+
+    def install(self):
+        maya = types.ModuleType("maya")
+        maya.cmds = self.cmds
+        maya.mel = self.mel
+        maya.OpenMaya = self.open_maya
+        maya.OpenMayaUI = self.open_maya_ui
+        sys.modules.update({"maya": maya, "maya.cmds": self.cmds, "maya.mel": self.mel,
+                            "maya.OpenMaya": self.open_maya, "maya.OpenMayaUI": self.open_maya_ui})
+
+    def add_control(self, name, attrs=POSE_ATTRS):
+        self.controls[name] = list(attrs)
+        for attr in attrs:
+            self.values[name + "." + attr] = 1.0 if attr.startswith(("scale", "visibility")) else 0.0
+
+    def key_count(self):
+        return sum(self.curves.values())
+
+    def cmd_getAttr(self, attr, type=False, **kwargs):
+        if attr not in self.values:
+            raise ValueError("No object matches name: " + attr)
+        if type:
+            return ATTR_TYPES.get(attr.split(".")[-1][:-1], "double")
+        return self.values[attr]
+
+    def cmd_setAttr(self, attr, *values, **kwargs):
+        if ".ktv[" in attr:
+            self.curves[attr.split(".")[0]] = kwargs.get("size", len(values) // 2)
+            return
+        if attr not in self.values:
+            raise RuntimeError("No object matches name: " + attr)
+        self.values[attr] = values[0]
+
+    def cmd_listAttr(self, node, **kwargs):
+        return list(self.controls.get(node, []))
+
+    def cmd_listConnections(self, attr, type=None, **kwargs):
+        curve = self.sources.get(attr)
+        return [curve] if curve else None
+
+    def cmd_createNode(self, node_type, name=None, **kwargs):
+        name = name or node_type
+        unique = name
+        suffix = 1
+        while unique in self.curves:
+            unique = "{}{}".format(name, suffix)
+            suffix += 1
+        self.curves[unique] = 0
+        return unique
+
+    def cmd_connectAttr(self, source, destination, **kwargs):
+        self.sources[destination] = source.split(".")[0]
+
+    def cmd_keyTangent(self, *args, **kwargs):
+        pass
+
+    def cmd_copyKey(self, *args, **kwargs):
+        pass
+
+    def cmd_pasteKey(self, attr, **kwargs):
+        pass
+
+    def cmd_delete(self, *nodes, **kwargs):
+        for node in nodes:
+            self.curves.pop(node, None)
+
+    def cmd_undoInfo(self, *args, **kwargs):
+        pass
+
+    def cmd_refresh(self, *args, **kwargs):
+        pass
+
+    def cmd_warning(self, message):
+        pass
+
+    def cmd_error(self, message):
+        raise RuntimeError(message)
+
+    def cmd_ls(self, *args, **kwargs):
+        return list(self.selection) if kwargs.get("sl") or kwargs.get("selection") else list(self.controls)
+
+    def cmd_select(self, *nodes, **kwargs):
+        self.selection = list(nodes)
+
+    def cmd_sound(self, *args, **kwargs):
+        return "SoundFile"
+
+    def cmd_timeControl(self, *args, **kwargs):
+        pass
+
+    def mel_eval(self, command):
+        if command.startswith("currentTimeUnitToFPS"):
+            return self.fps
+        return ""
+
+
+def language_phones(language, phone_dict):
+    # Raw phones the way MFA writes them: English vowels with stress digits, Chinese vowels with tone letters
+    phones = [phone for phone in phone_dict if phone and phone not in ("None", "sil", "sp", "spn", "<eps>")]
+    if language == "English":
+        return [phone + random.choice("012") if phone[0] in "AEIOU" else phone for phone in phones]
+    tones = ["˥", "˧˥", "˨˩˦", "˥˩"]
+    vowels = ("a", "e", "i", "o", "u", "y", "ə", "aj", "aw", "ej", "ow")
+    return [phone + random.choice(tones) if phone in vowels else phone for phone in phones]
+
+
+def generate_textgrid(path, interval_count, language="English", seed=0):
+    from .lip_sync_core import language_settings
+    random.seed(seed)
+    phones = language_phones(language, language_settings[language]["phone_dict"])
+    starts = []
+    labels = []
+    time_now = 0.0
+    for index in range(interval_count):
+        starts.append(time_now)
+        labels.append("sil" if random.random() < 0.08 else random.choice(phones))
+        time_now += random.uniform(0.03, 0.15)
+    duration = time_now
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('File type = "ooTextFile"\nObject class = "TextGrid"\n\nxmin = 0\nxmax = {}\ntiers? <exists>\nsize = 2\nitem []:\n'.format(duration))
+        # A words tier first, so the reader has to skip it like it does with real MFA output
+        word_count = (interval_count + 2) // 3
+        f.write('    item [1]:\n        class = "IntervalTier"\n        name = "words"\n        xmin = 0\n        xmax = {}\n'
+                '        intervals: size = {}\n'.format(duration, word_count))
+        for word in range(word_count):
+            word_start = starts[word * 3]
+            word_end = starts[word * 3 + 3] if word * 3 + 3 < interval_count else duration
+            f.write('        intervals [{}]:\n            xmin = {}\n            xmax = {}\n            text = "w{}"\n'.format(word + 1, word_start, word_end, word))
+        f.write('    item [2]:\n        class = "IntervalTier"\n        name = "phones"\n        xmin = 0\n        xmax = {}\n'
+                '        intervals: size = {}\n'.format(duration, interval_count))
+        for index, label in enumerate(labels):
+            end = starts[index + 1] if index + 1 < interval_count else duration
+            f.write('        intervals [{}]:\n            xmin = {}\n            xmax = {}\n            text = "{}"\n'.format(index + 1, starts[index], end, label))
+    return path
+
+
+def control_names(control_count):
+    return ["face_{:03d}_ctrl".format(index) for index in range(control_count)]
+
+
+def generate_pose_library(folder, visemes, control_count, seed=0):
+    # One pose file per viseme storing POSE_ATTRS of every control. Only the mouth controls change between the poses,
+    # like a real face rig saved with Save pose. Returns {viseme: pose path}.
+    random.seed(seed)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    controls = control_names(control_count)
+    pose_paths = OrderedDict()
+    for viseme in visemes:
+        pose = OrderedDict()
+        for index, ctrl in enumerate(controls):
+            pose[ctrl] = OrderedDict()
+            for attr in POSE_ATTRS:
+                rest = 1.0 if attr.startswith(("scale", "visibility")) else 0.0
+                pose[ctrl][attr] = round(rest + random.uniform(-5, 5), 3) if index < MOUTH_CONTROLS and attr != "visibility" else rest
+        pose_paths[viseme] = os.path.join(folder, viseme + ".json")
+        with open(pose_paths[viseme], "w", encoding="utf-8") as f:
+            json.dump(pose, f, indent=4)
+    return pose_paths
+
+
+def measure(fake_maya, function, repeat=1, setup=None):
+    # Best wall time of `repeat` runs, then one more run under tracemalloc for the peak memory and the Maya calls
+    best = None
+    for run in range(repeat):
+        if setup:
+            setup()
+        fake_maya.reset()
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    if setup:
+        setup()
+    fake_maya.reset()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak, fake_maya.calls.copy(), fake_maya.seconds.copy(), fake_maya.key_count()
+
+
+class BenchmarkRun(object):
+
+    def __init__(self, fake_maya, work_dir, repeat=1):
+        self.fake_maya = fake_maya
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.results = []
+
+    def record(self, name, params, function, per=None, setup=None):
+        seconds, peak, calls, call_seconds, key_count = measure(self.fake_maya, function, self.repeat, setup)
+        result = OrderedDict([("name", name), ("params", params), ("seconds", round(seconds, 6)), ("peak_bytes", peak),
+                              ("maya_calls", sum(calls.values())), ("maya_seconds", round(sum(call_seconds.values()), 6)),
+                              ("keys", key_count), ("calls", OrderedDict(sorted(calls.items())))])
+        if per:
+            result["calls_per_interval"] = round(sum(calls.values()) / float(per), 4)
+            result["intervals_per_second"] = round(per / seconds, 1) if seconds else None
+        self.results.append(result)
+        print("{:<24} {:<64} {:>9.3f} s {:>9.1f} MB {:>9} calls".format(
+            name, json.dumps(params, ensure_ascii=False), seconds, peak / 1048576.0, result["maya_calls"]), file=sys.stderr)
+        return result
+
+    def rig(self, control_count):
+        for ctrl in control_names(control_count):
+            self.fake_maya.add_control(ctrl)
+
+    def keying_cases(self, interval_counts, control_counts, languages):
+        from . import lip_sync_core, maya_keys
+        from .textgrid_reader import read_tier
+        from .blending import default_blend_settings
+
+        cases = [(count, KEYING_CONTROLS) for count in interval_counts]
+        # Rig size scaling runs on the smallest TextGrid
+        cases += [(interval_counts[0], count) for count in control_counts if count != KEYING_CONTROLS]
+        for language in languages:
+            settings = lip_sync_core.language_settings[language]
+            for interval_count, control_count in cases:
+                textgrid_path = os.path.join(self.work_dir, "{}_{}.TextGrid".format(language, interval_count))
+                if not os.path.exists(textgrid_path):
+                    generate_textgrid(textgrid_path, interval_count, language)
+                pose_paths = generate_pose_library(os.path.join(self.work_dir, "poses_{}_{}".format(language, control_count)),
+                                                   list(settings["phone_path_dict"]), control_count)
+                params = OrderedDict([("intervals", interval_count), ("language", language), ("controls", control_count)])
+
+                if control_count == KEYING_CONTROLS:
+                    self.record("read_textgrid", OrderedDict(list(params.items())[:2]), lambda: read_tier(textgrid_path), interval_count)
+                    intervals = read_tier(textgrid_path)
+                    self.record("keyframe_plan", OrderedDict(list(params.items())[:2]), lambda: lip_sync_core.compute_keyframe_plan(
+                        intervals, lip_sync_core.PhoneIndex(settings["phone_dict"], pose_paths)), interval_count)
+
+                def create_keyframes(blend=None, compact=True):
+                    # What LipSyncDialog.create_keyframes does once MFA has written the TextGrid
+                    self.rig(control_count)
+                    phone_index = lip_sync_core.PhoneIndex(settings["phone_dict"], pose_paths)
+                    keys = lip_sync_core.compute_keyframe_plan(lip_sync_core.read_phone_intervals(textgrid_path), phone_index)
+                    if compact:
+                        keys = lip_sync_core.compact_keyframe_plan(keys, maya_keys.get_fps(), lip_sync_core.MIN_HOLD_FRAMES)
+                    maya_keys.apply_keyframe_plan(keys, blend=blend)
+
+                self.record("create_keyframes", params, create_keyframes, interval_count)
+                self.record("create_keyframes_blend", params, lambda: create_keyframes(default_blend_settings()), interval_count)
+                # The plan as MFA timed it, to see what compacting saves on the rig
+                self.record("create_keyframes_raw", params, lambda: create_keyframes(compact=False), interval_count)
+
+    def pose_cases(self, control_counts):
+        from . import maya_keys
+        from .pose_library import pose_cache, list_pose_files
+
+        for control_count in control_counts:
+            folder = os.path.join(self.work_dir, "pose_io_{}".format(control_count))
+            pose_paths = generate_pose_library(folder, ["AI", "O", "E"], control_count)
+            params = OrderedDict([("controls", control_count)])
+
+            def save_pose():
+                self.rig(control_count)
+                self.fake_maya.selection = control_names(control_count)
+                maya_keys.save_pose(os.path.join(folder, "saved.json"), self.fake_maya.cmds.ls(sl=True))
+
+            def load_pose():
+                self.rig(control_count)
+                maya_keys.load_pose(pose_paths["AI"])
+
+            self.record("save_pose", params, save_pose)
+            self.record("load_pose", params, load_pose, setup=pose_cache.invalidate)
+            self.record("load_pose_cached", params, load_pose, setup=lambda: pose_cache.get(pose_paths["AI"]))
+
+            # Pad the folder so the listing has a realistic number of files
+            for index in range(control_count):
+                open(os.path.join(folder, "extra_{:03d}.json".format(index)), "w").close()
+            self.record("get_pose_paths", OrderedDict([("files", len(os.listdir(folder)))]), lambda: list_pose_files(folder))
+
+
+def result_key(result):
+    return result["name"] + json.dumps(result["params"], sort_keys=True, ensure_ascii=False)
+
+
+def compare_results(results, baseline, max_regression):
+    # Returns a message for every case that got slower than the baseline by more than max_regression (0.25 = 25%)
+    baseline_seconds = dict((result_key(result), result["seconds"]) for result in baseline["results"])
+    regressions = []
+    for result in results:
+        before = baseline_seconds.get(result_key(result))
+        if not before or max(before, result["seconds"]) < MIN_COMPARE_SECONDS:
+            continue
+        if result["seconds"] > before * (1 + max_regression):
+            regressions.append("{} {}: {:.3f} s, baseline {:.3f} s (+{:.0%})".format(
+                result["name"], json.dumps(result["params"], ensure_ascii=False), result["seconds"], before,
+                result["seconds"] / before - 1))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="auto_lip_sync.benchmark", description="Benchmark keying and pose handling against a stand-in Maya.")
+    parser.add_argument("-o", "--output", help="Json file to write the results to (default: print them)")
+    parser.add_argument("--quick", action="store_true", help="Only the small sizes")
+    parser.add_argument("--intervals", type=int, nargs="+", help="TextGrid sizes (default: {})".format(" ".join(map(str, INTERVAL_COUNTS))))
+    parser.add_argument("--controls", type=int, nargs="+", help="Pose library sizes (default: {})".format(" ".join(map(str, CONTROL_COUNTS))))
+    parser.add_argument("--languages", nargs="+", default=["English", "Chinese"])
+    parser.add_argument("--repeat", type=int, help="Runs per case, the best time counts (default: 3, 1 with --quick)")
+    parser.add_argument("--baseline", help="Results json of an earlier run to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="Allowed slowdown against the baseline (default: 0.25)")
+    parser.add_argument("-w", "--work-dir", help="Folder for the generated files (default: a temporary folder)")
+    args = parser.parse_args(argv)
+
+    fake_maya = FakeMaya()
+    fake_maya.install()
+
+    interval_counts = args.intervals or (QUICK_INTERVAL_COUNTS if args.quick else INTERVAL_COUNTS)
+    control_counts = args.controls or (QUICK_CONTROL_COUNTS if args.quick else CONTROL_COUNTS)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="auto_lip_sync_benchmark_")
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    run = BenchmarkRun(fake_maya, work_dir, args.repeat or (1 if args.quick else 3))
+    # The keying code prints a summary per run, keep the report readable
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        run.keying_cases(sorted(interval_counts), sorted(control_counts), args.languages)
+        run.pose_cases(sorted(control_counts))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = OrderedDict([("version", RESULTS_VERSION), ("python", platform.python_version()), ("platform", platform.platform()),
+                          ("results", run.results)])
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare_results(run.results, json.load(f), args.max_regression)
+        for message in regressions:
+            print("[REGRESSION] " + message, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+'''
+Name: blending
+
+Description: Coarticulation blending. Instead of switching hard from one viseme pose to the next at the interval
+boundaries, every interval gets a weight that fades in across its start (attack), holds while the phone is spoken and
+fades out across its end (decay). The whole schedule is shifted earlier by a lookahead, so the mouth shapes a sound
+slightly before it is heard. Intervals shorter than their fades never reach full weight, the way fast speech blends.
+
+The weights are sampled per frame into a (frames x poses) matrix and normalized, and all animated attributes are
+evaluated at once by multiplying it with the (poses x attributes) pose matrix.
+
+Needs numpy, which ships with mayapy 2022 and later.
+'''
+from array import array
+from collections import OrderedDict, namedtuple
+
+DEFAULT_ATTACK = 0.08
+DEFAULT_DECAY = 0.1
+DEFAULT_LOOKAHEAD = 0.04
+
+PoseMatrix = namedtuple("PoseMatrix", ["pose_paths", "names", "values"])
+
+
+def default_blend_settings():
+    return OrderedDict([("attack", DEFAULT_ATTACK), ("decay", DEFAULT_DECAY), ("lookahead", DEFAULT_LOOKAHEAD)])
+
+
+def build_pose_matrix(pose_paths, get_pose):
+    # (poses x attributes) matrix of every scalar attribute in the poses. A pose that doesn't store an attribute
+    # takes the value of the first pose that does, the same value the old hard keys would have held it at.
+    import numpy as np
+
+    poses = [get_pose(path) for path in pose_paths]
+    columns = OrderedDict()
+    for pose in poses:
+        for name, value in zip(pose.names, pose.values):
+            if name not in columns and not isinstance(value, (list, tuple)):
+                columns[name] = len(columns)
+
+    values = np.full((len(poses), len(columns)), np.nan)
+    for row, pose in enumerate(poses):
+        for name, value in zip(pose.names, pose.values):
+            column = columns.get(name)
+            if column is not None and not isinstance(value, (list, tuple)):
+                values[row, column] = value
+    if len(poses):
+        missing = np.isnan(values)
+        first_defined = np.argmax(~missing, axis=0)
+        fill = values[first_defined, np.arange(len(columns))]
+        values = np.where(missing, fill, values)
+    return PoseMatrix(list(pose_paths), list(columns), values)
+
+
+def smoothstep(x, np):
+    x = np.clip(x, 0.0, 1.0)
+    return x * x * (3.0 - 2.0 * x)
+
+
+def compute_weight_matrix(starts, ends, pose_ids, pose_count, fps, attack=DEFAULT_ATTACK, decay=DEFAULT_DECAY,
+                          lookahead=DEFAULT_LOOKAHEAD):
+    # (frames x poses) weights, rows sum to 1. Frame k is at k / fps. Every interval only touches the frames between
+    # the start of its fade in and the end of its fade out, those (interval, frame) pairs are built flat and summed into
+    # the matrix with one bincount, so the cost follows the number of keys rather than frames x intervals.
+    import numpy as np
+
+    starts = np.asarray(starts, dtype=np.float64) - lookahead
+    ends = np.asarray(ends, dtype=np.float64) - lookahead
+    pose_ids = np.asarray(pose_ids, dtype=np.int64)
+    frame_count = int(np.ceil(max(ends.max(), 0.0) * fps)) + 1 if len(ends) else 0
+    weights = np.zeros((frame_count, pose_count))
+    if not frame_count or not len(starts):
+        return weights
+
+    first = np.clip(np.ceil((starts - attack / 2.0) * fps), 0, frame_count - 1).astype(np.int64)
+    last = np.clip(np.floor((ends + decay / 2.0) * fps), 0, frame_count - 1).astype(np.int64)
+    spans = np.maximum(last - first + 1, 0)
+    interval = np.repeat(np.arange(len(starts)), spans)
+    # Frame numbers of every pair: first frame of the interval plus the offset inside the span
+    offsets = np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)
+    frames = first[interval] + offsets
+    times = frames / float(fps)
+
+    # The fades are centred on the boundaries, so neighbours cross at half weight where one phone ends and the next starts
+    start = starts[interval]
+    end = ends[interval]
+    rise = smoothstep((times - start) / attack + 0.5, np) if attack > 0 else (times >= start).astype(np.float64)
+    fall = smoothstep((end - times) / decay + 0.5, np) if decay > 0 else (times <= end).astype(np.float64)
+    pair_weights = np.minimum(rise, fall)
+
+    flat = np.bincount(frames * pose_count + pose_ids[interval], weights=pair_weights, minlength=frame_count * pose_count)
+    weights = flat.reshape(frame_count, pose_count)
+
+    # Frames no interval reaches hold the last blended pose, before the first one they take the first
+    total = weights.sum(axis=1)
+    covered = total > 0
+    if not covered.any():
+        return weights
+    source = np.where(covered, np.arange(frame_count), 0)
+    source = np.maximum.accumulate(source)
+    source[:np.argmax(covered)] = np.argmax(covered)
+    return weights[source] / total[source][:, None]
+
+
+def compute_blended_curves(keys, get_pose, fps, attack=DEFAULT_ATTACK, decay=DEFAULT_DECAY, lookahead=DEFAULT_LOOKAHEAD):
+    # Same result shape as lip_sync_core.compute_attribute_curves: "control.attr" -> (times, values), one key per frame
+    import numpy as np
+
+    keys = [key for key in keys if key["pose"]]
+    if not keys:
+        return OrderedDict()
+    pose_ids = OrderedDict()
+    for key in keys:
+        pose_ids.setdefault(key["pose"], len(pose_ids))
+    pose_matrix = build_pose_matrix(list(pose_ids), get_pose)
+
+    weights = compute_weight_matrix([key["start"] for key in keys], [key["end"] for key in keys],
+                                    [pose_ids[key["pose"]] for key in keys], len(pose_ids), fps, attack, decay, lookahead)
+    # (frames x poses) @ (poses x attributes)
+    values = weights @ pose_matrix.values
+    times = array('d', (np.arange(len(weights)) / float(fps)).tolist())
+
+    curves = OrderedDict()
+    for column, name in enumerate(pose_matrix.names):
+        curves[name] = (times, array('d', values[:, column].tolist()))
+    return curves
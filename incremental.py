@@ -0,0 +1,166 @@
+'''
+Name: incremental
+
+Description: Re-aligning only what changed. After every alignment the cache remembers which alignment the clip's audio
+got last (see align_cache.run_key). When the same audio comes back with an edited transcript, the new words are diffed
+against the words tier of that alignment, and only the spans around the edits (plus one unchanged word either side)
+are cut out of the audio and aligned again. Their TextGrids are spliced into the previous timeline, and the spans are
+handed on as re-key windows, so only the keys inside them are replaced on the rig.
+
+Chinese words are compared character by character, so a different word segmentation by MFA doesn't count as an edit.
+When more than half of the words changed, the whole clip is aligned again as usual.
+'''
+import os
+import difflib
+
+from .align_cache import run_key, normalize_transcript
+from .lexicon import load_index, tokenize, CJK_RUN, LexiconError
+from .long_audio import Segment, offset_tier, fill_gap
+from .textgrid_reader import IntervalTier, read_tier, write_textgrid, TextGridError
+from .tracing import tracer
+
+CONTEXT_UNITS = 1
+MAX_CHANGED = 0.5
+SILENCE_LABELS = frozenset(["", "sil", "sp", "spn", "<eps>", "<unk>"])
+
+
+def remember_run(cache, sound_path, transcript, settings, alignment):
+    # alignment is the cache key of the clip's TextGrid (see align_cache.alignment_key)
+    if cache is None:
+        return
+    try:
+        cache.put_run(run_key(sound_path, settings), {"transcript": normalize_transcript(transcript), "alignment": alignment})
+    except OSError as e:
+        print(f"[WARNING] Could not remember the run: {e}")
+
+
+def previous_textgrid(cache, sound_path, settings):
+    # The TextGrid this audio was aligned to last, or None
+    record = cache.get_run(run_key(sound_path, settings)) if cache is not None else None
+    if not record:
+        return None
+    return cache.get(record["alignment"])
+
+
+def split_units(word):
+    # Chinese words become their characters, anything else stays one unit
+    return list(word) if CJK_RUN.fullmatch(word) else [word]
+
+
+def transcript_units(text, index):
+    return [unit for token in tokenize(text, index) for unit in split_units(token)]
+
+
+def tier_units(words):
+    # (unit, start, end) of every spoken word of a words tier, a Chinese word's time shared out over its characters
+    units = []
+    for start, end, label in words:
+        label = label.strip().casefold()
+        if label in SILENCE_LABELS:
+            continue
+        parts = split_units(label)
+        step = (end - start) / len(parts)
+        units.extend((part, start + step * index, start + step * (index + 1)) for index, part in enumerate(parts))
+    return units
+
+
+def join_units(units):
+    text = ""
+    for unit in units:
+        # Characters of a Chinese run are written together so MFA segments them itself
+        if text and not (CJK_RUN.fullmatch(unit) and CJK_RUN.fullmatch(text[-1])):
+            text += " "
+        text += unit
+    return text
+
+
+def plan_edits(words, new_units, duration, name, context=CONTEXT_UNITS, max_changed=MAX_CHANGED):
+    # Segments to align again for the new transcript units, [] if nothing changed and None if too much did. Each edit
+    # takes context unchanged units along either side, and is cut halfway between its outer words and their neighbours.
+    old = tier_units(words)
+    if not old:
+        return None
+    labels = [unit for unit, start, end in old]
+    matcher = difflib.SequenceMatcher(None, labels, new_units, autojunk=False)
+    changes = [opcode[1:] for opcode in matcher.get_opcodes() if opcode[0] != "equal"]
+    if sum(max(i2 - i1, j2 - j1) for i1, i2, j1, j2 in changes) > max_changed * len(labels):
+        return None
+
+    spans = []
+    for i1, i2, j1, j2 in changes:
+        a = max(i1 - context, 0)
+        b = min(i2 + context, len(labels))
+        j1, j2 = j1 - (i1 - a), j2 + (b - i2)
+        if spans and a <= spans[-1][1]:
+            # Overlaps the previous edit once the context is added, align them together
+            previous = spans.pop()
+            a, j1 = previous[0], previous[2]
+        spans.append((a, b, j1, j2))
+
+    segments = []
+    for index, (a, b, j1, j2) in enumerate(spans):
+        start = 0.0 if a == 0 else (old[a - 1][2] + old[a][1]) / 2.0
+        end = duration if b == len(old) else (old[b - 1][2] + old[b][1]) / 2.0
+        segments.append(Segment("{}_edit{:03d}".format(name, index), start, end, join_units(new_units[j1:j2])))
+    return segments
+
+
+def plan_realignment(cache, sound_path, transcript, settings, name=None):
+    # (previous TextGrid, Segments) for an edited transcript of an aligned clip, None if the clip has to be aligned whole
+    textgrid_path = previous_textgrid(cache, sound_path, settings)
+    if not textgrid_path:
+        return None
+    name = name or os.path.splitext(os.path.basename(sound_path))[0]
+    with tracer.span("diff transcript"):
+        try:
+            words = read_tier(textgrid_path, "words")
+            phones = read_tier(textgrid_path, "phones")
+            new_units = transcript_units(transcript, load_index(settings["lexicon"]))
+        except (OSError, TextGridError, LexiconError):
+            return None
+        duration = max(words.ends[-1] if len(words) else 0.0, phones.ends[-1] if len(phones) else 0.0)
+        segments = plan_edits(words, new_units, duration, name)
+    if segments is None:
+        print("[DEBUG] Too much of the transcript changed, aligning the whole clip")
+        return None
+    print("Re-aligning {} edited spans: {}".format(len(segments), ", ".join("{:.1f}-{:.1f}s".format(s.start, s.end) for s in segments)))
+    return textgrid_path, segments
+
+
+def splice_edits(previous_path, segments, textgrid_files, target_path):
+    # Writes the previous alignment with the spans of the aligned segments replaced by their new words and phones.
+    # Returns the (start, end) windows that changed, a segment MFA failed on keeps its previous alignment.
+    windows = []
+    tiers = []
+    with tracer.span("splice", segments=len(segments)):
+        aligned = {}
+        for segment in segments:
+            if not segment.text:
+                # Every word of the span was deleted, it rests now
+                aligned[segment.name] = (IntervalTier("words"), IntervalTier("phones"))
+                windows.append((segment.start, segment.end))
+                continue
+            try:
+                aligned[segment.name] = (read_tier(textgrid_files[segment.name], "words"), read_tier(textgrid_files[segment.name], "phones"))
+                windows.append((segment.start, segment.end))
+            except (KeyError, OSError, TextGridError) as e:
+                print("[ERROR] Edited span {:.1f}-{:.1f}s was not aligned, keeping its previous alignment: {}".format(segment.start, segment.end, e))
+
+        for tier_index, tier_name in enumerate(("words", "phones")):
+            previous = read_tier(previous_path, tier_name)
+            duration = previous.ends[-1] if len(previous) else 0.0
+            tier = IntervalTier(tier_name)
+            last = 0.0
+            for segment in segments:
+                offset_tier(previous, tier, 0.0, last, segment.start)
+                if segment.name in aligned:
+                    fill_gap(tier, segment.start)
+                    offset_tier(aligned[segment.name][tier_index], tier, segment.start, segment.start, segment.end)
+                    fill_gap(tier, segment.end)
+                else:
+                    offset_tier(previous, tier, 0.0, segment.start, segment.end)
+                last = segment.end
+            offset_tier(previous, tier, 0.0, last, duration)
+            tiers.append(tier)
+        write_textgrid(target_path, tiers)
+    return windows
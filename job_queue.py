@@ -0,0 +1,376 @@
+'''
+Name: job_queue
+
+Description: Folder backed job queue for running lip sync jobs on background workers. A job is a json record that
+moves between the pending, running, done and failed subfolders of the queue folder. Claiming a job is a rename from
+pending to running, which only one worker can win, and every write goes through a temp file and an atomic replace, so
+any number of workers on one machine or on a shared folder can take jobs from the same queue.
+
+A worker runs up to N jobs at once, each as its own command line run (see lip_sync_core.main) in its own staging
+folder, so jobs never delete each other's MFA input or output. N follows the core and memory budget of the worker.
+A job that runs past its timeout is stopped together with its MFA run, and a failed job is queued again until it has
+used its attempts. A job whose worker stopped sending heartbeats (the running record's modification time) goes back to
+pending as well.
+
+Usage (from the folder that contains the auto_lip_sync folder):
+
+python -m auto_lip_sync.job_queue submit vo/line_001.wav vo/line_001.txt -o plans/line_001.plan.json -- --blend
+python -m auto_lip_sync.job_queue worker --cores 16 --job-cores 2 --memory 32 --job-memory 3
+python -m auto_lip_sync.job_queue status
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import socket
+import argparse
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+
+from .mfa_runner import STOP_GRACE, new_session_kwargs, stop_process_tree
+
+STATES = ("pending", "running", "done", "failed")
+DEFAULT_ATTEMPTS = 3
+DEFAULT_TIMEOUT = 30 * 60
+STALE_AFTER = 120
+POLL_INTERVAL = 2.0
+LOG_TAIL = 2000
+
+
+def get_default_queue_dir():
+    from .lip_sync_core import USER_SCRIPT_DIR
+    return os.environ.get("AUTO_LIP_SYNC_QUEUE") or os.path.join(USER_SCRIPT_DIR, "job_queue")
+
+
+def new_job_id():
+    # Sorts in submission order
+    return "{:013d}_{}".format(int(time.time() * 1000), uuid.uuid4().hex[:8])
+
+
+def write_record(path, record):
+    temp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex[:8])
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(record, f, indent=2, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def read_record(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class JobQueue(object):
+
+    def __init__(self, folder=None):
+        self.folder = folder or get_default_queue_dir()
+        for state in STATES:
+            path = os.path.join(self.folder, state)
+            if not os.path.exists(path):
+                os.makedirs(path, exist_ok=True)
+
+    def path(self, state, job_id):
+        return os.path.join(self.folder, state, job_id + ".json")
+
+    def job_ids(self, state):
+        try:
+            return sorted(file[:-5] for file in os.listdir(os.path.join(self.folder, state)) if file.endswith(".json"))
+        except OSError:
+            return []
+
+    def submit(self, sound, text, output, args=(), pose_map=None, attempts=DEFAULT_ATTEMPTS, timeout=DEFAULT_TIMEOUT):
+        # args are extra lip_sync_core command line arguments, pose_map a viseme -> pose path mapping
+        job_id = new_job_id()
+        record = OrderedDict([("id", job_id), ("sound", os.path.abspath(sound)), ("text", os.path.abspath(text)),
+                              ("output", os.path.abspath(output)), ("args", list(args)), ("pose_map", pose_map),
+                              ("attempts", 0), ("max_attempts", attempts), ("timeout", timeout),
+                              ("submitted", time.time()), ("worker", None), ("error", None)])
+        write_record(self.path("pending", job_id), record)
+        return job_id
+
+    def claim(self, worker_id):
+        # The oldest pending job, now running under worker_id, or None
+        for job_id in self.job_ids("pending"):
+            running_path = self.path("running", job_id)
+            try:
+                os.rename(self.path("pending", job_id), running_path)
+            except OSError:
+                # Another worker was first
+                continue
+            try:
+                # The rename keeps the submission time, a job that waited long would look stale to other workers
+                os.utime(running_path)
+                record = read_record(running_path)
+                record["attempts"] += 1
+                record["worker"] = worker_id
+                record["claimed"] = time.time()
+                write_record(running_path, record)
+            except (OSError, ValueError):
+                # Reaped by another worker before the first heartbeat, it is pending again
+                continue
+            return record
+        return None
+
+    def heartbeat(self, job_id):
+        try:
+            os.utime(self.path("running", job_id))
+        except OSError:
+            pass
+
+    def finish(self, record, state, running_path=None):
+        # Writes the record to the running file first, so a crash between the two steps leaves it there to be reaped
+        running_path = running_path or self.path("running", record["id"])
+        write_record(running_path, record)
+        os.replace(running_path, self.path(state, record["id"]))
+
+    def complete(self, record):
+        record["finished"] = time.time()
+        record["error"] = None
+        self.finish(record, "done")
+
+    def fail(self, record, error, running_path=None):
+        # Queued again while it has attempts left, returns the state it went to
+        record["error"] = error
+        state = "pending" if record["attempts"] < record["max_attempts"] else "failed"
+        if state == "failed":
+            record["finished"] = time.time()
+        self.finish(record, state, running_path)
+        return state
+
+    def requeue_stale(self, stale_after=STALE_AFTER):
+        # Running jobs whose worker stopped sending heartbeats, counted as failed attempts
+        requeued = []
+        now = time.time()
+        for job_id in self.job_ids("running"):
+            path = self.path("running", job_id)
+            reap_path = path + ".reap"
+            try:
+                if now - os.path.getmtime(path) < stale_after:
+                    continue
+                # The rename picks one worker to requeue it
+                os.rename(path, reap_path)
+                record = read_record(reap_path)
+            except (OSError, ValueError):
+                continue
+            self.fail(record, "Worker {} stopped responding".format(record.get("worker")), reap_path)
+            requeued.append(job_id)
+        return requeued
+
+    def retry_failed(self):
+        count = 0
+        for job_id in self.job_ids("failed"):
+            record = read_record(self.path("failed", job_id))
+            record["attempts"] = 0
+            record["error"] = None
+            write_record(self.path("failed", job_id), record)
+            os.replace(self.path("failed", job_id), self.path("pending", job_id))
+            count += 1
+        return count
+
+    def status(self):
+        return OrderedDict((state, len(self.job_ids(state))) for state in STATES)
+
+    def records(self, state):
+        records = []
+        for job_id in self.job_ids(state):
+            try:
+                records.append(read_record(self.path(state, job_id)))
+            except (OSError, ValueError):
+                pass
+        return records
+
+
+def worker_slots(jobs=None, cores=None, job_cores=1, memory=None, job_memory=None):
+    # How many jobs fit at once in the core and memory (GB) budget
+    cores = cores or multiprocessing.cpu_count()
+    slots = max(cores // max(job_cores, 1), 1)
+    if jobs:
+        slots = min(slots, jobs)
+    if memory and job_memory:
+        slots = min(slots, max(int(memory // job_memory), 1))
+    return slots
+
+
+def package_root():
+    # The folder that contains the package, the job commands run from there
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def job_command(record, staging, job_cores, python=None):
+    command = [python or sys.executable, "-m", __package__ or "auto_lip_sync", record["sound"], record["text"],
+               "-o", record["output"], "-w", staging, "-j", str(job_cores)]
+    if record.get("pose_map"):
+        pose_map_path = os.path.join(staging, "pose_map.json")
+        with open(pose_map_path, "w", encoding="utf-8") as f:
+            json.dump(record["pose_map"], f, ensure_ascii=False)
+        command += ["--pose-map", pose_map_path]
+    return command + list(record.get("args", []))
+
+
+def log_tail(log_path):
+    try:
+        with open(log_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - LOG_TAIL, 0))
+            return f.read().decode("utf-8", errors="replace")
+    except OSError:
+        return ""
+
+
+class Worker(object):
+    # Runs queued jobs as child processes, slots at a time
+
+    def __init__(self, queue, slots, job_cores=1, work_root=None, stale_after=STALE_AFTER, poll_interval=POLL_INTERVAL):
+        self.queue = queue
+        self.slots = slots
+        self.job_cores = job_cores
+        self.work_root = work_root or os.path.join(queue.folder, "staging")
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.running = OrderedDict()
+        self.finished = 0
+        self.failed = 0
+
+    def start_job(self, record):
+        staging = os.path.join(self.work_root, record["id"])
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        log_path = os.path.join(staging, "job.log")
+        log_file = open(log_path, "wb")
+        try:
+            process = subprocess.Popen(job_command(record, staging, self.job_cores), cwd=package_root(),
+                                       stdout=log_file, stderr=subprocess.STDOUT, **new_session_kwargs())
+        except OSError as e:
+            log_file.close()
+            self.end_job(record, staging, "Could not start the job: {}".format(e))
+            return
+        print("[{}] Started {} ({})".format(time.strftime("%H:%M:%S"), os.path.basename(record["sound"]), record["id"]))
+        self.running[record["id"]] = (record, process, log_file, staging, time.time())
+
+    def end_job(self, record, staging, error=None):
+        if error is None:
+            self.queue.complete(record)
+            shutil.rmtree(staging, ignore_errors=True)
+            self.finished += 1
+            print("[{}] Finished {}".format(time.strftime("%H:%M:%S"), os.path.basename(record["sound"])))
+            return
+        state = self.queue.fail(record, error)
+        if state == "failed":
+            # Kept for a look at the log
+            self.failed += 1
+        print("[ERROR] {} ({}), {}: {}".format(os.path.basename(record["sound"]), record["id"],
+                                                "queued again" if state == "pending" else "giving up", error.splitlines()[0]))
+
+    def stop_job(self, process):
+        # The job cancels its MFA run on SIGTERM, MFA has a session of its own that killing the job would miss.
+        # Whatever is left of the job's process group after the grace period is killed.
+        stop_process_tree(process)
+        try:
+            return process.wait(STOP_GRACE)
+        except subprocess.TimeoutExpired:
+            stop_process_tree(process, force=True)
+            return process.wait()
+
+    def poll_jobs(self):
+        now = time.time()
+        for job_id, (record, process, log_file, staging, started) in list(self.running.items()):
+            return_code = process.poll()
+            if return_code is None and now - started > record["timeout"]:
+                return_code = self.stop_job(process)
+                error = "Timed out after {:.1f}s".format(now - started)
+            elif return_code is None:
+                self.queue.heartbeat(job_id)
+                continue
+            else:
+                error = None if return_code == 0 else "Exit code {}\n{}".format(return_code, log_tail(log_file.name))
+            log_file.close()
+            del self.running[job_id]
+            self.end_job(record, staging, error)
+
+    def fill_slots(self):
+        while len(self.running) < self.slots:
+            record = self.queue.claim(self.worker_id)
+            if record is None:
+                return False
+            self.start_job(record)
+        return True
+
+    def run(self, drain=False):
+        # Works until interrupted, or with drain until the queue is empty. Returns the number of failed jobs.
+        print("Worker {} running {} jobs at once from {}".format(self.worker_id, self.slots, self.queue.folder))
+        try:
+            while True:
+                self.queue.requeue_stale(self.stale_after)
+                self.poll_jobs()
+                has_more = self.fill_slots()
+                if drain and not self.running and not has_more:
+                    break
+                time.sleep(self.poll_interval)
+        finally:
+            for record, process, log_file, staging, started in self.running.values():
+                self.stop_job(process)
+                log_file.close()
+                self.queue.fail(record, "Worker {} was stopped".format(self.worker_id))
+            self.running.clear()
+        print("Worker {} finished {} jobs, {} failed".format(self.worker_id, self.finished, self.failed))
+        return self.failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="auto_lip_sync.job_queue", description="Queue lip sync jobs and run them on background workers.")
+    parser.add_argument("--queue", help="Queue folder (default: $AUTO_LIP_SYNC_QUEUE or job_queue in the script dir)")
+    commands = parser.add_subparsers(dest="command")
+
+    submit = commands.add_parser("submit", help="Queue a clip, arguments after -- go to the lip sync command line")
+    submit.add_argument("sound")
+    submit.add_argument("text")
+    submit.add_argument("-o", "--output", help="Plan file to write (default: next to the sound)")
+    submit.add_argument("--attempts", type=int, default=DEFAULT_ATTEMPTS, help="Runs before the job counts as failed (default: 3)")
+    submit.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="Seconds before a run is killed (default: 1800)")
+
+    worker = commands.add_parser("worker", help="Run queued jobs")
+    worker.add_argument("--jobs", type=int, help="Most jobs at once (default: as many as the budget allows)")
+    worker.add_argument("--cores", type=int, help="Cores the worker may use (default: all)")
+    worker.add_argument("--job-cores", type=int, default=1, help="Cores, and MFA jobs, per job (default: 1)")
+    worker.add_argument("--memory", type=float, help="GB of memory the worker may use")
+    worker.add_argument("--job-memory", type=float, default=2.0, help="GB of memory a job needs (default: 2)")
+    worker.add_argument("--work-dir", help="Folder for the per job staging folders (default: staging in the queue folder)")
+    worker.add_argument("--drain", action="store_true", help="Stop when the queue is empty")
+
+    commands.add_parser("status", help="Count the jobs in every state and list the failed ones")
+    commands.add_parser("retry", help="Queue the failed jobs again")
+    argv = sys.argv[1:] if argv is None else list(argv)
+    extra = []
+    if "--" in argv:
+        extra = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_help()
+        return 1
+
+    queue = JobQueue(args.queue)
+    if args.command == "submit":
+        output = args.output or os.path.splitext(args.sound)[0] + ".plan.json"
+        print("Queued {}".format(queue.submit(args.sound, args.text, output, extra, attempts=args.attempts, timeout=args.timeout)))
+    elif args.command == "worker":
+        slots = worker_slots(args.jobs, args.cores, args.job_cores, args.memory, args.job_memory)
+        try:
+            failed = Worker(queue, slots, args.job_cores, args.work_dir).run(args.drain)
+        except KeyboardInterrupt:
+            return 1
+        return 1 if failed else 0
+    elif args.command == "status":
+        print(", ".join("{} {}".format(state, count) for state, count in queue.status().items()))
+        for record in queue.records("failed"):
+            print("[ERROR] {} ({}): {}".format(record["sound"], record["id"], (record.get("error") or "unknown error").splitlines()[0]))
+    else:
+        print("Queued {} failed jobs again".format(queue.retry_failed()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
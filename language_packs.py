@@ -0,0 +1,174 @@
+'''
+Name: language_packs
+
+Description: Language pack registry. Every language is one json file in the language_packs folder next to this module,
+named after the language (Chinese.json), with its MFA backend, lexicon, model and G2P locations, its viseme set and
+its phone to viseme map. Extra folders can be listed in $AUTO_LIP_SYNC_LANGUAGE_PACKS (separated like PATH), a pack
+there replaces a shipped pack of the same name.
+
+The registry only lists the folders to know which languages there are. A pack is read and compiled the first time its
+settings are asked for: "{scripts}" in a path becomes the scripts folder and "{plugin}" the folder of this package,
+settings named in "overrides" are taken from their environment variable when it is set, the phone map is checked
+against the viseme set and the viseme set becomes the ordered viseme -> pose table. The compiled settings are kept for
+the session, so adding languages doesn't slow down startup and switching between them is a dict lookup. Tools that run
+MFA call check(language) first, which reports an mfa_path or overridable path that doesn't exist together with the
+variable to set. Reading a pack's phone map works without MFA installed.
+
+MFA 3.x runs with the pack's "mfa_bin_dirs" (folders relative to mfa_path, Library/bin if the pack has none) in front
+of PATH, the ones that exist. A conda environment keeps openfst and the other binaries in Library/bin, a venv keeps
+them next to python.exe in Scripts.
+
+Pack file:
+
+{"format": "auto_lip_sync_language_pack", "version": 1, "mfa_version": "v3.2.3", "mfa_path": "...",
+ "mfa_align_cmd": "...", "mfa_train_cmd": "...", "lexicon": "{scripts}...", "model": "{scripts}...", "g2p_model": "",
+ "mfa_bin_dirs": [".", "Library/bin"], "overrides": {"mfa_path": "ENV_VAR"}, "visemes": ["AI", ...],
+ "phone_dict": {"AA": "AI", ...}}
+'''
+import os
+import json
+from collections import OrderedDict
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+PACK_FORMAT = "auto_lip_sync_language_pack"
+PACK_VERSION = 1
+PACK_EXTENSION = ".json"
+PATH_KEYS = ("mfa_path", "lexicon", "model", "g2p_model")
+REQUIRED_KEYS = ("mfa_version", "mfa_path", "mfa_align_cmd", "mfa_train_cmd", "lexicon", "model", "visemes", "phone_dict")
+DEFAULT_MFA_BIN_DIRS = ("Library/bin",)
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "")
+PACK_FOLDER = os.path.join(PLUGIN_DIR, "language_packs")
+
+
+class LanguagePackError(ValueError):
+    pass
+
+
+def pack_folders():
+    # The shipped packs first, so packs in $AUTO_LIP_SYNC_LANGUAGE_PACKS replace them
+    folders = [PACK_FOLDER]
+    folders.extend(folder for folder in os.environ.get("AUTO_LIP_SYNC_LANGUAGE_PACKS", "").split(os.pathsep) if folder)
+    return folders
+
+
+def discover_packs(folders):
+    # Language name -> pack file, from the file names alone
+    packs = OrderedDict()
+    for folder in folders:
+        try:
+            names = sorted(os.listdir(folder))
+        except OSError:
+            continue
+        for file_name in names:
+            name, extension = os.path.splitext(file_name)
+            if extension.lower() == PACK_EXTENSION and not name.startswith("."):
+                packs[name] = os.path.join(folder, file_name)
+    return packs
+
+
+def compile_pack(pack_path, script_dir):
+    # Returns the settings and the messages for overridable paths that don't exist
+    try:
+        with open(pack_path, 'r', encoding='utf-8') as f:
+            pack = json.load(f)
+    except (OSError, ValueError) as e:
+        raise LanguagePackError("Can't read the language pack {}: {}".format(pack_path, e))
+    if not isinstance(pack, dict) or pack.get("format") != PACK_FORMAT:
+        raise LanguagePackError("{} is not a language pack".format(pack_path))
+    if pack.get("version", 0) > PACK_VERSION:
+        raise LanguagePackError("{} needs a newer version of auto_lip_sync".format(pack_path))
+    missing = [key for key in REQUIRED_KEYS if key not in pack]
+    if missing:
+        raise LanguagePackError("{} has no {}".format(pack_path, ", ".join(missing)))
+
+    settings = {}
+    for key, value in pack.items():
+        if key in ("format", "version", "notes", "overrides", "visemes"):
+            continue
+        if key in PATH_KEYS and value:
+            value = value.replace("{scripts}", script_dir).replace("{plugin}", PLUGIN_DIR)
+        settings[key] = value
+    settings.setdefault("g2p_model", "")
+    language = os.path.splitext(os.path.basename(pack_path))[0]
+    overrides = pack.get("overrides", {})
+    for key, env_name in overrides.items():
+        if os.environ.get(env_name):
+            settings[key] = os.environ[env_name]
+    missing = []
+    for key in PATH_KEYS:
+        # MFA can't run without mfa_path, the other paths only count when they can be overridden
+        if (key == "mfa_path" or key in overrides) and not os.path.exists(settings[key]):
+            message = "{} of the {} language pack is {}, which doesn't exist.".format(
+                key, language, settings[key] or "not set")
+            if key in overrides:
+                message += " Set ${} to where it is.".format(overrides[key])
+            missing.append(message)
+
+    visemes = pack["visemes"]
+    unknown = sorted(set(settings["phone_dict"].values()) - set(visemes))
+    if unknown:
+        raise LanguagePackError("The phone map of {} uses visemes it doesn't list: {}".format(pack_path, ", ".join(unknown)))
+    settings["phone_path_dict"] = OrderedDict((viseme, "") for viseme in visemes)
+    return settings, missing
+
+
+def mfa_environment(settings):
+    # The environment to run MFA 3.x and its G2P in
+    env = os.environ.copy()
+    folders = [os.path.normpath(os.path.join(settings["mfa_path"], folder)) for folder in
+               settings.get("mfa_bin_dirs", DEFAULT_MFA_BIN_DIRS)]
+    env["PATH"] = os.pathsep.join([folder for folder in folders if os.path.isdir(folder)] + [env.get("PATH", "")])
+    return env
+
+
+class LanguagePacks(Mapping):
+    # Language name -> settings dict, read only as far as it is used. The settings of a language are compiled once and
+    # then the same dict is returned, changes made to it (the dialog fills in phone_path_dict) last for the session.
+
+    def __init__(self, script_dir, folders=None):
+        self.script_dir = script_dir
+        self.folders = folders
+        self._packs = None
+        self._compiled = {}
+        self._missing = {}
+
+    @property
+    def packs(self):
+        if self._packs is None:
+            self._packs = discover_packs(self.folders if self.folders is not None else pack_folders())
+        return self._packs
+
+    def __getitem__(self, language):
+        settings = self._compiled.get(language)
+        if settings is None:
+            settings, self._missing[language] = compile_pack(self.packs[language], self.script_dir)
+            self._compiled[language] = settings
+        return settings
+
+    def check(self, language):
+        # Raises LanguagePackError if the language can't run MFA as set up on this machine
+        self[language]
+        if self._missing[language]:
+            raise LanguagePackError(" ".join(self._missing[language]))
+
+    def __contains__(self, language):
+        return language in self.packs
+
+    def __iter__(self):
+        return iter(self.packs)
+
+    def __len__(self):
+        return len(self.packs)
+
+    def pack_path(self, language):
+        return self.packs[language]
+
+    def reload(self):
+        # Lists the folders again and drops the compiled settings, for packs added or edited while Maya runs
+        self._packs = None
+        self._compiled.clear()
+        self._missing.clear()
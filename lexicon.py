@@ -0,0 +1,366 @@
+'''
+Name: lexicon
+
+Description: Pre-flight check of a transcript against the MFA lexicon. Words the lexicon doesn't have are only
+aligned as noise (spn) and a transcript full of them can leave MFA without a usable TextGrid, which used to show after
+MFA had run for minutes. check_transcript tokenizes the transcript the way MFA will see it and reports the missing
+words in milliseconds.
+
+The lexicon is read once into an index of its words and the byte offset of every pronunciation line, which is saved
+next to the scripts (lexicon_index folder) and only rebuilt when the lexicon file changes. Chinese text without spaces
+is split into words by longest match against the lexicon.
+
+The index also gives the byte offset of every word's lines, so write_pruned_lexicon can cut the lexicon down to the
+words of the clips being aligned with a few seeks. MFA then compiles a dictionary of a few dozen words instead of the
+whole LibriSpeech or Mandarin lexicon on every run.
+
+Languages with a "g2p_model" in their settings (MFA 3.x) can fill in missing words with MFA's G2P. The generated
+pronunciations are kept in a json file per G2P model, so every word is only generated once.
+'''
+import os
+import re
+import sys
+import json
+import struct
+import bisect
+import hashlib
+import subprocess
+import unicodedata
+from array import array
+from collections import OrderedDict, namedtuple
+
+from .language_packs import mfa_environment
+
+INDEX_FORMAT = b"ALSLEXI1"
+INDEX_VERSION = 1
+CJK_RUN = re.compile("([\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\U00020000-\U0002a6df]+)")
+WORD = re.compile(r"[^\W_]+(?:['’][^\W_]+)*")
+
+Preflight = namedtuple("Preflight", ["tokens", "oov", "extra", "words"])
+
+
+class LexiconError(ValueError):
+    pass
+
+
+def normalize_word(word):
+    # MFA matches words case insensitively
+    return unicodedata.normalize("NFC", word).casefold()
+
+
+def get_index_folder():
+    from .lip_sync_core import USER_SCRIPT_DIR
+    return os.environ.get("AUTO_LIP_SYNC_LEXICON_INDEX") or os.path.join(USER_SCRIPT_DIR, "lexicon_index")
+
+
+def lexicon_stamp(lexicon_path):
+    stat = os.stat(lexicon_path)
+    return OrderedDict([("lexicon", os.path.abspath(lexicon_path)), ("size", stat.st_size), ("mtime", stat.st_mtime_ns)])
+
+
+class LexiconIndex(object):
+    # Sorted unique words, and for word i the offsets[starts[i]:starts[i + 1]] of its lines in the lexicon file
+
+    def __init__(self, lexicon_path, words, starts, offsets):
+        self.lexicon_path = lexicon_path
+        self.words = words
+        self.starts = starts
+        self.offsets = offsets
+        self.max_length = max(len(word) for word in words) if words else 0
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return self.find(word) >= 0
+
+    def find(self, word):
+        position = bisect.bisect_left(self.words, word)
+        if position < len(self.words) and self.words[position] == word:
+            return position
+        return -1
+
+    def line_offsets(self, word):
+        position = self.find(word)
+        if position < 0:
+            return []
+        return self.offsets[self.starts[position]:self.starts[position + 1]]
+
+    def pronunciation_lines(self, word, lexicon_file=None):
+        # The lexicon lines of word, read with one seek per line
+        if lexicon_file is None:
+            with open(self.lexicon_path, "rb") as f:
+                return self.pronunciation_lines(word, f)
+        lines = []
+        for offset in self.line_offsets(word):
+            lexicon_file.seek(offset)
+            lines.append(lexicon_file.readline().decode("utf-8", errors="replace").rstrip("\r\n"))
+        return lines
+
+
+def build_index(lexicon_path):
+    word_offsets = {}
+    offset = 0
+    with open(lexicon_path, "rb") as f:
+        for line in f:
+            text = line.decode("utf-8", errors="replace").strip()
+            # Skip blank lines and CMU style comments
+            if text and not text.startswith(";;;"):
+                word_offsets.setdefault(normalize_word(text.split(None, 1)[0]), []).append(offset)
+            offset += len(line)
+
+    words = sorted(word_offsets)
+    starts = array('q', [0])
+    offsets = array('q')
+    for word in words:
+        offsets.extend(word_offsets[word])
+        starts.append(len(offsets))
+    return LexiconIndex(lexicon_path, words, starts, offsets)
+
+
+def index_path(lexicon_path, folder=None):
+    name = hashlib.sha1(os.path.abspath(lexicon_path).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(folder or get_index_folder(), name + ".idx")
+
+
+def write_index(path, index, stamp):
+    # Format tag, then the stamp json, the words, the starts and the offsets, each after its byte length
+    header = dict(stamp, version=INDEX_VERSION, byteorder=sys.byteorder)
+    sections = [json.dumps(header).encode("utf-8"), "\n".join(index.words).encode("utf-8"),
+                index.starts.tobytes(), index.offsets.tobytes()]
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, "wb") as f:
+        f.write(INDEX_FORMAT)
+        for section in sections:
+            f.write(struct.pack("<Q", len(section)))
+            f.write(section)
+    os.replace(temp_path, path)
+
+
+def read_index(path, lexicon_path, stamp):
+    # Returns None if the file is missing, unreadable or was built from another version of the lexicon
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if not data.startswith(INDEX_FORMAT):
+        return None
+    sections = []
+    position = len(INDEX_FORMAT)
+    try:
+        for _ in range(4):
+            size, = struct.unpack_from("<Q", data, position)
+            position += 8
+            sections.append(data[position:position + size])
+            position += size
+        header = json.loads(sections[0].decode("utf-8"))
+    except (struct.error, ValueError):
+        return None
+    if header.get("version") != INDEX_VERSION or any(header.get(key) != value for key, value in stamp.items()):
+        return None
+
+    starts = array('q')
+    starts.frombytes(sections[2])
+    offsets = array('q')
+    offsets.frombytes(sections[3])
+    if header.get("byteorder") != sys.byteorder:
+        starts.byteswap()
+        offsets.byteswap()
+    words = sections[1].decode("utf-8").split("\n") if sections[1] else []
+    return LexiconIndex(lexicon_path, words, starts, offsets)
+
+
+# (path, size, mtime) -> LexiconIndex, a lexicon is loaded once per session
+_indexes = {}
+
+
+def load_index(lexicon_path, folder=None):
+    if not os.path.isfile(lexicon_path):
+        raise LexiconError("Lexicon not found: {}".format(lexicon_path))
+    stamp = lexicon_stamp(lexicon_path)
+    memo_key = tuple(stamp.values())
+    index = _indexes.get(memo_key)
+    if index is not None:
+        return index
+
+    path = index_path(lexicon_path, folder)
+    index = read_index(path, lexicon_path, stamp)
+    if index is None:
+        print(f"[DEBUG] Indexing lexicon {lexicon_path}")
+        index = build_index(lexicon_path)
+        try:
+            write_index(path, index, stamp)
+        except OSError as e:
+            print(f"[WARNING] Could not save the lexicon index: {e}")
+    _indexes[memo_key] = index
+    return index
+
+
+def segment_cjk(run, index):
+    # Longest match from the left, a character the lexicon doesn't have is a word of its own
+    words = []
+    position = 0
+    while position < len(run):
+        for length in range(min(max(index.max_length, 1), len(run) - position), 0, -1):
+            candidate = run[position:position + length]
+            if length == 1 or candidate in index:
+                words.append(candidate)
+                position += length
+                break
+    return words
+
+
+def tokenize(text, index):
+    # Words as MFA looks them up: case folded, punctuation dropped, hyphenated words split, Chinese segmented
+    text = normalize_word(text)
+    tokens = []
+    for part in CJK_RUN.split(text):
+        if not part:
+            continue
+        if CJK_RUN.match(part):
+            tokens.extend(segment_cjk(part, index))
+        else:
+            tokens.extend(WORD.findall(part.replace("’", "'")))
+    return tokens
+
+
+def lexicon_words(text, index):
+    # Every lexicon word MFA might look up for text, whichever way it splits it: the tokens, hyphenated words kept
+    # whole and every word of the lexicon found inside a run of Chinese characters
+    text = normalize_word(text)
+    words = set()
+    for part in CJK_RUN.split(text):
+        if not part:
+            continue
+        if CJK_RUN.match(part):
+            for start in range(len(part)):
+                for stop in range(start + 1, min(start + index.max_length, len(part)) + 1):
+                    words.add(part[start:stop])
+        else:
+            part = part.replace("’", "'")
+            words.update(WORD.findall(part))
+            words.update(re.findall(r"[^\W_]+(?:['’-][^\W_]+)+", part))
+    return set(word for word in words if word in index)
+
+
+class G2PCache(object):
+    # word -> pronunciations generated by MFA's G2P with one model, stored as json in the index folder
+
+    def __init__(self, settings, folder=None):
+        self.settings = settings
+        self.model = settings.get("g2p_model") or ""
+        name = hashlib.sha1(os.path.abspath(self.model).encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(folder or get_index_folder(), "g2p_" + name + ".json")
+        self._words = None
+
+    @property
+    def available(self):
+        return bool(self.model) and os.path.isfile(self.model) and not self.settings["mfa_version"].startswith("v1")
+
+    @property
+    def words(self):
+        if self._words is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._words = json.load(f, object_pairs_hook=OrderedDict)
+            except (OSError, ValueError):
+                self._words = OrderedDict()
+        return self._words
+
+    def lookup(self, words):
+        return OrderedDict((word, self.words[word]) for word in words if word in self.words)
+
+    def generate(self, words, work_folder):
+        # Runs MFA's G2P once for all words it hasn't seen, returns word -> pronunciations for all of them
+        missing = [word for word in words if word not in self.words]
+        if missing and self.available:
+            print(f"[DEBUG] Generating pronunciations for {len(missing)} words")
+            for word, pronunciation in run_g2p(self.settings, missing, work_folder):
+                self.words.setdefault(word, [])
+                if pronunciation not in self.words[word]:
+                    self.words[word].append(pronunciation)
+            self.save()
+        return self.lookup(words)
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        temp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.words, f, ensure_ascii=False, indent=0)
+        os.replace(temp_path, self.path)
+
+
+def build_g2p_command(settings, word_list_path, output_path):
+    # Same interpreter and PATH setup as lip_sync_core.build_mfa_command for MFA 3.x
+    env = mfa_environment(settings)
+    command = [os.path.join(settings["mfa_path"], settings["mfa_align_cmd"]), "-m", "montreal_forced_aligner.command_line.mfa",
+               "g2p", word_list_path, settings["g2p_model"], output_path]
+    return command, env
+
+
+def run_g2p(settings, words, work_folder):
+    # Yields (word, pronunciation) for the words MFA's G2P could pronounce
+    if not os.path.exists(work_folder):
+        os.makedirs(work_folder)
+    word_list_path = os.path.join(work_folder, "g2p_words.txt")
+    output_path = os.path.join(work_folder, "g2p_output.txt")
+    with open(word_list_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(words) + "\n")
+    command, env = build_g2p_command(settings, word_list_path, output_path)
+    print("Running command:", subprocess.list2cmdline(command))
+    try:
+        result = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    except OSError as e:
+        print(f"[WARNING] Could not run MFA's G2P: {e}")
+        return
+    if result.returncode != 0 or not os.path.exists(output_path):
+        print(f"[WARNING] MFA's G2P failed:\n{result.stdout}")
+        return
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.rstrip("\r\n").split("\t")
+            if len(parts) >= 2 and parts[-1].strip():
+                yield normalize_word(parts[0]), parts[-1].strip()
+
+
+def check_transcript(text, settings, g2p=True, work_folder=None):
+    # Returns Preflight(tokens, oov, extra, words): the transcript's words, the ones neither the lexicon nor the G2P
+    # fallback can pronounce, word -> pronunciations from the fallback that have to be added to the lexicon for MFA,
+    # and the set of lexicon words the transcript needs (see write_pruned_lexicon)
+    index = load_index(settings["lexicon"])
+    tokens = tokenize(text, index)
+    unknown = list(OrderedDict.fromkeys(token for token in tokens if token not in index))
+    extra = OrderedDict()
+    if unknown and g2p:
+        cache = G2PCache(settings)
+        extra = cache.lookup(unknown)
+        if len(extra) < len(unknown) and cache.available and work_folder:
+            extra = cache.generate(unknown, work_folder)
+    oov = [word for word in unknown if word not in extra]
+    return Preflight(tokens, oov, extra, lexicon_words(text, index))
+
+
+def extra_lines(extra):
+    return "".join("{}\t{}\n".format(word, pronunciation)
+                   for word, pronunciations in extra.items() for pronunciation in pronunciations).encode("utf-8")
+
+
+def write_pruned_lexicon(lexicon_path, output_path, words, extra=None):
+    # Only the lines of words (normalized, see lexicon_words) plus the extra pronunciations. The lines are read in
+    # file order with one seek each and keep their original order. Returns the number of lines written.
+    index = load_index(lexicon_path)
+    offsets = sorted(offset for word in words for offset in index.line_offsets(word))
+    with open(lexicon_path, "rb") as source, open(output_path, "wb") as target:
+        for offset in offsets:
+            source.seek(offset)
+            line = source.readline()
+            target.write(line if line.endswith(b"\n") else line + b"\n")
+        if extra:
+            target.write(extra_lines(extra))
+    return len(offsets) + sum(len(pronunciations) for pronunciations in (extra or {}).values())
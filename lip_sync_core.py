@@ -0,0 +1,661 @@
+'''
+Name: lip_sync_core
+
+Description: The Maya and Qt independent part of auto_lip_sync. Holds the language settings, the phone to viseme
+mapping, MFA invocation, TextGrid parsing and the keyframe plan computation. Can be imported in mayapy or plain Python.
+
+Command line usage (from the folder that contains the auto_lip_sync folder):
+
+python -m auto_lip_sync input.wav input.txt -o plan.json --language English --pose-map poses.json
+
+The pose map is an optional json file that maps visemes to pose files ({"AI": "D:/poses/AI.json", ...}).
+The resulting plan file can be applied to a rig with the "Apply plan" button in the Maya tool.
+'''
+import shutil
+import os
+import sys
+import json
+import argparse
+import subprocess
+import unicodedata
+import multiprocessing
+from array import array
+from collections import Counter, OrderedDict
+
+from .mfa_runner import MfaProcess, mfa_stage_name, cancel_on_terminate
+from .align_cache import AlignmentCache, alignment_key, envelope_key
+from .incremental import remember_run, plan_realignment, splice_edits
+from .mfa_worker import WarmAligner, WarmAlignJob
+from .textgrid_reader import read_tier, TextGridError
+from .audio import condition_wav, compute_envelope, AudioError
+from .blending import default_blend_settings
+from .tracks import build_track, write_track, TrackError
+from .tracing import tracer
+from .schedule import compile_schedule, schedule_keys, MIN_HOLD_FRAMES
+from .language_packs import LanguagePacks, LanguagePackError, mfa_environment
+from .lexicon import check_transcript, write_pruned_lexicon, LexiconError
+
+PLAN_VERSION = 1
+
+
+class LipSyncError(RuntimeError):
+    pass
+
+
+def get_user_script_dir():
+    # Only ask Maya for the script dir if Maya is already running, importing maya.cmds outside of it is expensive.
+    env_dir = os.environ.get("AUTO_LIP_SYNC_DIR")
+    if env_dir:
+        return os.path.join(env_dir, "")
+    if "maya.cmds" in sys.modules:
+        try:
+            return sys.modules["maya.cmds"].internalVar(userScriptDir=True)
+        except AttributeError:
+            pass
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "")
+
+
+USER_SCRIPT_DIR = get_user_script_dir()
+
+# Language name -> settings, every language is a pack file in the language_packs folder compiled on first use
+language_settings = LanguagePacks(USER_SCRIPT_DIR)
+
+
+def delete_folders(*folders):
+    for folder in folders:
+        try:
+            shutil.rmtree(folder)
+        except OSError:
+            pass
+
+
+def read_transcript(text_path):
+    # Try different encodings
+    encodings = ['utf-8', 'gb18030', 'big5', 'gbk']
+    for enc in encodings:
+        try:
+            with open(text_path, 'r', encoding=enc) as source_file:
+                return source_file.read()
+        except UnicodeDecodeError:
+            continue
+    raise LipSyncError("Could not decode the text file with any of the supported encodings. Please ensure the file is encoded in UTF-8, GB18030, Big5, or GBK.")
+
+
+def stage_clip(sound_path, text_path, folder, name=None):
+    # MFA wants the transcript next to the sound file with the same name, and the sound as 16 kHz mono 16-bit
+    name = name or os.path.splitext(os.path.basename(sound_path))[0]
+    try:
+        condition_wav(sound_path, os.path.join(folder, name + ".wav"))
+    except (OSError, AudioError) as e:
+        raise LipSyncError("Can't use the sound file: {}".format(e))
+
+    # Write the text file in UTF-8
+    text_content = read_transcript(text_path)
+    target_path = os.path.join(folder, name + ".txt")
+    with open(target_path, 'w', encoding='utf-8') as target_file:
+        target_file.write(text_content)
+    return name
+
+
+def stage_input(sound_path, text_path, input_folder):
+    os.makedirs(input_folder)
+    return stage_clip(sound_path, text_path, input_folder)
+
+
+def build_mfa_command(settings, input_folder, output_folder, num_jobs=None):
+    # Returns the argument list and the environment to run MFA with
+    mfa_cmd = os.path.join(settings["mfa_path"], settings["mfa_align_cmd"])
+    job_args = ["-j", str(num_jobs)] if num_jobs else []
+    if settings["mfa_version"].startswith("v1"):
+        # MFA 1.0.1 command format
+        command = [mfa_cmd, input_folder, settings["lexicon"], settings["model"], output_folder] + job_args
+        return command, None
+
+    # MFA 3.x is run as a python module and needs openfst on PATH
+    env = mfa_environment(settings)
+    command = [mfa_cmd, "-m", "montreal_forced_aligner.command_line.mfa", "align",
+               input_folder, settings["lexicon"], settings["model"], output_folder] + job_args
+    return command, env
+
+
+def create_mfa_process(settings, input_folder, output_folder, num_jobs=None):
+    command, env = build_mfa_command(settings, input_folder, output_folder, num_jobs)
+    print("Running command:", subprocess.list2cmdline(command))
+    return MfaProcess(command, env)
+
+
+def create_aligner_process(settings, input_folder, output_folder, num_jobs=None, warm=False):
+    # warm=True sends the clips to the long lived MFA 3.x worker instead of starting "mfa align"
+    if warm:
+        try:
+            return WarmAlignJob(WarmAligner(settings), input_folder, output_folder)
+        except ValueError as e:
+            print("[WARNING] {}, running MFA normally".format(e))
+    return create_mfa_process(settings, input_folder, output_folder, num_jobs)
+
+
+def run_mfa(settings, input_folder, output_folder, on_line=None, num_jobs=None, warm=False):
+    # Blocking run, on_line(line, progress) is called for every line MFA prints on stdout or stderr
+    mfa_process = create_aligner_process(settings, input_folder, output_folder, num_jobs, warm).start()
+    progress = 0
+    stage = tracer.begin("mfa " + mfa_stage_name(progress))
+    for stream, line in mfa_process.lines():
+        if mfa_process.progress != progress:
+            progress = mfa_process.progress
+            stage = tracer.switch(stage, "mfa " + mfa_stage_name(progress))
+        if on_line:
+            on_line(line, mfa_process.progress)
+        else:
+            print(line)
+    return_code = mfa_process.wait()
+    tracer.end(stage, return_code=return_code)
+    return return_code
+
+
+def find_textgrid_file(output_folder, clip_name=None):
+    # MFA 3 writes output/<clip>.TextGrid, MFA 1 writes output/<corpus folder>/<clip>.TextGrid
+    if clip_name:
+        file_name = clip_name + ".TextGrid"
+        candidates = [os.path.join(output_folder, file_name)]
+        if os.path.isdir(output_folder):
+            candidates += [os.path.join(output_folder, folder, file_name) for folder in os.listdir(output_folder)]
+        for candidate in candidates:
+            if os.path.isfile(candidate):
+                return candidate
+        return find_textgrid_files(output_folder).get(clip_name, "")
+
+    textgrid_file = ""
+    for root, dirs, files in os.walk(output_folder):
+        for file in files:
+            if file.endswith(".TextGrid"):
+                textgrid_file = root+"/"+file
+    return textgrid_file
+
+
+def find_textgrid_files(output_folder):
+    # Maps the clip name (file name without extension) to its TextGrid path
+    textgrid_files = {}
+    for root, dirs, files in os.walk(output_folder):
+        for file in files:
+            if file.endswith(".TextGrid"):
+                textgrid_files[os.path.splitext(file)[0]] = os.path.join(root, file)
+    return textgrid_files
+
+
+def read_phone_intervals(textgrid_path):
+    # Returns the phones tier as a textgrid_reader.IntervalTier, iterating it gives (min_time, max_time, phone)
+    try:
+        with tracer.span("read textgrid", path=textgrid_path):
+            return read_tier(textgrid_path, "phones")
+    except (OSError, TextGridError) as e:
+        raise LipSyncError("Error reading TextGrid file: {}".format(e))
+
+
+OOV_SHOWN = 20
+
+
+def preflight_transcript(transcript, settings, work_dir=None, allow_oov=False):
+    # Checks the transcript against the lexicon before MFA runs, see lexicon.check_transcript. Raises a LipSyncError
+    # listing the words nothing can pronounce unless allow_oov is set.
+    try:
+        with tracer.span("preflight"):
+            preflight = check_transcript(transcript, settings, work_folder=os.path.join(work_dir or USER_SCRIPT_DIR, "g2p"))
+    except (OSError, LexiconError) as e:
+        raise LipSyncError("Can't check the transcript: {}".format(e))
+    tracer.count("words", len(preflight.tokens))
+    if preflight.extra:
+        print("[DEBUG] Pronounced with G2P: {}".format(", ".join(preflight.extra)))
+    if preflight.oov:
+        shown = ", ".join(preflight.oov[:OOV_SHOWN]) + (", ..." if len(preflight.oov) > OOV_SHOWN else "")
+        message = "{} of {} words are not in the lexicon: {}".format(len(preflight.oov), len(preflight.tokens), shown)
+        if not allow_oov:
+            raise LipSyncError(message)
+        print("[WARNING] " + message)
+    return preflight
+
+
+def lexicon_settings(settings, preflight, folder):
+    # The settings MFA runs with. The lexicon is cut down to the words of the checked transcripts plus the G2P
+    # pronunciations of the pre-flight check, so MFA doesn't compile the whole dictionary for a few lines of dialogue.
+    if preflight is None or not (preflight.extra or preflight.words):
+        return settings
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    lexicon_path = os.path.join(folder, "lexicon.dict")
+    with tracer.span("prune lexicon"):
+        line_count = write_pruned_lexicon(settings["lexicon"], lexicon_path, preflight.words, preflight.extra)
+    print("Pruned the lexicon to {} lines for {} words".format(line_count, len(preflight.words) + len(preflight.extra)))
+    return dict(settings, lexicon=lexicon_path)
+
+
+def use_warm_worker(warm, preflight):
+    # The warm worker only has the language's own lexicon compiled. A transcript that needs G2P pronunciations on top
+    # of it is aligned by a normal MFA run with those added, the worker keeps serving the plain lexicon.
+    if warm and preflight is not None and preflight.extra:
+        print("[DEBUG] {} words need G2P pronunciations, running MFA normally instead of on the warm worker".format(len(preflight.extra)))
+        return False
+    return warm
+
+
+def align_incremental(sound_path, text_path, language, work_dir=None, on_line=None, cache=None, allow_oov=False, num_jobs=None):
+    # Like align, but if this audio was aligned before with another transcript only the edited spans go to MFA (see
+    # incremental). Returns (intervals, windows), windows being the (start, end) seconds whose keys have to be replaced,
+    # or None when the whole clip was aligned and has to be keyed.
+    settings = language_settings[language]
+    transcript = read_transcript(text_path)
+    plan = None
+    if cache is not None and not cache.get(alignment_key(sound_path, transcript, settings)):
+        plan = plan_realignment(cache, sound_path, transcript, settings)
+    if plan is None:
+        return align(sound_path, text_path, language, work_dir, on_line, cache, allow_oov=allow_oov), None
+
+    previous_path, segments = plan
+    cache_key = alignment_key(sound_path, transcript, settings)
+    clip_name = os.path.splitext(os.path.basename(sound_path))[0]
+    work_dir = work_dir or USER_SCRIPT_DIR
+    input_folder = os.path.join(work_dir, "input")
+    output_folder = os.path.join(work_dir, "output")
+    lexicon_folder = os.path.join(work_dir, "lexicon")
+
+    preflight = preflight_transcript(" ".join(segment.text for segment in segments), settings, work_dir, allow_oov)
+    delete_folders(input_folder, output_folder, lexicon_folder)
+    try:
+        spoken = [segment for segment in segments if segment.text]
+        if spoken:
+            with tracer.span("stage input"):
+                stage_edits(sound_path, spoken, input_folder)
+                run_settings = lexicon_settings(settings, preflight, lexicon_folder)
+            with tracer.span("mfa", language=language):
+                run_mfa(run_settings, input_folder, output_folder, on_line, num_jobs or multiprocessing.cpu_count())
+        textgrid_path, windows = splice_realignment(previous_path, segments, output_folder, clip_name)
+        cache.put(cache_key, textgrid_path)
+        remember_run(cache, sound_path, transcript, settings, cache_key)
+        return read_phone_intervals(textgrid_path), windows
+    finally:
+        delete_folders(input_folder, output_folder, lexicon_folder)
+
+
+def stage_edits(sound_path, segments, input_folder):
+    from .long_audio import stage_spans, LongAudioError
+    try:
+        return stage_spans(sound_path, segments, input_folder)
+    except LongAudioError as e:
+        raise LipSyncError(str(e))
+
+
+def splice_realignment(previous_path, segments, output_folder, clip_name):
+    # Writes output_folder/<clip_name>.TextGrid from the previous alignment and the edited spans MFA wrote, returns
+    # its path and the (start, end) windows that changed
+    textgrid_files = find_textgrid_files(output_folder)
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    textgrid_path = os.path.join(output_folder, clip_name + ".TextGrid")
+    try:
+        windows = splice_edits(previous_path, segments, textgrid_files, textgrid_path)
+    except (OSError, TextGridError) as e:
+        raise LipSyncError("Could not splice the edited spans into the previous alignment: {}".format(e))
+    return textgrid_path, windows
+
+
+def stage_long_audio(sound_path, transcript, input_folder):
+    from .long_audio import stage_segments, LongAudioError
+    try:
+        return stage_segments(sound_path, transcript, input_folder)
+    except LongAudioError as e:
+        raise LipSyncError(str(e))
+
+
+def stitch_long_audio(segments, output_folder, clip_name):
+    # Writes output_folder/<clip_name>.TextGrid from the segment TextGrids MFA wrote
+    from .long_audio import stitch_segments, LongAudioError
+    textgrid_files = find_textgrid_files(output_folder)
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    try:
+        failed = stitch_segments(segments, textgrid_files, os.path.join(output_folder, clip_name + ".TextGrid"))
+    except LongAudioError as e:
+        raise LipSyncError(str(e))
+    if failed:
+        print("[WARNING] {} of {} segments could not be aligned and are keyed as rest".format(len(failed), len(segments)))
+
+
+MISSING_TEXTGRID_MESSAGE = ("No TextGrid file found. This usually means the Montreal Forced Aligner failed to run. "
+                            "Please check that Montreal Forced Aligner is properly installed, that the input audio file "
+                            "is an uncompressed WAV file and that the input text file is properly formatted.")
+
+
+def align(sound_path, text_path, language, work_dir=None, on_line=None, cache=None, warm=False, allow_oov=False,
+          long_audio=False, num_jobs=None):
+    # Runs MFA on a single wav/txt pair and returns the phone intervals. With an AlignmentCache MFA only runs on a miss.
+    # The transcript is checked against the lexicon first, see preflight_transcript. long_audio splits the clip at its
+    # pauses and aligns the segments with num_jobs MFA jobs (default: one per core), see long_audio.
+    settings = language_settings[language]
+    if cache is not None:
+        with tracer.span("cache lookup"):
+            cache_key = alignment_key(sound_path, read_transcript(text_path), settings)
+            cached_path = cache.get(cache_key)
+        if cached_path:
+            print("Using cached alignment: " + cached_path)
+            remember_run(cache, sound_path, read_transcript(text_path), settings, cache_key)
+            return read_phone_intervals(cached_path)
+
+    work_dir = work_dir or USER_SCRIPT_DIR
+    input_folder = os.path.join(work_dir, "input")
+    output_folder = os.path.join(work_dir, "output")
+    lexicon_folder = os.path.join(work_dir, "lexicon")
+
+    transcript = read_transcript(text_path)
+    preflight = preflight_transcript(transcript, settings, work_dir, allow_oov)
+    delete_folders(input_folder, output_folder, lexicon_folder)
+    try:
+        with tracer.span("stage input"):
+            if long_audio:
+                segments = stage_long_audio(sound_path, transcript, input_folder)
+                clip_name = os.path.splitext(os.path.basename(sound_path))[0]
+                num_jobs = num_jobs or multiprocessing.cpu_count()
+            else:
+                clip_name = stage_input(sound_path, text_path, input_folder)
+            warm = use_warm_worker(warm, preflight)
+            run_settings = settings if warm else lexicon_settings(settings, preflight, lexicon_folder)
+        with tracer.span("mfa", language=language, warm=warm):
+            run_mfa(run_settings, input_folder, output_folder, on_line, num_jobs, warm=warm)
+        if long_audio:
+            stitch_long_audio(segments, output_folder, clip_name)
+        textgrid_path = find_textgrid_file(output_folder, clip_name)
+        if not textgrid_path:
+            raise LipSyncError(MISSING_TEXTGRID_MESSAGE)
+        if cache is not None:
+            cache.put(cache_key, textgrid_path)
+            remember_run(cache, sound_path, transcript, settings, cache_key)
+        return read_phone_intervals(textgrid_path)
+    finally:
+        delete_folders(input_folder, output_folder, lexicon_folder)
+
+
+TONE_LETTERS = "\u02e5\u02e6\u02e7\u02e8\u02e9"
+
+
+def normalize_phone(phone, strip_diacritics=False):
+    # Drops stress digits and tone letters, and optionally combining diacritics and modifier letters
+    phone = phone.rstrip("0123456789" + TONE_LETTERS)
+    if strip_diacritics:
+        phone = "".join(c for c in phone if not unicodedata.combining(c) and unicodedata.category(c) != "Lm")
+    return phone
+
+
+class PhoneIndex(object):
+    # Maps raw MFA phones straight to (viseme, pose path). Built once per run, every phone is resolved only once.
+
+    def __init__(self, phone_dict, phone_path_dict):
+        self.phone_dict = phone_dict
+        self.pose_paths = dict((viseme, path or None) for viseme, path in phone_path_dict.items())
+        self.unknown = Counter()
+        self.unassigned = Counter()
+        self._lookup = {}
+
+    def find_viseme(self, phone):
+        for candidate in (phone, normalize_phone(phone), normalize_phone(phone, strip_diacritics=True)):
+            viseme = self.phone_dict.get(candidate)
+            if viseme is not None:
+                return viseme
+        return None
+
+    def lookup(self, phone):
+        entry = self._lookup.get(phone)
+        if entry is None:
+            viseme = self.find_viseme(str(phone))
+            entry = self._lookup[phone] = (viseme, self.pose_paths.get(viseme))
+        if entry[0] is None:
+            self.unknown[phone] += 1
+        elif entry[1] is None:
+            self.unassigned[entry[0]] += 1
+        return entry
+
+    def summary(self):
+        lines = []
+        if self.unknown:
+            lines.append("Unknown phones: " + ", ".join("'{}' x{}".format(p, n) for p, n in self.unknown.most_common()))
+        if self.unassigned:
+            lines.append("Visemes without a pose: " + ", ".join("{} x{}".format(v, n) for v, n in self.unassigned.most_common()))
+        return "\n".join(lines)
+
+
+def compute_keyframe_plan(intervals, phone_index):
+    # Each key in the plan holds the pose to apply at start and end of the interval. Pose is None if not assigned.
+    keys = []
+    lookup = phone_index.lookup
+    with tracer.span("keyframe plan"):
+        for min_time, max_time, phone in intervals:
+            viseme, pose_path = lookup(phone)
+            keys.append({"start": min_time, "end": max_time, "phone": phone, "viseme": viseme, "pose": pose_path})
+    tracer.count("intervals", len(keys))
+    return keys
+
+
+def compact_keyframe_plan(keys, fps, min_hold=MIN_HOLD_FRAMES):
+    # Snaps the plan to frames and merges the intervals that would key the same pose again, see schedule
+    with tracer.span("compile schedule", fps=fps, min_hold=min_hold):
+        compact = schedule_keys(compile_schedule(keys, fps, min_hold))
+    tracer.count("scheduled intervals", len(compact))
+    print("[DEBUG] Compiled {} intervals into {} at {:g} fps".format(len(keys), len(compact), fps))
+    return compact
+
+
+def compute_attribute_curves(keys, get_pose):
+    # Turns the plan into one (times, values) series per control.attr for the whole clip.
+    # get_pose(path) returns a pose_library.Pose. Keys without a pose are skipped.
+    curves = OrderedDict()
+    for key in keys:
+        if not key["pose"]:
+            continue
+        pose = get_pose(key["pose"])
+        for name, value in zip(pose.names, pose.values):
+            if isinstance(value, (list, tuple)):
+                continue
+            series = curves.get(name)
+            if series is None:
+                series = curves[name] = (array('d'), array('d'))
+            times, values = series
+            for time in (key["start"], key["end"]):
+                # Intervals share their boundaries, the later interval wins like it did with setKeyframe
+                if times and times[-1] >= time:
+                    if times[-1] == time:
+                        values[-1] = value
+                    continue
+                times.append(time)
+                values.append(value)
+    return curves
+
+
+def drop_redundant_keys(times, values, tolerance=1e-4):
+    # Drops the keys inside flat stretches of a curve. A key goes when it and the key after it are both within
+    # tolerance of the last kept key, so the first and last key of every plateau stay and the result never strays
+    # more than twice the tolerance from the dropped keys.
+    count = len(times)
+    if count < 3:
+        return times, values
+    kept_times = array('d', times[:1])
+    kept_values = array('d', values[:1])
+    anchor = values[0]
+    for index in range(1, count - 1):
+        value = values[index]
+        if abs(value - anchor) <= tolerance and abs(values[index + 1] - anchor) <= tolerance:
+            continue
+        kept_times.append(times[index])
+        kept_values.append(value)
+        anchor = value
+    kept_times.append(times[-1])
+    kept_values.append(values[-1])
+    return kept_times, kept_values
+
+
+def reduce_curves(curves, static=(), tolerance=1e-4):
+    # Takes the static attributes (see pose_library.analyze_poses) out of curves and drops the redundant keys of the
+    # rest. Returns the reduced curves and a Counter of what was avoided.
+    stats = Counter()
+    reduced = OrderedDict()
+    for name, (times, values) in curves.items():
+        stats["keys"] += len(times)
+        if name in static:
+            stats["static_curves"] += 1
+            stats["dropped_keys"] += len(times)
+            continue
+        reduced_times, reduced_values = drop_redundant_keys(times, values, tolerance)
+        stats["dropped_keys"] += len(times) - len(reduced_times)
+        reduced[name] = (reduced_times, reduced_values)
+    return reduced, stats
+
+
+def clip_envelope(sound_path, fps, cache=None, smoothing=0.08):
+    # Loudness envelope of the clip, one value in [0, 1] per frame at fps, see audio.compute_envelope
+    key = None
+    if cache is not None:
+        key = envelope_key(sound_path, fps, smoothing)
+        envelope = cache.get_envelope(key)
+        if envelope is not None:
+            return envelope
+    try:
+        envelope = compute_envelope(sound_path, fps, smoothing)
+    except (OSError, AudioError) as e:
+        raise LipSyncError("Can't compute the envelope of the sound file: {}".format(e))
+    if cache is not None:
+        cache.put_envelope(key, envelope)
+    return envelope
+
+
+def envelope_plan(sound_path, attr, fps, low=0.0, high=1.0, cache=None):
+    # The "envelope" entry of a keyframe plan: attr is keyed from low (silence) to high (loudest) every frame
+    envelope = clip_envelope(sound_path, fps, cache)
+    return OrderedDict([("attr", attr), ("fps", fps), ("low", low), ("high", high),
+                        ("values", [round(float(value), 4) for value in envelope])])
+
+
+def compute_envelope_curve(envelope):
+    # Turns a plan's envelope entry into a (times, values) series like compute_attribute_curves
+    fps = float(envelope["fps"])
+    low = envelope.get("low", 0.0)
+    scale = envelope.get("high", 1.0) - low
+    times = array('d', (frame / fps for frame in range(len(envelope["values"]))))
+    values = array('d', (low + scale * value for value in envelope["values"]))
+    return times, values
+
+
+def write_plan(plan_path, keys, language, sound_path="", text_path="", **extra):
+    plan = OrderedDict([
+        ("version", PLAN_VERSION),
+        ("language", language),
+        ("sound", sound_path),
+        ("transcript", text_path),
+    ])
+    plan.update(extra)
+    plan["keys"] = keys
+    with open(plan_path, "w", encoding='utf-8') as jsonFile:
+        json.dump(plan, jsonFile, indent=4, ensure_ascii=False)
+
+
+def read_plan(plan_path):
+    with open(plan_path, 'r', encoding='utf-8') as f:
+        plan = json.load(f)
+    if plan.get("version") != PLAN_VERSION:
+        raise LipSyncError("Unsupported keyframe plan version: {}".format(plan.get("version")))
+    return plan
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="auto_lip_sync", description="Align a wav/txt pair with MFA and write a keyframe plan file.")
+    parser.add_argument("sound", help="Input wav file")
+    parser.add_argument("text", help="Input transcript txt file")
+    parser.add_argument("-o", "--output", help="Keyframe plan file to write (default: next to the wav file)")
+    parser.add_argument("-l", "--language", default="English", choices=sorted(language_settings))
+    parser.add_argument("-p", "--pose-map", help="Json file mapping visemes to pose files")
+    parser.add_argument("-w", "--work-dir", help="Folder used for the MFA input and output folders")
+    parser.add_argument("--cache-dir", help="Alignment cache folder (default: $AUTO_LIP_SYNC_CACHE or alignment_cache in the script dir)")
+    parser.add_argument("--no-cache", action="store_true", help="Always run MFA and don't store the result")
+    parser.add_argument("--warm", action="store_true", help="Align on the long lived MFA 3.x worker, started on first use")
+    parser.add_argument("--allow-oov", action="store_true", help="Align even if the transcript has words the lexicon can't pronounce")
+    parser.add_argument("--incremental", action="store_true",
+                        help="If this audio was aligned before with another transcript, only align and re-key the edited spans")
+    parser.add_argument("--long", action="store_true", help="Split a long take at its pauses and align the segments in parallel")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of parallel MFA jobs for --long (default: number of cores)")
+    parser.add_argument("--jaw-attr", help="Key this control.attr from the loudness of the clip, e.g. jaw_ctrl.rotateZ")
+    parser.add_argument("--jaw-range", type=float, nargs=2, default=(0.0, 1.0), metavar=("CLOSED", "OPEN"),
+                        help="Values of --jaw-attr at silence and at full loudness (default: 0 1)")
+    parser.add_argument("--fps", type=float, default=24.0, help="Frame rate the plan is snapped to and of the loudness keys (default: 24)")
+    parser.add_argument("--min-hold", type=int, default=MIN_HOLD_FRAMES,
+                        help="Frames a viseme is held at least, shorter ones go to the viseme before (default: 1)")
+    parser.add_argument("--keep-intervals", action="store_true", help="Key every MFA interval as it is instead of the compiled schedule")
+    parser.add_argument("--blend", action="store_true", help="Blend neighbouring visemes (coarticulation) when the plan is keyed")
+    parser.add_argument("--track", help="Also export the viseme schedule and per frame weights at --fps (.npz, .json or .csv)")
+    parser.add_argument("--trace", help="Write the time spent in every stage to this Chrome trace json file")
+    args = parser.parse_args(argv)
+    try:
+        language_settings.check(args.language)
+    except LanguagePackError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 1
+    # A job queue worker terminates runs that time out, MFA has to stop with them
+    cancel_on_terminate()
+    if args.trace:
+        tracer.reset(enabled=True)
+    try:
+        return run_main(args)
+    finally:
+        if args.trace:
+            tracer.write(args.trace)
+            print("Timings: " + tracer.summary())
+            tracer.reset(enabled=False)
+
+
+def run_main(args):
+
+    phone_path_dict = OrderedDict(language_settings[args.language]["phone_path_dict"])
+    if args.pose_map:
+        with open(args.pose_map, 'r', encoding='utf-8') as f:
+            phone_path_dict.update(json.load(f))
+
+    try:
+        cache = None if args.no_cache else AlignmentCache(args.cache_dir)
+        extra = {}
+        if args.incremental:
+            intervals, windows = align_incremental(args.sound, args.text, args.language, args.work_dir, cache=cache,
+                                                   allow_oov=args.allow_oov, num_jobs=args.jobs)
+            if windows is not None:
+                extra["windows"] = windows
+        else:
+            intervals = align(args.sound, args.text, args.language, args.work_dir, cache=cache, warm=args.warm and not args.long,
+                              allow_oov=args.allow_oov, long_audio=args.long, num_jobs=args.jobs)
+        if args.blend:
+            extra["blend"] = default_blend_settings()
+        if args.jaw_attr:
+            with tracer.span("envelope"):
+                extra["envelope"] = envelope_plan(args.sound, args.jaw_attr, args.fps, args.jaw_range[0], args.jaw_range[1], cache)
+    except LipSyncError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 1
+
+    phone_index = PhoneIndex(language_settings[args.language]["phone_dict"], phone_path_dict)
+    keys = compute_keyframe_plan(intervals, phone_index)
+    if phone_index.summary():
+        print(phone_index.summary())
+    if not args.keep_intervals:
+        keys = compact_keyframe_plan(keys, args.fps, args.min_hold)
+    plan_path = args.output or os.path.splitext(args.sound)[0] + ".plan.json"
+    with tracer.span("write plan"):
+        write_plan(plan_path, keys, args.language, os.path.abspath(args.sound), os.path.abspath(args.text), **extra)
+    print("Wrote {} keys to {}".format(len(keys), plan_path))
+    if args.track:
+        settings = language_settings[args.language]
+        try:
+            with tracer.span("track"):
+                track = build_track(keys, args.fps, args.language, settings["phone_dict"], list(settings["phone_path_dict"]),
+                                    extra.get("blend"), sound=os.path.abspath(args.sound))
+                write_track(args.track, track)
+        except TrackError as e:
+            print("Error: {}".format(e), file=sys.stderr)
+            return 1
+        print("Wrote {} frames of viseme weights to {}".format(len(track.weights), args.track))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
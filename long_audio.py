@@ -0,0 +1,232 @@
+'''
+Name: long_audio
+
+Description: Long take mode. Aligning a whole cinematic as one utterance is slow and memory hungry in MFA, and one
+bad region can fail all of it. Instead the pauses of the recording are found with an energy VAD (per 10 ms RMS from
+audio.frame_rms, thresholded between the noise floor and the speech level), the transcript is split into sentences,
+and each sentence boundary is cut at the longest pause near where the boundary should fall by the amount of text
+before it. The segments are staged as one corpus with every segment in a speaker folder of its own. MFA splits its
+work between jobs by speaker, so this is what lets it spread the segments over its jobs (one per core). The segment
+TextGrids are then stitched back into one words/phones timeline with each segment's time offset.
+
+A segment MFA fails on is reported and left as a rest interval, the rest of the take is still keyed.
+
+Needs numpy, which ships with mayapy 2022 and later.
+'''
+import os
+import re
+import wave
+from collections import namedtuple
+from contextlib import contextmanager
+
+from .audio import condition_wav, frame_rms, read_wav_header, AudioError
+from .textgrid_reader import IntervalTier, read_tier, write_textgrid, TextGridError
+from .tracing import tracer
+
+VAD_RATE = 100
+VAD_THRESHOLD = 0.3
+MIN_SILENCE = 0.25
+MIN_SEGMENT = 15.0
+CUT_TOLERANCE = 2.5
+
+SENTENCE_END = re.compile(r"(?<=[.!?;…])\s+|(?<=[。！？；])|\n+")
+
+Segment = namedtuple("Segment", ["name", "start", "end", "text"])
+
+
+class LongAudioError(ValueError):
+    pass
+
+
+def detect_speech(path, rate=VAD_RATE, threshold=VAD_THRESHOLD):
+    # One bool per 1 / rate seconds, True where someone is speaking. The threshold sits `threshold` of the way from the
+    # noise floor (10th percentile) to the speech level (90th percentile) in dB, so it follows the recording's levels.
+    import numpy as np
+
+    levels = frame_rms(path, rate)
+    if not len(levels):
+        return np.zeros(0, dtype=bool)
+    db = 20.0 * np.log10(levels.astype(np.float64) + 1e-9)
+    floor, speech = np.percentile(db, [10, 90])
+    return db > floor + (speech - floor) * threshold
+
+
+def find_pauses(speech, rate=VAD_RATE, min_silence=MIN_SILENCE):
+    # (start, end) seconds of every run of non speech at least min_silence long, as an (n x 2) array
+    import numpy as np
+
+    edges = np.diff(np.concatenate(([0], (~speech).astype(np.int8), [0])))
+    starts = np.nonzero(edges == 1)[0]
+    ends = np.nonzero(edges == -1)[0]
+    keep = (ends - starts) >= min_silence * rate
+    return np.column_stack((starts[keep], ends[keep])) / float(rate)
+
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in SENTENCE_END.split(text) if sentence and sentence.strip()]
+
+
+def text_weight(sentence):
+    # Letters and characters, a rough stand in for how long a sentence takes to say
+    return max(len(re.sub(r"[\W_]", "", sentence)), 1)
+
+
+def plan_segments(speech, sentences, rate=VAD_RATE, min_silence=MIN_SILENCE, min_segment=MIN_SEGMENT,
+                  tolerance=CUT_TOLERANCE):
+    # Returns [(start, end, text)] covering the whole clip. Each sentence boundary is expected where its share of the
+    # text falls on the speech only timeline, the cut goes at the longest pause within tolerance seconds of it.
+    # Boundaries that would leave a segment shorter than min_segment, or have no pause near them, are not cut.
+    import numpy as np
+
+    duration = len(speech) / float(rate)
+    if len(sentences) < 2 or duration < 2 * min_segment:
+        return [(0.0, duration, " ".join(sentences))]
+
+    pauses = find_pauses(speech, rate, min_silence)
+    centers = pauses.mean(axis=1) if len(pauses) else np.zeros(0)
+    lengths = pauses[:, 1] - pauses[:, 0] if len(pauses) else np.zeros(0)
+    # Seconds of speech before every VAD frame, to turn a share of the text into a time
+    speech_time = np.cumsum(speech) / float(rate)
+    weights = np.cumsum([text_weight(sentence) for sentence in sentences], dtype=np.float64)
+    weights /= weights[-1]
+    targets = np.searchsorted(speech_time, weights[:-1] * speech_time[-1]) / float(rate)
+
+    segments = []
+    start = 0.0
+    first_sentence = 0
+    for boundary, target in enumerate(targets, 1):
+        near = np.nonzero((np.abs(centers - target) <= tolerance) & (centers - start >= min_segment) &
+                          (duration - centers >= min_segment / 2.0))[0]
+        if not len(near):
+            continue
+        cut = float(centers[near[np.argmax(lengths[near])]])
+        segments.append((start, cut, " ".join(sentences[first_sentence:boundary])))
+        start = cut
+        first_sentence = boundary
+    segments.append((start, duration, " ".join(sentences[first_sentence:])))
+    return segments
+
+
+def segment_folder(folder, segment):
+    # MFA 1.x and 3.x take the speaker from the folder and hand out work by speaker, a flat corpus is one job
+    path = os.path.join(folder, segment.name)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def write_segment_wavs(source_path, segments, folder):
+    # Cuts the conditioned 16-bit mono source into one wav per segment, reading only the frames of each
+    with wave.open(source_path, "rb") as source:
+        rate = source.getframerate()
+        frame_total = source.getnframes()
+        for segment in segments:
+            first = min(int(round(segment.start * rate)), frame_total)
+            last = min(int(round(segment.end * rate)), frame_total)
+            source.setpos(first)
+            with wave.open(os.path.join(segment_folder(folder, segment), segment.name + ".wav"), "wb") as target:
+                target.setnchannels(source.getnchannels())
+                target.setsampwidth(source.getsampwidth())
+                target.setframerate(rate)
+                target.writeframes(source.readframes(last - first))
+
+
+def write_segments(source_path, segments, folder):
+    # A wav/txt pair per segment in a subfolder of folder, which becomes the MFA corpus
+    with tracer.span("split audio", segments=len(segments)):
+        write_segment_wavs(source_path, segments, folder)
+    for segment in segments:
+        with open(os.path.join(segment_folder(folder, segment), segment.name + ".txt"), "w", encoding="utf-8") as f:
+            f.write(segment.text)
+    tracer.count("segments", len(segments))
+
+
+@contextmanager
+def conditioned_source(sound_path, folder, name):
+    # The whole clip as a 16 kHz mono file next to folder, deleted again when the segments are cut
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    source_path = os.path.join(os.path.dirname(os.path.abspath(folder)), name + "_source.wav")
+    try:
+        with tracer.span("condition audio"):
+            condition_wav(sound_path, source_path)
+        yield source_path
+    except ImportError:
+        raise LongAudioError("Splitting audio needs numpy")
+    except (OSError, AudioError, wave.Error) as e:
+        raise LongAudioError("Can't split {}: {}".format(sound_path, e))
+    finally:
+        if os.path.exists(source_path):
+            os.remove(source_path)
+
+
+def stage_spans(sound_path, segments, folder):
+    # Stages already planned Segments of the clip, e.g. the edited spans of a transcript (see incremental)
+    name = os.path.splitext(os.path.basename(sound_path))[0]
+    with conditioned_source(sound_path, folder, name) as source_path:
+        write_segments(source_path, segments, folder)
+    return segments
+
+
+def stage_segments(sound_path, transcript, folder, name=None, min_segment=MIN_SEGMENT):
+    # Stages the clip as segment wav/txt pairs for one MFA corpus and returns the Segments
+    name = name or os.path.splitext(os.path.basename(sound_path))[0]
+    with conditioned_source(sound_path, folder, name) as source_path:
+        with tracer.span("vad"):
+            speech = detect_speech(source_path)
+        # The VAD frames cover the whole clip, the last segment ends at the real length
+        info = read_wav_header(source_path)
+        duration = info.frame_count / float(info.sample_rate)
+        spans = plan_segments(speech, split_sentences(transcript), min_segment=min_segment)
+        spans[-1] = (spans[-1][0], max(spans[-1][1], duration), spans[-1][2])
+        segments = [Segment("{}_seg{:03d}".format(name, index), start, end, text) for index, (start, end, text) in enumerate(spans)]
+        write_segments(source_path, segments, folder)
+    print("Split {} into {} segments: {}".format(os.path.basename(sound_path), len(segments),
+                                                 ", ".join("{:.1f}-{:.1f}s".format(s.start, s.end) for s in segments)))
+    return segments
+
+
+def offset_tier(tier, target, offset, start, end):
+    # Appends the intervals of a segment's tier to target, shifted by offset and clipped to [start, end]
+    for interval_start, interval_end, label in tier:
+        interval_start = min(max(interval_start + offset, start), end)
+        interval_end = min(interval_end + offset, end)
+        if interval_end > interval_start:
+            target.append(interval_start, interval_end, label)
+
+
+def fill_gap(tier, end):
+    # Rest from the end of the tier up to end
+    last = tier.ends[-1] if len(tier) else 0.0
+    if end - last > 1e-6:
+        tier.append(last, end, "")
+
+
+def stitch_segments(segments, textgrid_files, target_path):
+    # textgrid_files maps segment names to their TextGrid (see lip_sync_core.find_textgrid_files). Writes one TextGrid
+    # with the words and phones of all segments at their place in the clip and returns the names of failed segments.
+    words = IntervalTier("words")
+    phones = IntervalTier("phones")
+    failed = []
+    with tracer.span("stitch", segments=len(segments)):
+        for segment in segments:
+            textgrid_path = textgrid_files.get(segment.name)
+            try:
+                if not textgrid_path:
+                    raise TextGridError("MFA produced no TextGrid")
+                segment_phones = read_tier(textgrid_path, "phones")
+                segment_words = read_tier(textgrid_path, "words")
+            except (OSError, TextGridError) as e:
+                print("[ERROR] Segment {} ({:.1f}-{:.1f}s) was not aligned: {}".format(segment.name, segment.start, segment.end, e))
+                failed.append(segment.name)
+                continue
+            for tier, segment_tier in ((words, segment_words), (phones, segment_phones)):
+                fill_gap(tier, segment.start)
+                offset_tier(segment_tier, tier, segment.start, segment.start, segment.end)
+        end = segments[-1].end if segments else 0.0
+        fill_gap(words, end)
+        fill_gap(phones, end)
+        write_textgrid(target_path, [words, phones], end)
+    if len(failed) == len(segments):
+        raise LongAudioError("MFA could not align any segment of the clip")
+    return failed
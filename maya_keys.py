@@ -0,0 +1,264 @@
+'''
+Name: maya_keys
+
+Description: Bulk keyframe writer. The whole (time, value) series of an attribute is written to its anim curve in a
+single setAttr on the keyTimeValue array and the tangents are set once per curve, instead of one setAttr, setKeyframe
+and keyTangent call per interval. With re-key windows (see incremental) only the keys inside the windows are replaced
+and the rest of every curve is left alone. Also holds the Maya side of saving and loading poses.
+'''
+import os
+import json
+import bisect
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from maya import cmds, mel
+
+from . import lip_sync_core
+from . import blending
+from .pose_library import (pose_cache, analyze_poses, pose_exists, pose_from_data, save_library_pose, split_pose_reference,
+                           NamespacedPoses)
+from .tracing import tracer
+
+CURVE_TYPES = {"doubleLinear": "animCurveTL", "doubleAngle": "animCurveTA", "time": "animCurveTT"}
+KEY_TOLERANCE = 1e-4
+
+
+@contextmanager
+def keying_chunk(chunk_name="autoLipSync"):
+    # One undo step for the whole pass and no viewport redraw while the curves are written
+    cmds.undoInfo(openChunk=True, chunkName=chunk_name)
+    cmds.refresh(suspend=True)
+    try:
+        yield
+    finally:
+        cmds.refresh(suspend=False)
+        cmds.undoInfo(closeChunk=True)
+
+
+def save_pose(pose_path, controls):
+    # Stores every keyable, unlocked attribute of the controls, see pose_library.parse_pose for the format.
+    # A "<library>#<name>" pose_path adds the pose to that library file instead.
+    controller_dict = OrderedDict()
+    for ctrl in controls:
+        attr_dict = OrderedDict()
+        for attr in cmds.listAttr(ctrl, keyable=True, unlocked=True) or []:
+            attr_dict[attr] = cmds.getAttr(ctrl+"."+attr)
+        controller_dict[ctrl] = attr_dict
+
+    if split_pose_reference(pose_path)[1] is not None:
+        save_library_pose(pose_path, pose_from_data(pose_path, controller_dict))
+        pose_cache.invalidate(pose_path)
+        return
+
+    with open(pose_path, "w", encoding='utf-8') as jsonFile:
+        json.dump(controller_dict, jsonFile, indent=4, ensure_ascii=False)
+    pose_cache.invalidate(pose_path)
+
+
+def load_pose(pose_path):
+    pose = pose_cache.get(pose_path)
+    for name, value in zip(pose.names, pose.values):
+        cmds.setAttr(name, value)
+    return pose
+
+
+def import_sound(sound_path, name="SoundFile"):
+    # Returns the audio node playing sound_path, imported only if the scene doesn't have one yet
+    target = os.path.normcase(os.path.abspath(sound_path))
+    for node in cmds.ls(type="audio") or []:
+        if os.path.normcase(os.path.abspath(cmds.getAttr(node + ".filename"))) == target:
+            return node
+    return cmds.sound(file=sound_path, name=name)
+
+
+def get_fps():
+    return mel.eval("currentTimeUnitToFPS()")
+
+
+def write_curve(attr, times, values, fps, tangent="spline", merge=False):
+    # times are in seconds, the keyTimeValue array wants frames in the current time unit. merge pastes the keys into an
+    # existing curve without removing any, see write_window.
+    count = len(times)
+    if not count:
+        return None
+
+    sources = cmds.listConnections(attr, source=True, destination=False, plugs=False) or []
+    existing = cmds.listConnections(attr, source=True, destination=False, type="animCurve") or []
+    if sources and not existing:
+        cmds.warning("Skipping {}, it is driven by {}".format(attr, sources[0]))
+        return None
+
+    flat = []
+    for time, value in zip(times, values):
+        flat.append(time * fps)
+        flat.append(value)
+
+    curve_type = CURVE_TYPES.get(cmds.getAttr(attr, type=True), "animCurveTU")
+    curve = cmds.createNode(curve_type, name=attr.replace(".", "_"), skipSelect=True)
+    cmds.setAttr("{}.ktv[0:{}]".format(curve, count - 1), *flat, size=count)
+    cmds.keyTangent(curve, inTangentType=tangent, outTangentType=tangent)
+
+    if not existing:
+        cmds.connectAttr(curve+".output", attr)
+        return curve
+
+    # The attribute is already animated: replace its keys inside the clip range and leave the rest of the curve alone
+    frame_range = (flat[0], flat[-2])
+    cmds.copyKey(curve)
+    if merge:
+        cmds.pasteKey(attr, option="merge", time=(flat[0], flat[0]))
+    else:
+        cmds.pasteKey(attr, option="replace", time=frame_range)
+    cmds.delete(curve)
+    return existing[0]
+
+
+def set_static_values(static):
+    # Attributes that are the same in every pose are set once instead of keyed. Animated or driven ones are left alone.
+    count = 0
+    for name, value in static.items():
+        if cmds.listConnections(name, source=True, destination=False):
+            continue
+        try:
+            cmds.setAttr(name, value)
+            count += 1
+        except RuntimeError:
+            cmds.warning("Could not set {}".format(name))
+    return count
+
+
+def write_window(attr, times, values, fps, window, tangent="spline"):
+    # Clears the keys of attr inside the (start, end) seconds window and keys the part of the series inside it
+    first = bisect.bisect_left(times, window[0] - 1e-9)
+    last = bisect.bisect_right(times, window[1] + 1e-9)
+    existing = cmds.listConnections(attr, source=True, destination=False, type="animCurve")
+    if existing:
+        cmds.cutKey(attr, time=(window[0] * fps, window[1] * fps), clear=True)
+    if write_curve(attr, times[first:last], values[first:last], fps, tangent, merge=bool(existing)):
+        return last - first
+    return 0
+
+
+def write_curves(curves, tangent="spline", windows=None):
+    # curves is an OrderedDict of "control.attr" -> (times, values) as built by lip_sync_core.compute_attribute_curves.
+    # With windows only the keys inside those (start, end) seconds are written.
+    fps = get_fps()
+    key_count = 0
+    for attr, (times, values) in curves.items():
+        if windows is not None:
+            key_count += sum(write_window(attr, times, values, fps, window, tangent) for window in windows)
+        elif write_curve(attr, times, values, fps, tangent):
+            key_count += len(times)
+    return key_count
+
+
+def apply_keyframe_plan(keys, envelope=None, blend=None, windows=None):
+    # Keys a plan (see lip_sync_core.compute_keyframe_plan) onto the rig and returns the written curves.
+    # envelope is the plan's optional loudness entry (see lip_sync_core.envelope_plan), it overrides the poses on its attr.
+    # blend holds the coarticulation timings (see blending.default_blend_settings), without it every pose is held hard.
+    # windows limits the keying to those (start, end) seconds, see lip_sync_core.align_incremental.
+    parse_count = pose_cache.parse_count
+    curves, pose_paths, keep = plan_curves(keys, pose_cache.get, envelope, blend)
+    curves = key_curves(curves, pose_paths, keep, windows)
+    tracer.count("poses loaded", pose_cache.parse_count - parse_count)
+    print(f"[DEBUG] {pose_cache.parse_count - parse_count} pose files parsed")
+    return curves
+
+
+def apply_scene(rigs, blend=None):
+    # Keys several characters in one pass and one undo step. rigs is a list of (namespace, keys), the poses of every
+    # plan are remapped onto the controls in its namespace (see pose_library.NamespacedPoses). Returns the written
+    # curves of every rig in one OrderedDict.
+    parse_count = pose_cache.parse_count
+    poses = NamespacedPoses(pose_cache)
+    prepared = []
+    for namespace, keys in rigs:
+        get_pose = poses.getter(namespace)
+        curves, pose_paths, keep = plan_curves(keys, get_pose, blend=blend)
+        prepared.append((namespace, reduce_pose_curves(curves, pose_paths, get_pose, keep)))
+
+    written = OrderedDict()
+    set_count = key_count = 0
+    with tracer.span("write keys", rigs=len(rigs)), keying_chunk("autoLipSyncScene"):
+        for namespace, (curves, static, stats) in prepared:
+            set_count += set_static_values(static)
+            rig_keys = write_curves(curves)
+            key_count += rig_keys
+            written.update(curves)
+            print(f"[DEBUG] {namespace or 'root namespace'}: {rig_keys} keys on {len(curves)} curves")
+    tracer.count("keys set", key_count)
+    tracer.count("attributes set", set_count)
+    tracer.count("poses loaded", pose_cache.parse_count - parse_count)
+    print(f"[DEBUG] Keyed {len(rigs)} rigs ({key_count} keys, {pose_cache.parse_count - parse_count} pose files parsed)")
+    return written
+
+
+def plan_curves(keys, get_pose, envelope=None, blend=None):
+    # Returns the (curves, pose paths, attributes to keep) of a plan's keys, see apply_keyframe_plan.
+    # Check every pose file once instead of once per interval
+    pose_found = {}
+    valid_keys = []
+    for key in keys:
+        pose_path = key["pose"]
+        if pose_path and pose_path not in pose_found:
+            pose_found[pose_path] = pose_exists(pose_path)
+        if pose_path and pose_found[pose_path]:
+            valid_keys.append(key)
+
+    missing = [path for path, exists in pose_found.items() if not exists]
+    if missing:
+        print(f"[ERROR] Pose files not found: {', '.join(missing)}")
+    if len(valid_keys) < len(keys):
+        print(f"[DEBUG] Skipped {len(keys) - len(valid_keys)} of {len(keys)} intervals without a valid pose")
+
+    with tracer.span("curves", blend=bool(blend)):
+        if blend:
+            curves = blending.compute_blended_curves(valid_keys, get_pose, get_fps(), **blend)
+        else:
+            curves = lip_sync_core.compute_attribute_curves(valid_keys, get_pose)
+    keep = []
+    if envelope and envelope.get("attr"):
+        curves[envelope["attr"]] = lip_sync_core.compute_envelope_curve(envelope)
+        keep.append(envelope["attr"])
+    return curves, [key["pose"] for key in valid_keys], keep
+
+
+def apply_track(track, viseme_pose_paths):
+    # Keys a viseme track (see tracks.read_track) with viseme_pose_paths mapping its visemes to pose files
+    from . import tracks
+    posed = OrderedDict((viseme, viseme_pose_paths.get(viseme)) for viseme in track.visemes)
+    posed = OrderedDict((viseme, path) for viseme, path in posed.items() if path and pose_exists(path))
+    missing = [viseme for viseme in track.visemes if viseme not in posed]
+    if missing:
+        print(f"[WARNING] Visemes without a pose file: {', '.join(missing)}")
+    return key_curves(tracks.track_curves(track, posed, pose_cache.get), list(posed.values()))
+
+
+def reduce_pose_curves(curves, pose_paths, get_pose, keep=()):
+    # Returns (curves, static, stats): the curves without the attributes that are the same in every pose, which are
+    # in static with their value, and with flat stretches thinned out
+    with tracer.span("reduce keys"):
+        varying, static = analyze_poses(pose_paths, get_pose, KEY_TOLERANCE)
+        for name in keep:
+            static.pop(name, None)
+        curves, stats = lip_sync_core.reduce_curves(curves, static, KEY_TOLERANCE)
+    return curves, static, stats
+
+
+def key_curves(curves, pose_paths, keep=(), windows=None):
+    # Writes curves in one undo chunk. Only what changes between the poses is keyed, attributes that are the same in
+    # every pose are set once and flat stretches are thinned out. keep lists attributes that aren't pose driven.
+    # windows, if given, are the only (start, end) seconds whose keys are replaced.
+    curves, static, stats = reduce_pose_curves(curves, pose_paths, pose_cache.get, keep)
+    with tracer.span("write keys", curves=len(curves)), keying_chunk():
+        set_count = set_static_values(static)
+        key_count = write_curves(curves, windows=windows)
+    tracer.count("keys set", key_count)
+    tracer.count("attributes set", set_count)
+    if windows is not None:
+        print(f"[DEBUG] Re-keyed {len(windows)} edited spans: {', '.join('{:.2f}-{:.2f}s'.format(*window) for window in windows)}")
+    print(f"[DEBUG] Finished creating keyframes ({key_count} keys on {len(curves)} curves)")
+    print(f"[DEBUG] Avoided {stats['static_curves']} static curves ({set_count} attributes set once) and "
+          f"{stats['dropped_keys']} of {stats['keys']} keys")
+    return curves
@@ -0,0 +1,171 @@
+'''
+Name: mfa_runner
+
+Description: Runs an MFA command without blocking on its output. stdout and stderr are read concurrently on two
+reader threads, MFA's stage messages are turned into a progress percentage and the whole process tree can be killed.
+cancel_on_terminate makes a command line run cancel its MFA runs when it is terminated, MFA runs in a session of its
+own and would outlive it otherwise.
+'''
+import os
+import sys
+import queue
+import signal
+import subprocess
+import threading
+
+# Substrings of the stage messages printed by MFA 1.x and 3.x and how far along the run is when they show up
+MFA_STAGES = (
+    ("setting up corpus", 5),
+    ("loading corpus", 8),
+    ("creating dictionary", 10),
+    ("normalizing text", 12),
+    ("mfcc", 20),
+    ("cmvn", 30),
+    ("final features", 35),
+    ("done with setup", 40),
+    ("compiling training graphs", 45),
+    ("first-pass alignment", 55),
+    ("fmllr", 70),
+    ("second-pass alignment", 80),
+    ("collecting phone and word alignments", 88),
+    ("exporting", 92),
+    ("done!", 100),
+)
+# Seconds a cancelled MFA run gets to exit on SIGTERM before what is left of it is killed
+STOP_GRACE = 10.0
+
+
+def parse_mfa_progress(line, current=0):
+    # Progress never goes backwards, MFA repeats some messages (e.g. feature generation) in later stages
+    lowered = line.lower()
+    for pattern, percent in MFA_STAGES:
+        if percent > current and pattern in lowered:
+            current = percent
+    return current
+
+
+# The MfaProcesses of this process that haven't been waited for
+running_processes = set()
+running_lock = threading.Lock()
+
+
+def new_session_kwargs():
+    # Popen arguments that start a process in a new process group/session, so stop_process_tree reaches its children
+    if os.name == "nt":
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {"start_new_session": True}
+
+
+def stop_process_tree(process, force=False):
+    # process was started with new_session_kwargs. Without force its group gets SIGTERM and can clean up.
+    if process.poll() is not None:
+        return
+    try:
+        if os.name == "nt":
+            subprocess.call(["taskkill", "/F", "/T", "/PID", str(process.pid)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(process.pid, signal.SIGKILL if force else signal.SIGTERM)
+    except OSError:
+        process.kill()
+
+
+def cancel_running():
+    with running_lock:
+        processes = list(running_processes)
+    for mfa_process in processes:
+        mfa_process.cancel(wait=True)
+
+
+def cancel_on_terminate():
+    # SIGTERM cancels the running MFA processes and exits, only possible from the main thread
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    def terminate(signum, frame):
+        cancel_running()
+        sys.exit(128 + signum)
+    signal.signal(signal.SIGTERM, terminate)
+
+
+def mfa_stage_name(progress):
+    # The stage message that brought a run to this progress, for naming trace spans
+    for pattern, percent in MFA_STAGES:
+        if percent == progress:
+            return pattern
+    return "starting"
+
+
+class MfaProcess(object):
+
+    def __init__(self, command, env=None):
+        self.command = command
+        self.env = env
+        self.process = None
+        self.progress = 0
+        self.cancelled = False
+        self._lines = queue.Queue()
+        self._lock = threading.Lock()
+
+    def start(self):
+        # A new process group/session so cancel() can take down the workers MFA spawns as well. A run cancelled
+        # before it started is never started, cancel() holds the lock while it checks for a process to stop.
+        with self._lock:
+            if self.cancelled:
+                return self
+            self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env,
+                                            **new_session_kwargs())
+        with running_lock:
+            running_processes.add(self)
+        for name, stream in (("stdout", self.process.stdout), ("stderr", self.process.stderr)):
+            reader = threading.Thread(target=self._read_stream, args=(name, stream))
+            reader.daemon = True
+            reader.start()
+        return self
+
+    def _read_stream(self, name, stream):
+        for raw_line in iter(stream.readline, b""):
+            self._lines.put((name, raw_line.decode("utf-8", "replace").rstrip()))
+        stream.close()
+        self._lines.put((name, None))
+
+    def lines(self):
+        # Yields (stream name, line) as they arrive on either stream until both are closed
+        open_streams = 2 if self.process is not None else 0
+        while open_streams:
+            name, line = self._lines.get()
+            if line is None:
+                open_streams -= 1
+            elif line:
+                self.progress = parse_mfa_progress(line, self.progress)
+                yield name, line
+
+    def wait(self):
+        if self.process is None:
+            # Cancelled before it started, fails like a run stopped by SIGTERM
+            return -signal.SIGTERM
+        return_code = self.process.wait()
+        with running_lock:
+            running_processes.discard(self)
+        return return_code
+
+    def cancel(self, wait=False):
+        # SIGTERM first so MFA can clean up, whatever is left of its tree after STOP_GRACE is killed. The grace period
+        # runs on a thread of its own unless wait is set, cancelling from the UI doesn't block it.
+        with self._lock:
+            self.cancelled = True
+            process = self.process
+        if process is None:
+            return
+        stop_process_tree(process)
+        stopper = threading.Thread(target=self._stop, args=(process,))
+        stopper.daemon = True
+        stopper.start()
+        if wait:
+            stopper.join()
+
+    def _stop(self, process):
+        try:
+            process.wait(STOP_GRACE)
+        except subprocess.TimeoutExpired:
+            stop_process_tree(process, force=True)
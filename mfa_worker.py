@@ -0,0 +1,407 @@
+'''
+Name: mfa_worker
+
+Description: Optional long lived MFA 3.x worker. The worker runs in MFA's own python, imports MFA and loads the
+acoustic model and the lexicon once, and then takes alignment jobs over a local socket until it has been idle for a
+while. This saves the interpreter start, the MFA import and the model/lexicon setup that "mfa align" pays on every run.
+
+The worker side only uses the standard library and MFA, so this file is started as a plain script:
+
+python.exe mfa_worker.py --lexicon mandarin_china_mfa3.0.0.dict --model "mandarin_mfa v3.0.0.zip" --state-file worker.json
+
+The worker's port and connection key are kept in a state file in a folder only the user can open
+($XDG_RUNTIME_DIR/auto_lip_sync, or mfa_worker in the scripts folder). Clients refuse a state file or folder that is
+not private to them, anyone with the key could make the worker run code.
+
+--backend stub swaps MFA for a stand-in aligner that returns a single silence interval, for testing without MFA.
+The client side (WarmAligner, WarmAlignJob) is used by lip_sync_core when the warm worker is switched on.
+'''
+import os
+import sys
+import json
+import time
+import wave
+import queue
+import socket
+import hashlib
+import argparse
+import threading
+import subprocess
+from multiprocessing.connection import Listener, Client
+
+DEFAULT_IDLE_TIMEOUT = 15 * 60
+STARTUP_TIMEOUT = 300
+
+TEXTGRID_TEMPLATE = u'''File type = "ooTextFile"
+Object class = "TextGrid"
+
+xmin = 0
+xmax = {duration}
+tiers? <exists>
+size = 2
+item []:
+    item [1]:
+        class = "IntervalTier"
+        name = "words"
+        xmin = 0
+        xmax = {duration}
+        intervals: size = 1
+        intervals [1]:
+            xmin = 0
+            xmax = {duration}
+            text = ""
+    item [2]:
+        class = "IntervalTier"
+        name = "phones"
+        xmin = 0
+        xmax = {duration}
+        intervals: size = 1
+        intervals [1]:
+            xmin = 0
+            xmax = {duration}
+            text = "sil"
+'''
+
+
+class StubBackend(object):
+    # Stand-in aligner: one silence interval over the whole clip
+
+    def __init__(self, lexicon, model):
+        self.lexicon = lexicon
+        self.model = model
+
+    def align(self, sound_path, text_path, output_path):
+        with wave.open(sound_path, "rb") as wav_file:
+            duration = wav_file.getnframes() / float(wav_file.getframerate())
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(TEXTGRID_TEMPLATE.format(duration=duration))
+
+
+class MfaBackend(object):
+    # Does the setup of MFA's align_one command once: the acoustic model is loaded, the lexicon compiled into its FSTs
+    # and the tokenizer built here. A job then only reads its clip, computes the features and aligns the utterances.
+
+    def __init__(self, lexicon, model):
+        from kalpy.fstext.lexicon import LexiconCompiler
+        from montreal_forced_aligner.command_line.utils import validate_model_arg
+        from montreal_forced_aligner.data import Language
+        from montreal_forced_aligner.dictionary.mixins import (DEFAULT_BRACKETS, DEFAULT_CLITIC_MARKERS,
+                                                               DEFAULT_COMPOUND_MARKERS, DEFAULT_PUNCTUATION,
+                                                               DEFAULT_WORD_BREAK_MARKERS)
+        from montreal_forced_aligner.models import AcousticModel
+        from montreal_forced_aligner.tokenization.simple import SimpleTokenizer
+        from montreal_forced_aligner.tokenization.spacy import generate_language_tokenizer
+        self.lexicon = lexicon
+        self.model = model
+        self.acoustic_model = AcousticModel(validate_model_arg(model, "acoustic"))
+        parameters = self.acoustic_model.parameters
+        self.lexicon_compiler = LexiconCompiler(
+            disambiguation=False,
+            silence_probability=parameters["silence_probability"],
+            initial_silence_probability=parameters["initial_silence_probability"],
+            final_silence_correction=parameters["final_silence_correction"],
+            final_non_silence_correction=parameters["final_non_silence_correction"],
+            silence_phone=parameters["optional_silence_phone"],
+            oov_phone=parameters["oov_phone"],
+            position_dependent_phones=parameters["position_dependent_phones"],
+            phones=parameters["non_silence_phones"],
+            ignore_case=True,
+        )
+        self.lexicon_compiler.load_pronunciations(validate_model_arg(lexicon, "dictionary"))
+        # Compile both FSTs now, the pronunciation list isn't needed after that
+        self.lexicon_compiler.fst
+        self.lexicon_compiler.align_fst
+        self.lexicon_compiler.clear()
+        if self.acoustic_model.language is Language.unknown:
+            self.tokenizer = SimpleTokenizer(DEFAULT_WORD_BREAK_MARKERS, DEFAULT_PUNCTUATION, DEFAULT_CLITIC_MARKERS,
+                                             DEFAULT_COMPOUND_MARKERS, DEFAULT_BRACKETS, ignore_case=True,
+                                             word_table=self.lexicon_compiler.word_table)
+        else:
+            self.tokenizer = generate_language_tokenizer(self.acoustic_model.language)
+
+    def align(self, sound_path, text_path, output_path):
+        from pathlib import Path
+        from kalpy.feat.cmvn import CmvnComputer
+        from kalpy.fstext.lexicon import HierarchicalCtm
+        from kalpy.utterance import Segment, Utterance
+        from montreal_forced_aligner.corpus.classes import FileData
+        from montreal_forced_aligner.online.alignment import align_utterance_online
+
+        file = FileData.parse_file(os.path.splitext(os.path.basename(sound_path))[0], sound_path, text_path, "", 0)
+        utterances = []
+        for utterance in file.utterances:
+            utt = Utterance(Segment(sound_path, utterance.begin, utterance.end, utterance.channel), utterance.text)
+            utt.generate_mfccs(self.acoustic_model.mfcc_computer)
+            utterances.append(utt)
+        cmvn = CmvnComputer().compute_cmvn_from_features([utt.mfccs for utt in utterances])
+        file_ctm = HierarchicalCtm([])
+        for utt in utterances:
+            utt.apply_cmvn(cmvn)
+            ctm = align_utterance_online(self.acoustic_model, utt, self.lexicon_compiler, tokenizer=self.tokenizer)
+            file_ctm.word_intervals.extend(ctm.word_intervals)
+        file_ctm.export_textgrid(Path(output_path), file_duration=file.wav_info.duration, output_format="long_textgrid")
+
+
+BACKENDS = {"mfa": MfaBackend, "stub": StubBackend}
+
+
+def default_state_folder():
+    # Per user and private, the state file holds the key that lets a client send the worker pickles
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "auto_lip_sync")
+    from .lip_sync_core import USER_SCRIPT_DIR
+    return os.path.join(USER_SCRIPT_DIR, "mfa_worker")
+
+
+def check_private(path):
+    # Refuses a state file or folder that another user owns or could have written or read
+    if os.name == "nt":
+        # The state folder is in the user's profile, which other users can't open
+        return
+    info = os.stat(path)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise RuntimeError("{} is not private to this user, not using the MFA worker state in it".format(path))
+
+
+def write_state(state_path, state):
+    # The file is created readable by this user only before the key is written into it
+    temp_path = state_path + ".tmp"
+    try:
+        os.remove(temp_path)
+    except OSError:
+        pass
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(temp_path, state_path)
+
+
+def serve(backend, state_path, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    authkey = os.urandom(16)
+    listener = Listener(("127.0.0.1", 0), authkey=authkey)
+    write_state(state_path, {"pid": os.getpid(), "port": listener.address[1], "authkey": authkey.hex(),
+                             "lexicon": backend.lexicon, "model": backend.model})
+    activity = {"last": time.time(), "busy": False, "stopping": False}
+
+    # accept() can't be interrupted from another thread, so the watchdog wakes it up with a dummy connection
+    def watchdog():
+        while True:
+            time.sleep(min(5, idle_timeout))
+            if not activity["busy"] and time.time() - activity["last"] > idle_timeout:
+                activity["stopping"] = True
+                socket.create_connection(listener.address).close()
+                return
+    watchdog_thread = threading.Thread(target=watchdog)
+    watchdog_thread.daemon = True
+    watchdog_thread.start()
+
+    running = True
+    while running:
+        try:
+            conn = listener.accept()
+        except Exception:
+            # Failed handshake from the watchdog or from something that isn't our client
+            if activity["stopping"]:
+                break
+            continue
+        with conn:
+            while running:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    break
+                activity["busy"] = True
+                try:
+                    if request.get("cmd") == "align":
+                        backend.align(request["sound"], request["text"], request["output"])
+                        conn.send({"ok": True})
+                    elif request.get("cmd") == "shutdown":
+                        conn.send({"ok": True})
+                        running = False
+                    else:
+                        conn.send({"ok": True, "pid": os.getpid()})
+                except Exception as e:
+                    conn.send({"ok": False, "error": "{}: {}".format(type(e).__name__, e)})
+                finally:
+                    activity["busy"] = False
+                    activity["last"] = time.time()
+
+    listener.close()
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            if json.load(f).get("pid") == os.getpid():
+                os.remove(state_path)
+    except (OSError, ValueError):
+        pass
+
+
+class WarmAligner(object):
+    # Client side. Connects to the worker for these settings and starts one if none is running.
+
+    def __init__(self, settings, state_folder=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, backend="mfa"):
+        if settings["mfa_version"].startswith("v1"):
+            raise ValueError("The warm MFA worker needs MFA 3.x, this language uses MFA {}".format(settings["mfa_version"]))
+        self.settings = settings
+        self.idle_timeout = idle_timeout
+        self.backend = backend
+        self.state_folder = state_folder or default_state_folder()
+        worker_id = hashlib.sha1("|".join((settings["mfa_path"], settings["lexicon"], settings["model"], backend)).encode("utf-8")).hexdigest()[:12]
+        self.state_path = os.path.join(self.state_folder, "auto_lip_sync_mfa_worker_{}.json".format(worker_id))
+        self.log_path = os.path.splitext(self.state_path)[0] + ".log"
+        self.conn = None
+
+    def try_connect(self):
+        for path in (self.state_folder, self.state_path):
+            if os.path.exists(path):
+                check_private(path)
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            conn = Client(("127.0.0.1", state["port"]), authkey=bytes.fromhex(state["authkey"]))
+            conn.send({"cmd": "ping"})
+            conn.recv()
+        except (OSError, ValueError, KeyError, EOFError):
+            return None
+        return conn
+
+    def start_worker(self):
+        from .lip_sync_core import build_mfa_command
+        if not os.path.exists(self.state_folder):
+            os.makedirs(self.state_folder, mode=0o700)
+        check_private(self.state_folder)
+        command, env = build_mfa_command(self.settings, "", "")
+        command = [command[0], os.path.abspath(__file__), "--lexicon", self.settings["lexicon"], "--model", self.settings["model"],
+                   "--state-file", self.state_path, "--idle-timeout", str(self.idle_timeout), "--backend", self.backend]
+        if os.name == "nt":
+            kwargs = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP | 0x00000008}  # DETACHED_PROCESS
+        else:
+            kwargs = {"start_new_session": True}
+        with open(self.log_path, "ab") as log_file:
+            return subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, env=env, **kwargs)
+
+    def connect(self, on_line=None):
+        if self.conn is not None:
+            return self.conn
+        self.conn = self.try_connect()
+        if self.conn is not None:
+            return self.conn
+
+        if on_line:
+            on_line("Starting warm MFA worker, loading the acoustic model and lexicon...")
+        process = self.start_worker()
+        deadline = time.time() + STARTUP_TIMEOUT
+        while time.time() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("The MFA worker exited during startup, see {}".format(self.log_path))
+            self.conn = self.try_connect()
+            if self.conn is not None:
+                return self.conn
+            time.sleep(0.25)
+        process.kill()
+        raise RuntimeError("The MFA worker did not start within {} seconds, see {}".format(STARTUP_TIMEOUT, self.log_path))
+
+    def request(self, message):
+        conn = self.connect()
+        try:
+            conn.send(message)
+            reply = conn.recv()
+        except (OSError, EOFError):
+            self.conn = None
+            raise RuntimeError("Lost the connection to the MFA worker, see {}".format(self.log_path))
+        if not reply.get("ok"):
+            raise RuntimeError(reply.get("error", "MFA worker error"))
+        return reply
+
+    def align(self, sound_path, text_path, output_path):
+        return self.request({"cmd": "align", "sound": os.path.abspath(sound_path), "text": os.path.abspath(text_path),
+                             "output": os.path.abspath(output_path)})
+
+    def shutdown(self):
+        # The worker serves one connection at a time, so this reuses our connection instead of opening a new one
+        if self.conn is None:
+            self.conn = self.try_connect()
+        if self.conn is not None:
+            self.request({"cmd": "shutdown"})
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class WarmAlignJob(object):
+    # Same interface as mfa_runner.MfaProcess (start, lines, wait, cancel), but aligns every wav/txt pair of the
+    # input folder through the warm worker and writes <name>.TextGrid files to the output folder.
+
+    def __init__(self, warm_aligner, input_folder, output_folder):
+        self.warm_aligner = warm_aligner
+        self.input_folder = input_folder
+        self.output_folder = output_folder
+        self.progress = 0
+        self.cancelled = False
+        self.return_code = None
+        self._lines = queue.Queue()
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self.warm_aligner.connect(lambda line: self._lines.put(line))
+            clips = []
+            for root, dirs, files in os.walk(self.input_folder):
+                clips += [os.path.join(root, file) for file in files if file.endswith(".wav")]
+            if not os.path.exists(self.output_folder):
+                os.makedirs(self.output_folder)
+            for index, sound_path in enumerate(sorted(clips)):
+                if self.cancelled:
+                    break
+                name = os.path.splitext(os.path.basename(sound_path))[0]
+                self._lines.put("Aligning {} on the warm MFA worker".format(name))
+                self.warm_aligner.align(sound_path, os.path.splitext(sound_path)[0] + ".txt",
+                                        os.path.join(self.output_folder, name + ".TextGrid"))
+                self.progress = int(100 * (index + 1) / len(clips))
+            self.return_code = 0
+        except Exception as e:
+            self._lines.put("Error: {}".format(e))
+            self.return_code = 1
+        finally:
+            self.warm_aligner.close()
+            self._lines.put(None)
+
+    def lines(self):
+        while True:
+            line = self._lines.get()
+            if line is None:
+                return
+            yield "stdout", line
+
+    def wait(self):
+        return self.return_code
+
+    def cancel(self):
+        # The clip that is aligning finishes on the worker, its result is dropped
+        self.cancelled = True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Long lived MFA alignment worker.")
+    parser.add_argument("--lexicon", required=True)
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--state-file", required=True)
+    parser.add_argument("--idle-timeout", type=float, default=DEFAULT_IDLE_TIMEOUT)
+    parser.add_argument("--backend", default="mfa", choices=sorted(BACKENDS))
+    args = parser.parse_args(argv)
+
+    backend = BACKENDS[args.backend](args.lexicon, args.model)
+    serve(backend, args.state_file, args.idle_timeout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
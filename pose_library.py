@@ -0,0 +1,392 @@
+'''
+Name: pose_library
+
+Description: Reading of the pose json files written by the Save pose button. Poses are parsed once into a flat
+list of "control.attr" names and an array of values and kept in a cache that is invalidated when the file changes.
+analyze_poses finds which attributes actually differ between the poses of a library, since Save pose stores every
+keyable attribute of the selected controls.
+
+NamespacedPoses puts the poses of a library on another rig of the scene: the namespace of every control is swapped
+for the rig's. The parsed file is shared by every rig keyed from it, the remapped names are made once per namespace.
+
+A pose library can also be one indexed .alsposes file instead of a folder of json files. After the format tag and its
+length comes a json header with the control and attribute tables and the name, offset and size of every pose, then the
+poses as packed attribute numbers and doubles. Opening a library reads only the header, and a pose is read with one
+seek when it is first keyed. A pose of a library is addressed as "<library path>#<pose name>" wherever a pose file path
+goes. pack_pose_folder and unpack_pose_library convert between the two layouts:
+
+python -m auto_lip_sync.pose_library pack D:/poses/hero D:/poses/hero.alsposes
+python -m auto_lip_sync.pose_library unpack D:/poses/hero.alsposes D:/poses/hero
+'''
+import os
+import sys
+import json
+import struct
+import argparse
+from array import array
+from collections import namedtuple, OrderedDict
+
+LIBRARY_FORMAT = b"ALSPOSE1"
+LIBRARY_VERSION = 1
+LIBRARY_EXTENSION = ".alsposes"
+REFERENCE_SEPARATOR = "#"
+
+Pose = namedtuple("Pose", ["path", "controls", "names", "values"])
+
+
+class PoseLibraryError(ValueError):
+    pass
+
+
+def parse_pose(pose_path):
+    with open(pose_path, 'r', encoding='utf-8') as f:
+        return pose_from_data(pose_path, json.load(f))
+
+
+def pose_from_data(pose_path, pose_data):
+    # Pose of a {control: {attr: value}} mapping, the layout of a pose file
+    controls = []
+    names = []
+    values = []
+    for ctrl, attrs in pose_data.items():
+        controls.append(ctrl)
+        for attr, value in attrs.items():
+            names.append(ctrl+"."+attr)
+            values.append(value)
+
+    # Compound attributes come back from getAttr as lists, those poses keep their values as a tuple
+    try:
+        values = array('d', values)
+    except TypeError:
+        values = tuple(values)
+    return Pose(pose_path, tuple(controls), tuple(names), values)
+
+
+def list_pose_files(folder_path):
+    try:
+        return [folder_path+"/"+file for file in os.listdir(folder_path) if file.endswith(".json")]
+    except OSError:
+        return []
+
+
+def is_library_path(path):
+    return path.lower().endswith(LIBRARY_EXTENSION)
+
+
+def pose_reference(library_path, name):
+    return library_path + REFERENCE_SEPARATOR + name
+
+
+def split_pose_reference(pose_path):
+    # (library path, pose name) of a library pose, (pose_path, None) of a pose file
+    library_path, separator, name = pose_path.rpartition(REFERENCE_SEPARATOR)
+    if separator and is_library_path(library_path):
+        return library_path, name
+    return pose_path, None
+
+
+def list_poses(source):
+    # The pose paths of a pose folder or library file, the library's come from its index
+    if is_library_path(source):
+        try:
+            return load_library(source).references()
+        except (OSError, PoseLibraryError) as e:
+            print("[WARNING] Could not open the pose library {}: {}".format(source, e))
+            return []
+    return list_pose_files(source)
+
+
+def pose_exists(pose_path):
+    library_path, name = split_pose_reference(pose_path)
+    if name is None:
+        return os.path.exists(pose_path)
+    try:
+        return name in load_library(library_path)
+    except (OSError, PoseLibraryError):
+        return False
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class PoseLibrary(object):
+    # The header of a library file: poses are read from the file when asked for
+
+    def __init__(self, path, stamp, header, data_start):
+        self.path = path
+        self.stamp = stamp
+        self.data_start = data_start
+        self.swap = header.get("byteorder") != sys.byteorder
+        controls = header["controls"]
+        self.attr_names = [controls[control] + "." + attr for control, attr in header["attrs"]]
+        self.controls = controls
+        self.entries = OrderedDict((entry["name"], entry) for entry in header["poses"])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def names(self):
+        return list(self.entries)
+
+    def references(self):
+        return [pose_reference(self.path, name) for name in self.entries]
+
+    def read_pose(self, name, library_file=None):
+        entry = self.entries.get(name)
+        if entry is None:
+            raise PoseLibraryError("{} has no pose {}".format(self.path, name))
+        if library_file is None:
+            with open(self.path, "rb") as f:
+                return self.read_pose(name, f)
+        library_file.seek(self.data_start + entry["offset"])
+        body = library_file.read(entry["size"])
+        count = entry["count"]
+        indices = array('I')
+        if entry["kind"] == "d":
+            indices.frombytes(body[:4 * count])
+            values = array('d')
+            values.frombytes(body[4 * count:])
+            if self.swap:
+                indices.byteswap()
+                values.byteswap()
+        else:
+            # Compound attributes, stored as json
+            stored_indices, values = json.loads(body.decode("utf-8"))
+            indices.extend(stored_indices)
+            values = tuple(values)
+        names = tuple(self.attr_names[index] for index in indices)
+        controls = tuple(self.controls[index] for index in entry["controls"])
+        return Pose(pose_reference(self.path, name), controls, names, values)
+
+    def read_poses(self):
+        # (name, Pose) of every pose in file order, with one open
+        with open(self.path, "rb") as f:
+            return [(name, self.read_pose(name, f)) for name in self.entries]
+
+
+def read_library(library_path):
+    stamp = file_stamp(library_path)
+    with open(library_path, "rb") as f:
+        if f.read(len(LIBRARY_FORMAT)) != LIBRARY_FORMAT:
+            raise PoseLibraryError("{} is not a pose library".format(library_path))
+        try:
+            size, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(size).decode("utf-8"))
+        except (struct.error, ValueError) as e:
+            raise PoseLibraryError("Can't read the pose library {}: {}".format(library_path, e))
+    if header.get("version") != LIBRARY_VERSION:
+        raise PoseLibraryError("{} was written by another version of the tool".format(library_path))
+    return PoseLibrary(library_path, stamp, header, len(LIBRARY_FORMAT) + 8 + size)
+
+
+# library path -> PoseLibrary, read again when the file changes
+_libraries = {}
+
+
+def load_library(library_path):
+    library = _libraries.get(library_path)
+    if library is not None and library.stamp == file_stamp(library_path):
+        return library
+    library = _libraries[library_path] = read_library(library_path)
+    return library
+
+
+def write_library(library_path, poses):
+    # poses is a list of (name, Pose). The file is written next to the old one and swapped in.
+    controls = OrderedDict()
+    attrs = OrderedDict()
+    entries = []
+    bodies = []
+    offset = 0
+    for name, pose in poses:
+        indices = array('I')
+        for full_name in pose.names:
+            ctrl, _, attr = full_name.partition(".")
+            control_index = controls.setdefault(ctrl, len(controls))
+            indices.append(attrs.setdefault((control_index, attr), len(attrs)))
+        pose_controls = [controls.setdefault(ctrl, len(controls)) for ctrl in pose.controls]
+        if isinstance(pose.values, array):
+            kind = "d"
+            body = indices.tobytes() + pose.values.tobytes()
+        else:
+            kind = "json"
+            body = json.dumps([list(indices), list(pose.values)]).encode("utf-8")
+        entries.append(OrderedDict([("name", name), ("offset", offset), ("size", len(body)), ("count", len(indices)),
+                                    ("kind", kind), ("controls", pose_controls)]))
+        bodies.append(body)
+        offset += len(body)
+
+    header = json.dumps(OrderedDict([("version", LIBRARY_VERSION), ("byteorder", sys.byteorder), ("controls", list(controls)),
+                                     ("attrs", [list(attr) for attr in attrs]), ("poses", entries)]), ensure_ascii=False)
+    header = header.encode("utf-8")
+    temp_path = "{}.{}.tmp".format(library_path, os.getpid())
+    with open(temp_path, "wb") as f:
+        f.write(LIBRARY_FORMAT)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for body in bodies:
+            f.write(body)
+    os.replace(temp_path, library_path)
+    _libraries.pop(library_path, None)
+    return library_path
+
+
+def save_library_pose(pose_path, pose):
+    # Adds or replaces the pose addressed by pose_path, a library that doesn't exist yet is created
+    library_path, name = split_pose_reference(pose_path)
+    poses = load_library(library_path).read_poses() if os.path.exists(library_path) else []
+    replaced = [(pose_name, pose if pose_name == name else other) for pose_name, other in poses]
+    if name not in (pose_name for pose_name, other in poses):
+        replaced.append((name, pose))
+    write_library(library_path, replaced)
+
+
+def pose_data(pose):
+    # The {control: {attr: value}} layout of a pose file
+    controller_dict = OrderedDict((ctrl, OrderedDict()) for ctrl in pose.controls)
+    for name, value in zip(pose.names, pose.values):
+        ctrl, _, attr = name.partition(".")
+        controller_dict.setdefault(ctrl, OrderedDict())[attr] = value
+    return controller_dict
+
+
+def pack_pose_folder(folder_path, library_path):
+    # Writes every pose file of the folder into one library, the poses named after their files
+    poses = [(os.path.splitext(os.path.basename(path))[0], parse_pose(path)) for path in sorted(list_pose_files(folder_path))]
+    write_library(library_path, poses)
+    return len(poses)
+
+
+def unpack_pose_library(library_path, folder_path):
+    # Writes every pose of the library as a pose file named after it, in the layout of the Save pose button
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+    poses = load_library(library_path).read_poses()
+    for name, pose in poses:
+        with open(os.path.join(folder_path, name + ".json"), "w", encoding='utf-8') as f:
+            json.dump(pose_data(pose), f, indent=4, ensure_ascii=False)
+    return len(poses)
+
+
+def analyze_poses(pose_paths, get_pose, tolerance=1e-4):
+    # Returns (varying, static): the "control.attr" names whose value differs by more than tolerance between the
+    # poses, and an OrderedDict of the others with their shared value. Compound attributes count as varying.
+    first_values = OrderedDict()
+    varying = set()
+    for pose_path in OrderedDict.fromkeys(pose_paths):
+        pose = get_pose(pose_path)
+        for name, value in zip(pose.names, pose.values):
+            if name in varying:
+                continue
+            if isinstance(value, (list, tuple)):
+                varying.add(name)
+                continue
+            first = first_values.setdefault(name, value)
+            if abs(value - first) > tolerance:
+                varying.add(name)
+    static = OrderedDict((name, value) for name, value in first_values.items() if name not in varying)
+    return varying, static
+
+
+class PoseCache(object):
+
+    def __init__(self):
+        self._poses = {}
+        self.parse_count = 0
+
+    def get(self, pose_path):
+        library_path, name = split_pose_reference(pose_path)
+        stamp = file_stamp(library_path)
+        cached = self._poses.get(pose_path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        pose = parse_pose(pose_path) if name is None else load_library(library_path).read_pose(name)
+        self.parse_count += 1
+        self._poses[pose_path] = (stamp, pose)
+        return pose
+
+    def invalidate(self, pose_path=None):
+        if pose_path is None:
+            self._poses.clear()
+        else:
+            self._poses.pop(pose_path, None)
+
+    def __len__(self):
+        return len(self._poses)
+
+
+def remap_namespace(node, namespace):
+    # Puts node (a name or a |dag|path) in namespace, replacing whatever namespace the pose was saved with
+    parts = node.split("|")
+    prefix = namespace + ":" if namespace else ""
+    return "|".join(prefix + part.rpartition(":")[2] if part else part for part in parts)
+
+
+class NamespacedPoses(object):
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else pose_cache
+        self._poses = {}
+
+    def get(self, pose_path, namespace):
+        pose = self.cache.get(pose_path)
+        cached = self._poses.get((namespace, pose_path))
+        # The cache hands back a new Pose when the file changed
+        if cached is not None and cached[0] is pose:
+            return cached[1]
+
+        controls = {ctrl: remap_namespace(ctrl, namespace) for ctrl in pose.controls}
+        names = []
+        for name in pose.names:
+            ctrl, _, attr = name.partition(".")
+            names.append(controls[ctrl] + "." + attr)
+        remapped = Pose(pose.path, tuple(controls[ctrl] for ctrl in pose.controls), tuple(names), pose.values)
+        self._poses[(namespace, pose_path)] = (pose, remapped)
+        return remapped
+
+    def getter(self, namespace):
+        # get_pose function for one rig, see analyze_poses and lip_sync_core.compute_attribute_curves
+        return lambda pose_path: self.get(pose_path, namespace)
+
+
+# Shared by every dialog in the session so repeated runs don't parse the pose files again
+pose_cache = PoseCache()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="auto_lip_sync.pose_library", description="Convert between pose folders and pose library files.")
+    commands = parser.add_subparsers(dest="command")
+    pack = commands.add_parser("pack", help="Write the pose files of a folder into one library file")
+    pack.add_argument("folder")
+    pack.add_argument("library", help="Library file to write (" + LIBRARY_EXTENSION + ")")
+    unpack = commands.add_parser("unpack", help="Write the poses of a library file as pose files")
+    unpack.add_argument("library")
+    unpack.add_argument("folder")
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_help()
+        return 1
+
+    try:
+        if args.command == "pack":
+            if not is_library_path(args.library):
+                args.library += LIBRARY_EXTENSION
+            count = pack_pose_folder(args.folder, args.library)
+            print("Packed {} poses into {}".format(count, args.library))
+        else:
+            count = unpack_pose_library(args.library, args.folder)
+            print("Wrote {} pose files to {}".format(count, args.folder))
+    except (OSError, ValueError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
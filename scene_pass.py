@@ -0,0 +1,193 @@
+'''
+Name: scene_pass
+
+Description: Multi-rig scene mode. A scene file assigns a clip, a transcript and a pose library to every character
+namespace of a shot. The clips of each language are aligned together in one MFA run with parallel jobs, languages run
+side by side, and then all rigs are keyed in one pass and one undo step. The parsed poses are shared between the rigs
+and remapped onto each namespace (see pose_library.NamespacedPoses). A two character conversation so costs about as
+much as aligning its longest clip once.
+
+Usage (from the folder that contains the auto_lip_sync folder):
+
+mayapy -m auto_lip_sync.scene_pass conversation.json --scene shots/sh010.ma --blend
+
+A scene file is a json list of assignments: [{"namespace": "hero", "sound": "vo/hero_010.wav",
+"text": "vo/hero_010.txt", "pose_map": "poses/hero.json", "language": "English"}, ...]. "pose_map" maps visemes to pose
+files like --pose-map of the other tools, or is that mapping itself. "language" defaults to English. Relative paths are
+resolved from the folder of the file they appear in.
+'''
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import lip_sync_core
+from .lip_sync_core import language_settings, LipSyncError
+from .language_packs import LanguagePackError
+from .align_cache import AlignmentCache
+from .tracing import tracer
+from . import batch
+
+
+def resolve_path(path, root):
+    return path if not path or os.path.isabs(path) else os.path.join(root, path)
+
+
+def read_pose_map(pose_map, root):
+    # A viseme -> pose file mapping, from a json file or inline in the scene file
+    if isinstance(pose_map, dict):
+        return OrderedDict((viseme, resolve_path(path, root)) for viseme, path in pose_map.items())
+    pose_map_path = resolve_path(pose_map, root)
+    try:
+        with open(pose_map_path, 'r', encoding='utf-8') as f:
+            mapping = json.load(f)
+    except (OSError, ValueError) as e:
+        raise LipSyncError("Can't read the pose map {}: {}".format(pose_map_path, e))
+    return read_pose_map(mapping, os.path.dirname(os.path.abspath(pose_map_path)))
+
+
+def read_assignments(scene_path):
+    try:
+        with open(scene_path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        raise LipSyncError("Can't read the scene file {}: {}".format(scene_path, e))
+    root = os.path.dirname(os.path.abspath(scene_path))
+    assignments = []
+    for entry in entries:
+        if not entry.get("sound") or not entry.get("text"):
+            raise LipSyncError("Every assignment of {} needs a sound and a text".format(scene_path))
+        language = entry.get("language", "English")
+        if language not in language_settings:
+            raise LipSyncError("Unknown language {} in {}".format(language, scene_path))
+        try:
+            language_settings.check(language)
+        except LanguagePackError as e:
+            raise LipSyncError(str(e))
+        phone_path_dict = OrderedDict(language_settings[language]["phone_path_dict"])
+        if entry.get("pose_map"):
+            phone_path_dict.update(read_pose_map(entry["pose_map"], root))
+        assignments.append({"namespace": entry.get("namespace", "").strip(":"), "language": language,
+                            "sound": resolve_path(entry["sound"], root), "text": resolve_path(entry["text"], root),
+                            "phone_path_dict": phone_path_dict})
+    return assignments
+
+
+def align_assignments(assignments, work_dir=None, num_jobs=None, cache=None, allow_oov=False, on_line=None):
+    # Aligns the clips of every language in one MFA run each, the runs side by side with the cores shared out between
+    # them. Returns the assignments that got an alignment, each with its keyframe plan in assignment["keys"].
+    work_dir = work_dir or lip_sync_core.USER_SCRIPT_DIR
+    groups = OrderedDict()
+    for assignment in assignments:
+        groups.setdefault(assignment["language"], []).append(dict(assignment))
+    num_jobs = num_jobs or multiprocessing.cpu_count()
+    jobs_per_group = max(num_jobs // len(groups), 1)
+
+    def align_group(language, clips):
+        # A work folder per language so the runs don't share their MFA corpus
+        group_dir = os.path.join(work_dir, "scene_" + language.lower())
+        return batch.align_corpus(clips, language, group_dir, jobs_per_group, on_line, cache, allow_oov)
+
+    with tracer.span("align", clips=len(assignments), languages=len(groups)):
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            futures = [(clips, executor.submit(align_group, language, clips)) for language, clips in groups.items()]
+            results = [(clips, future.result()) for clips, future in futures]
+
+    aligned = []
+    with tracer.span("keyframe plans"):
+        for clips, intervals in results:
+            for clip in clips:
+                if clip["name"] not in intervals:
+                    print("[ERROR] {} was not aligned, {} is not keyed".format(clip["sound"], clip["namespace"] or "the root namespace"))
+                    continue
+                phone_index = lip_sync_core.PhoneIndex(language_settings[clip["language"]]["phone_dict"], clip["phone_path_dict"])
+                clip["keys"] = lip_sync_core.compute_keyframe_plan(intervals[clip["name"]], phone_index)
+                if phone_index.summary():
+                    print("[WARNING] {}: {}".format(clip["namespace"], phone_index.summary()))
+                aligned.append(clip)
+    return aligned
+
+
+def key_scene(aligned, blend=None, min_hold=lip_sync_core.MIN_HOLD_FRAMES):
+    # Maya only: imports every clip's sound once and keys all rigs in one undo step, returns the written curves.
+    # The plans are compiled at the scene frame rate first, a min_hold of None keys them as MFA aligned them.
+    from maya import cmds, mel
+    from . import maya_keys
+
+    if min_hold is not None:
+        fps = maya_keys.get_fps()
+        for clip in aligned:
+            clip["keys"] = lip_sync_core.compact_keyframe_plan(clip["keys"], fps, min_hold)
+
+    longest = None
+    for clip in aligned:
+        node = maya_keys.import_sound(clip["sound"], (clip["namespace"] or "Scene") + "_SoundFile")
+        end = clip["keys"][-1]["end"] if clip["keys"] else 0.0
+        if longest is None or end > longest[0]:
+            longest = (end, node)
+    if longest:
+        playback_slider = mel.eval("$tmpVar=$gPlayBackSlider")
+        cmds.timeControl(playback_slider, edit=True, sound=longest[1])
+    return maya_keys.apply_scene([(clip["namespace"], clip["keys"]) for clip in aligned], blend)
+
+
+def run_scene_pass(scene_path, work_dir=None, num_jobs=None, cache=None, allow_oov=False, blend=None, on_line=None,
+                   min_hold=lip_sync_core.MIN_HOLD_FRAMES):
+    # Maya only: aligns and keys every assignment of scene_path into the open scene. Returns (keyed, assigned) counts.
+    assignments = read_assignments(scene_path)
+    if not assignments:
+        raise LipSyncError("{} assigns no clips".format(scene_path))
+    aligned = align_assignments(assignments, work_dir, num_jobs, cache, allow_oov, on_line)
+    if aligned:
+        key_scene(aligned, blend, min_hold)
+    return len(aligned), len(assignments)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="auto_lip_sync.scene_pass",
+                                     description="Align the clips of several characters and key all their rigs in one pass (mayapy).")
+    parser.add_argument("assignments", help="Json list of namespace, sound, text, pose_map and language per character")
+    parser.add_argument("--scene", required=True, help="Maya scene to key, it is saved afterwards")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of parallel MFA jobs (default: number of cores)")
+    parser.add_argument("-w", "--work-dir", help="Folder used for the MFA corpus and output folders")
+    parser.add_argument("--cache-dir", help="Alignment cache folder (default: $AUTO_LIP_SYNC_CACHE or alignment_cache in the script dir)")
+    parser.add_argument("--no-cache", action="store_true", help="Always run MFA and don't store the results")
+    parser.add_argument("--allow-oov", action="store_true", help="Also align clips with words the lexicon can't pronounce")
+    parser.add_argument("--blend", action="store_true", help="Blend neighbouring visemes (coarticulation)")
+    parser.add_argument("--min-hold", type=int, default=lip_sync_core.MIN_HOLD_FRAMES,
+                        help="Frames a viseme is held at least, shorter ones go to the viseme before (default: 1)")
+    parser.add_argument("--keep-intervals", action="store_true", help="Key every MFA interval as it is instead of the compiled schedule")
+    parser.add_argument("--trace", help="Write the time spent in every stage to this Chrome trace json file")
+    args = parser.parse_args(argv)
+
+    import maya.standalone
+    maya.standalone.initialize()
+    from maya import cmds
+
+    if args.trace:
+        tracer.reset(enabled=True)
+    try:
+        cmds.file(args.scene, open=True, force=True)
+        cache = None if args.no_cache else AlignmentCache(args.cache_dir)
+        blend = lip_sync_core.default_blend_settings() if args.blend else None
+        keyed, assigned = run_scene_pass(args.assignments, args.work_dir, args.jobs, cache, args.allow_oov, blend,
+                                         min_hold=None if args.keep_intervals else args.min_hold)
+    except LipSyncError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 1
+    finally:
+        if args.trace:
+            tracer.write(args.trace)
+            print("Timings: " + tracer.summary())
+            tracer.reset(enabled=False)
+    if keyed:
+        cmds.file(save=True, force=True)
+    print("Keyed {} of {} characters in {}".format(keyed, assigned, args.scene))
+    return 0 if keyed == assigned else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+'''
+Name: schedule
+
+Description: Viseme schedule compiler. MFA emits one interval per phone, with boundaries anywhere between frames and
+neighbouring phones that often share a viseme. Keyed as they are, the same pose is keyed again at every boundary of a
+run and sub frame phones leave keys between frames that do nothing at playback.
+
+compile_schedule snaps every boundary to the nearest frame, merges neighbours that show the same pose and gives
+intervals shorter than the minimum hold to the interval before them (the one after for the first), before any curve is
+built. The result is a Schedule of arrays: start and end seconds and a row in the viseme / pose / phones tables per
+interval. schedule_keys turns it back into plan keys (see lip_sync_core.compute_keyframe_plan), a merged interval keeps
+the phones it was made of in its "phone" entry joined by "+".
+'''
+from array import array
+from collections import namedtuple, OrderedDict
+
+MIN_HOLD_FRAMES = 1
+
+Schedule = namedtuple("Schedule", ["fps", "starts", "ends", "entry_ids", "visemes", "poses", "phones"])
+
+
+def snap(time, fps):
+    return round(time * fps) / fps
+
+
+def compile_schedule(keys, fps, min_hold=MIN_HOLD_FRAMES):
+    # keys is a plan as built by lip_sync_core.compute_keyframe_plan, min_hold is in frames
+    entries = OrderedDict()
+    starts = array('d')
+    ends = array('d')
+    entry_ids = array('l')
+    phones = []
+    min_length = (min_hold - 0.5) / fps
+
+    for key in keys:
+        start = snap(key["start"], fps)
+        end = snap(key["end"], fps)
+        if starts and start < ends[-1]:
+            start = ends[-1]
+        if end <= start:
+            # Shorter than half a frame, the neighbours cover it
+            continue
+        entry = entries.setdefault((key["viseme"], key["pose"]), len(entries))
+        if starts and entry_ids[-1] == entry and start - ends[-1] < 0.5 / fps:
+            ends[-1] = end
+            phones[-1].append(key["phone"])
+            continue
+        starts.append(start)
+        ends.append(end)
+        entry_ids.append(entry)
+        phones.append([key["phone"]])
+
+    if min_hold > 1:
+        absorb_short(starts, ends, entry_ids, phones, min_length)
+
+    viseme_table = [viseme for viseme, pose in entries]
+    pose_table = [pose for viseme, pose in entries]
+    return Schedule(fps, starts, ends, entry_ids, viseme_table, pose_table, ["+".join(run) for run in phones])
+
+
+def absorb_short(starts, ends, entry_ids, phones, min_length):
+    # Gives every interval shorter than min_length to its neighbour in place, merging runs that meet again after it
+    index = 0
+    while index < len(starts) and len(starts) > 1:
+        if ends[index] - starts[index] >= min_length:
+            index += 1
+            continue
+        # Into the interval before it, the first one into the interval after it
+        target = index - 1 if index > 0 else index + 1
+        if target < index:
+            ends[target] = ends[index]
+        else:
+            starts[target] = starts[index]
+        del starts[index], ends[index], entry_ids[index], phones[index]
+        # The neighbours either side may show the same pose now
+        merge_at = min(target, index)
+        if 0 < merge_at + 1 < len(starts) and entry_ids[merge_at] == entry_ids[merge_at + 1] and \
+                starts[merge_at + 1] - ends[merge_at] < 1e-9:
+            ends[merge_at] = ends[merge_at + 1]
+            phones[merge_at].extend(phones[merge_at + 1])
+            del starts[merge_at + 1], ends[merge_at + 1], entry_ids[merge_at + 1], phones[merge_at + 1]
+        # Step back so the grown interval is measured again
+        index = max(merge_at, 0)
+
+
+def schedule_keys(schedule):
+    keys = []
+    for start, end, entry, phone in zip(schedule.starts, schedule.ends, schedule.entry_ids, schedule.phones):
+        keys.append({"start": start, "end": end, "phone": phone, "viseme": schedule.visemes[entry],
+                     "pose": schedule.poses[entry]})
+    return keys
@@ -0,0 +1,13 @@
+import os
+import sys
+import importlib.util
+
+# The repository folder is the auto_lip_sync package itself, load it under that name so the relative imports work
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "auto_lip_sync" not in sys.modules:
+    spec = importlib.util.spec_from_file_location("auto_lip_sync", os.path.join(ROOT, "__init__.py"),
+                                                  submodule_search_locations=[ROOT])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules["auto_lip_sync"] = package
+    spec.loader.exec_module(package)
@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import time
+import wave
+
+from auto_lip_sync.mfa_worker import WarmAligner, WarmAlignJob
+from auto_lip_sync.textgrid_reader import read_tier
+
+
+def write_silence(path, seconds, rate=16000):
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(rate)
+        wav_file.writeframes(b"\0\0" * int(seconds * rate))
+
+
+def stub_settings(tmp_path):
+    # The worker script is started with this interpreter, like MFA's own python.exe in a real language pack
+    return {"mfa_version": "v3.2.3", "mfa_path": os.path.dirname(sys.executable),
+            "mfa_align_cmd": os.path.basename(sys.executable), "mfa_train_cmd": os.path.basename(sys.executable),
+            "lexicon": str(tmp_path / "lexicon.dict"), "model": str(tmp_path / "model.zip")}
+
+
+def wait_until(condition, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    # A finished child of another session can linger as a zombie, that counts as gone
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            return f.read().split(")")[-1].split()[0] != "Z"
+    except OSError:
+        return True
+
+
+def test_warm_worker_aligns_and_stops_when_idle(tmp_path):
+    sound_path = str(tmp_path / "clip.wav")
+    text_path = str(tmp_path / "clip.txt")
+    write_silence(sound_path, 0.5)
+    (tmp_path / "clip.txt").write_text("hello", encoding="utf-8")
+    settings = stub_settings(tmp_path)
+
+    aligner = WarmAligner(settings, state_folder=str(tmp_path), idle_timeout=1, backend="stub")
+    try:
+        aligner.connect()
+        with open(aligner.state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        assert state["lexicon"] == settings["lexicon"]
+        assert os.stat(aligner.state_path).st_mode & 0o077 == 0
+
+        output_path = str(tmp_path / "clip.TextGrid")
+        assert aligner.align(sound_path, text_path, output_path)["ok"]
+        assert list(read_tier(output_path)) == [(0.0, 0.5, "sil")]
+
+        # A second client for the same settings finds the running worker instead of starting another one
+        aligner.close()
+        other = WarmAligner(settings, state_folder=str(tmp_path), idle_timeout=1, backend="stub")
+        conn = other.try_connect()
+        assert conn is not None
+        conn.close()
+    finally:
+        aligner.close()
+
+    # Without a connection the worker shuts down after the idle timeout and removes its state file
+    assert wait_until(lambda: not os.path.exists(aligner.state_path))
+    assert wait_until(lambda: not process_alive(state["pid"]))
+
+
+def test_warm_align_job_writes_a_textgrid_per_clip(tmp_path):
+    input_folder = tmp_path / "input"
+    input_folder.mkdir()
+    for name, seconds in (("a", 0.25), ("b", 1.0)):
+        write_silence(str(input_folder / (name + ".wav")), seconds)
+        (input_folder / (name + ".txt")).write_text(name, encoding="utf-8")
+    output_folder = str(tmp_path / "output")
+
+    aligner = WarmAligner(stub_settings(tmp_path), state_folder=str(tmp_path), idle_timeout=1, backend="stub")
+    job = WarmAlignJob(aligner, str(input_folder), output_folder).start()
+    lines = [line for stream, line in job.lines()]
+    try:
+        assert job.wait() == 0, lines
+        assert job.progress == 100
+        assert list(read_tier(os.path.join(output_folder, "a.TextGrid"))) == [(0.0, 0.25, "sil")]
+        assert list(read_tier(os.path.join(output_folder, "b.TextGrid"))) == [(0.0, 1.0, "sil")]
+    finally:
+        aligner.shutdown()
+    assert wait_until(lambda: not os.path.exists(aligner.state_path))
+
+
+def test_warm_aligner_refuses_a_state_file_others_can_read(tmp_path):
+    aligner = WarmAligner(stub_settings(tmp_path), state_folder=str(tmp_path), backend="stub")
+    with open(aligner.state_path, "w", encoding="utf-8") as f:
+        json.dump({"pid": 1, "port": 1, "authkey": "00"}, f)
+    os.chmod(aligner.state_path, 0o644)
+    try:
+        aligner.try_connect()
+    except RuntimeError as e:
+        assert "not private" in str(e)
+    else:
+        raise AssertionError("A world readable state file was used")
@@ -0,0 +1,154 @@
+'''
+Name: textgrid_reader
+
+Description: Streaming reader for Praat TextGrid files in both the long (ooTextFile) and the short format. Only the
+requested tier is parsed, looked up by name, into parallel arrays of start times, end times and label ids. Reading
+stops as soon as that tier is done, so long alignments are read with little memory and the external textgrid package
+is not needed. write_textgrid writes interval tiers back out in the long format, e.g. the stitched timeline of a
+long take aligned in segments.
+'''
+import codecs
+from array import array
+
+
+class TextGridError(ValueError):
+    pass
+
+
+class IntervalTier(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.starts = array('d')
+        self.ends = array('d')
+        self.label_ids = array('l')
+        self.labels = []
+        self._label_lookup = {}
+
+    def append(self, start, end, label):
+        label_id = self._label_lookup.get(label)
+        if label_id is None:
+            label_id = self._label_lookup[label] = len(self.labels)
+            self.labels.append(label)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.label_ids.append(label_id)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        # (start, end, label) tuples, the same shape lip_sync_core used to build from the textgrid package
+        labels = self.labels
+        for start, end, label_id in zip(self.starts, self.ends, self.label_ids):
+            yield start, end, labels[label_id]
+
+    def __getitem__(self, index):
+        return self.starts[index], self.ends[index], self.labels[self.label_ids[index]]
+
+
+def open_textgrid(path):
+    # Praat writes UTF-16 with a BOM, MFA writes UTF-8
+    with open(path, "rb") as f:
+        head = f.read(2)
+    encoding = "utf-16" if head in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE) else "utf-8-sig"
+    return open(path, "r", encoding=encoding)
+
+
+def iter_values(lines):
+    # Yields the raw values of the file in order. In the long format that is whatever follows "=", lines like
+    # "item [1]:" are structure only. In the short format every line is a value. Quoted strings keep their quotes.
+    pending = None
+    for line in lines:
+        if pending is not None:
+            pending += "\n" + line.rstrip("\r\n")
+            if pending.count('"') % 2 == 0:
+                yield pending
+                pending = None
+            continue
+
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('"'):
+            value = line
+        elif "=" in line:
+            value = line.split("=", 1)[1].strip()
+        elif line.endswith(":"):
+            continue
+        elif line.startswith("tiers?"):
+            value = line.split(None, 1)[1]
+        else:
+            value = line
+
+        # A label with a line break in it continues on the next lines
+        if value.startswith('"') and value.count('"') % 2:
+            pending = value
+            continue
+        yield value
+
+
+def parse_string(value):
+    if not (value.startswith('"') and value.endswith('"')):
+        raise TextGridError("Expected a quoted string, got: {}".format(value))
+    return value[1:-1].replace('""', '"')
+
+
+def tier_matches(name, tier_name):
+    # MFA 3 names the tiers "<speaker> - phones" when the corpus has speaker folders
+    return name == tier_name or name.endswith(" - " + tier_name)
+
+
+def read_tier(path, tier_name="phones"):
+    with open_textgrid(path) as f:
+        values = iter_values(f)
+        try:
+            if parse_string(next(values)) != "ooTextFile" or parse_string(next(values)) != "TextGrid":
+                raise TextGridError("{} is not a TextGrid file".format(path))
+            next(values)  # xmin
+            next(values)  # xmax
+            if next(values) != "<exists>":
+                raise TextGridError("{} has no tiers".format(path))
+            tier_count = int(next(values))
+
+            names = []
+            for tier_index in range(tier_count):
+                tier_class = parse_string(next(values))
+                name = parse_string(next(values))
+                names.append(name)
+                next(values)  # xmin
+                next(values)  # xmax
+                count = int(next(values))
+                values_per_item = 3 if tier_class == "IntervalTier" else 2
+
+                if tier_class != "IntervalTier" or not tier_matches(name, tier_name):
+                    for skip in range(count * values_per_item):
+                        next(values)
+                    continue
+
+                tier = IntervalTier(name)
+                for interval_index in range(count):
+                    start = float(next(values))
+                    end = float(next(values))
+                    tier.append(start, end, parse_string(next(values)))
+                return tier
+        except StopIteration:
+            raise TextGridError("{} ended unexpectedly".format(path))
+
+    raise TextGridError("{} has no interval tier named '{}' (tiers: {})".format(path, tier_name, ", ".join(names)))
+
+
+def write_textgrid(path, tiers, xmax=None):
+    # tiers are IntervalTiers, xmax defaults to the last interval end of any tier
+    if xmax is None:
+        xmax = max([tier.ends[-1] for tier in tiers if len(tier)] or [0.0])
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('File type = "ooTextFile"\nObject class = "TextGrid"\n\nxmin = 0\nxmax = {!r}\ntiers? <exists>\n'
+                'size = {}\nitem []:\n'.format(xmax, len(tiers)))
+        for tier_index, tier in enumerate(tiers, 1):
+            f.write('    item [{}]:\n        class = "IntervalTier"\n        name = "{}"\n        xmin = 0\n'
+                    '        xmax = {!r}\n        intervals: size = {}\n'.format(tier_index, tier.name.replace('"', '""'), xmax, len(tier)))
+            for interval_index, (start, end, label) in enumerate(tier, 1):
+                f.write('        intervals [{}]:\n            xmin = {!r}\n            xmax = {!r}\n            text = "{}"\n'.format(
+                    interval_index, start, end, label.replace('"', '""')))
+    return path
@@ -0,0 +1,121 @@
+'''
+Name: tracing
+
+Description: Per stage timing. Stages are wrapped in tracer.span("name") blocks and quantities (intervals, poses
+parsed, keys set) are added with tracer.count. A run is written as a Chrome trace json (open it in chrome://tracing or
+https://ui.perfetto.dev) and summed up per stage for the Script Editor.
+
+The tracer is off unless a run switches it on. Switched off, span() hands back one shared do-nothing block and count()
+returns straight away, so the instrumented code pays a method call per stage and nothing per key.
+'''
+import os
+import json
+import time
+import threading
+from collections import Counter, OrderedDict
+
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = time.perf_counter()
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.end(self)
+        return False
+
+    def set(self, **args):
+        # Extra values shown with the span in the trace viewer
+        self.args.update(args)
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self, enabled=None):
+        if enabled is not None:
+            self.enabled = enabled
+        self.events = []
+        self.counters = Counter()
+        self.totals = OrderedDict()
+        self.origin = time.perf_counter()
+
+    def span(self, name, **args):
+        # with tracer.span("stage"): ... times the block
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def begin(self, name, **args):
+        # For stages that start and end in different callbacks, pass the result to end()
+        if not self.enabled:
+            return None
+        return Span(self, name, args)
+
+    def end(self, span, **args):
+        if span is None or not self.enabled:
+            return
+        end = time.perf_counter()
+        span.args.update(args)
+        self.events.append({"name": span.name, "cat": "auto_lip_sync", "ph": "X", "pid": os.getpid(),
+                            "tid": threading.get_ident(), "ts": (span.start - self.origin) * 1e6,
+                            "dur": (end - span.start) * 1e6, "args": span.args})
+        self.totals[span.name] = self.totals.get(span.name, 0.0) + end - span.start
+
+    def switch(self, span, name, **args):
+        # Ends span and begins the next one, for a run that moves through stages like MFA
+        self.end(span)
+        return self.begin(name, **args)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        self.counters[name] += value
+        self.events.append({"name": name, "ph": "C", "pid": os.getpid(), "ts": (time.perf_counter() - self.origin) * 1e6,
+                            "args": {name: self.counters[name]}})
+
+    def summary(self):
+        # One line of seconds per stage and the counters, in the order the stages finished
+        stages = ", ".join("{} {:.2f}s".format(name, seconds) for name, seconds in self.totals.items())
+        counters = ", ".join("{} {}".format(name, value) for name, value in self.counters.items())
+        return "; ".join(part for part in (stages, counters) if part)
+
+    def write(self, trace_path):
+        folder = os.path.dirname(trace_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        trace = OrderedDict([("traceEvents", self.events), ("displayTimeUnit", "ms"),
+                             ("otherData", OrderedDict([("stages", self.totals), ("counters", self.counters)]))])
+        with open(trace_path, "w", encoding="utf-8") as f:
+            json.dump(trace, f, ensure_ascii=False)
+        return trace_path
+
+
+# Shared by the core, the keying code and the dialog, a run resets it and switches it on
+tracer = Tracer()
@@ -0,0 +1,252 @@
+'''
+Name: tracks
+
+Description: Engine agnostic viseme tracks. A track holds the resolved viseme schedule (one row per phone interval)
+and the per frame viseme weights (frames x visemes) together with a header of frame rate, language and phone set id,
+so a game engine can drive its own rig from the same timing the Maya keys are made from.
+
+Three formats, picked by file extension:
+.npz   compact columnar numpy archive, the one to ship
+.json  header, schedule and weights as json, for debugging
+.csv   the same as a flat table, "interval" rows for the schedule followed by one "frame" row per frame
+
+The json and csv writers stream the rows to the file chunk by chunk. read_track reads all three back, and
+track_curves turns a track into anim curves for the rig without running MFA again.
+
+Needs numpy, which ships with mayapy 2022 and later.
+'''
+import os
+import csv
+import json
+import hashlib
+from array import array
+from collections import OrderedDict, namedtuple
+
+TRACK_FORMAT = "auto_lip_sync_track"
+TRACK_VERSION = 1
+ROW_CHUNK = 4096
+
+Track = namedtuple("Track", ["header", "starts", "ends", "phone_ids", "viseme_ids", "phones", "visemes", "weights"])
+
+
+class TrackError(ValueError):
+    pass
+
+
+def phone_set_id(phone_dict):
+    # Short stable id of a phone -> viseme table, so an importer can tell which mapping a track was made with
+    text = json.dumps(sorted(phone_dict.items()), ensure_ascii=False)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+
+def intern(values):
+    # (table of unique values, id of every value)
+    table = OrderedDict()
+    ids = array('l', (table.setdefault(value, len(table)) for value in values))
+    return list(table), ids
+
+
+def build_track(keys, fps, language, phone_dict, visemes=None, blend=None, **extra):
+    # keys is a plan as built by lip_sync_core.compute_keyframe_plan. visemes fixes the weight columns (the
+    # phone_path_dict order), by default they are the visemes of the plan. With blend the weights are the
+    # coarticulation weights of blending.compute_weight_matrix, without it every frame is all on its current viseme.
+    import numpy as np
+
+    count = len(keys)
+    starts = np.fromiter((key["start"] for key in keys), dtype=np.float64, count=count)
+    ends = np.fromiter((key["end"] for key in keys), dtype=np.float64, count=count)
+    phones, phone_ids = intern(key["phone"] for key in keys)
+    if visemes is None:
+        visemes = list(OrderedDict.fromkeys(key["viseme"] for key in keys if key["viseme"]))
+    viseme_lookup = dict((viseme, index) for index, viseme in enumerate(visemes))
+    viseme_ids = np.fromiter((viseme_lookup.get(key["viseme"], -1) for key in keys), dtype=np.int32, count=count)
+
+    weights = compute_track_weights(starts, ends, viseme_ids, len(visemes), fps, blend)
+    header = OrderedDict([
+        ("format", TRACK_FORMAT),
+        ("version", TRACK_VERSION),
+        ("fps", fps),
+        ("language", language),
+        ("phone_set", phone_set_id(phone_dict)),
+        ("blend", blend),
+        ("frames", len(weights)),
+    ])
+    header.update(extra)
+    return Track(header, starts, ends, np.asarray(phone_ids, dtype=np.int32), viseme_ids,
+                 phones, list(visemes), weights)
+
+
+def compute_track_weights(starts, ends, viseme_ids, viseme_count, fps, blend=None):
+    import numpy as np
+
+    assigned = viseme_ids >= 0
+    if blend:
+        from .blending import compute_weight_matrix
+        return compute_weight_matrix(starts[assigned], ends[assigned], viseme_ids[assigned], viseme_count, fps,
+                                     **blend).astype(np.float32)
+
+    frame_count = int(np.ceil(ends.max() * fps)) + 1 if len(ends) else 0
+    weights = np.zeros((frame_count, viseme_count), dtype=np.float32)
+    if not frame_count or not assigned.any():
+        return weights
+    # Interval of every frame, the later interval wins on a shared boundary like the hard keys
+    times = np.arange(frame_count) / float(fps)
+    interval = np.searchsorted(starts, times, side="right") - 1
+    inside = (interval >= 0) & (times <= ends[np.maximum(interval, 0)])
+    frames = np.nonzero(inside & (viseme_ids[np.maximum(interval, 0)] >= 0))[0]
+    weights[frames, viseme_ids[interval[frames]]] = 1.0
+    return weights
+
+
+def write_track(path, track):
+    ext = os.path.splitext(path)[1].lower()
+    writer = {".npz": write_npz, ".json": write_json, ".csv": write_csv}.get(ext)
+    if writer is None:
+        raise TrackError("Unknown track format {}, use .npz, .json or .csv".format(ext))
+    writer(path, track)
+    return path
+
+
+def write_npz(path, track):
+    import numpy as np
+    np.savez_compressed(path, header=np.array(json.dumps(track.header)), starts=track.starts, ends=track.ends,
+                        phone_ids=track.phone_ids, viseme_ids=track.viseme_ids, phones=np.array(track.phones, dtype=str),
+                        visemes=np.array(track.visemes, dtype=str), weights=track.weights)
+
+
+def write_json(path, track):
+    # Written row by row so a long cinematic never becomes one big python structure
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{\n"header": ' + json.dumps(track.header, ensure_ascii=False))
+        f.write(',\n"visemes": ' + json.dumps(track.visemes, ensure_ascii=False))
+        f.write(',\n"schedule": [')
+        separator = "\n"
+        for start in range(0, len(track.starts), ROW_CHUNK):
+            stop = start + ROW_CHUNK
+            rows = zip(track.starts[start:stop].tolist(), track.ends[start:stop].tolist(),
+                       track.phone_ids[start:stop].tolist(), track.viseme_ids[start:stop].tolist())
+            for row_start, row_end, phone_id, viseme_id in rows:
+                viseme = track.visemes[viseme_id] if viseme_id >= 0 else None
+                f.write(separator + json.dumps([row_start, row_end, track.phones[phone_id], viseme], ensure_ascii=False))
+                separator = ",\n"
+        f.write('\n],\n"weights": [')
+        separator = "\n"
+        for start in range(0, len(track.weights), ROW_CHUNK):
+            for row in track.weights[start:start + ROW_CHUNK].round(4).tolist():
+                f.write(separator + json.dumps(row))
+                separator = ",\n"
+        f.write("\n]\n}\n")
+
+
+def write_csv(path, track):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write("# " + json.dumps(track.header, ensure_ascii=False) + "\n")
+        writer = csv.writer(f)
+        writer.writerow(["kind", "start", "end", "phone", "viseme"] + track.visemes)
+        for start in range(0, len(track.starts), ROW_CHUNK):
+            stop = start + ROW_CHUNK
+            rows = zip(track.starts[start:stop].tolist(), track.ends[start:stop].tolist(),
+                       track.phone_ids[start:stop].tolist(), track.viseme_ids[start:stop].tolist())
+            writer.writerows(["interval", row_start, row_end, track.phones[phone_id],
+                              track.visemes[viseme_id] if viseme_id >= 0 else ""]
+                             for row_start, row_end, phone_id, viseme_id in rows)
+        fps = float(track.header["fps"])
+        for start in range(0, len(track.weights), ROW_CHUNK):
+            rows = track.weights[start:start + ROW_CHUNK].round(4).tolist()
+            writer.writerows(["frame", round((start + index) / fps, 6), "", "", ""] + row for index, row in enumerate(rows))
+
+
+def is_track_file(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".npz", ".csv"):
+        return True
+    if ext != ".json":
+        return False
+    # A json track starts with its header, a keyframe plan with its version
+    with open(path, "r", encoding="utf-8") as f:
+        return TRACK_FORMAT in f.read(256)
+
+
+def read_track(path):
+    ext = os.path.splitext(path)[1].lower()
+    reader = {".npz": read_npz, ".json": read_json, ".csv": read_csv}.get(ext)
+    if reader is None:
+        raise TrackError("Unknown track format {}, use .npz, .json or .csv".format(ext))
+    track = reader(path)
+    if track.header.get("format") != TRACK_FORMAT or track.header.get("version") != TRACK_VERSION:
+        raise TrackError("{} is not a version {} viseme track".format(path, TRACK_VERSION))
+    return track
+
+
+def read_npz(path):
+    import numpy as np
+    with np.load(path, allow_pickle=False) as data:
+        header = json.loads(str(data["header"]), object_pairs_hook=OrderedDict)
+        return Track(header, data["starts"], data["ends"], data["phone_ids"], data["viseme_ids"],
+                     data["phones"].tolist(), data["visemes"].tolist(), data["weights"])
+
+
+def schedule_track(header, visemes, schedule, weights):
+    import numpy as np
+    count = len(schedule)
+    phones, phone_ids = intern(row[2] for row in schedule)
+    viseme_lookup = dict((viseme, index) for index, viseme in enumerate(visemes))
+    return Track(header,
+                 np.fromiter((float(row[0]) for row in schedule), dtype=np.float64, count=count),
+                 np.fromiter((float(row[1]) for row in schedule), dtype=np.float64, count=count),
+                 np.asarray(phone_ids, dtype=np.int32),
+                 np.fromiter((viseme_lookup.get(row[3], -1) for row in schedule), dtype=np.int32, count=count),
+                 phones, list(visemes), np.asarray(weights, dtype=np.float32).reshape(-1, len(visemes)))
+
+
+def read_json(path):
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f, object_pairs_hook=OrderedDict)
+    return schedule_track(data["header"], data["visemes"], data["schedule"], data["weights"])
+
+
+def read_csv(path):
+    import numpy as np
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        first_line = f.readline()
+        if not first_line.startswith("# "):
+            raise TrackError("{} has no track header".format(path))
+        header = json.loads(first_line[2:], object_pairs_hook=OrderedDict)
+        reader = csv.reader(f)
+        visemes = next(reader)[5:]
+        schedule = []
+        weights = array('f')
+        for row in reader:
+            if row[0] == "interval":
+                schedule.append((row[1], row[2], row[3], row[4] or None))
+            elif row[0] == "frame":
+                weights.extend(float(value) for value in row[5:])
+    return schedule_track(header, visemes, schedule, np.frombuffer(weights, dtype=np.float32))
+
+
+def track_curves(track, viseme_pose_paths, get_pose):
+    # "control.attr" -> (times, values) from the track's weights and the poses mapped to its visemes (viseme -> pose
+    # path, e.g. a phone_path_dict). Visemes without a pose are left out and the remaining weights renormalized.
+    import numpy as np
+    from .blending import build_pose_matrix
+
+    columns = [index for index, viseme in enumerate(track.visemes) if viseme_pose_paths.get(viseme)]
+    if not columns or not len(track.weights):
+        return OrderedDict()
+    pose_matrix = build_pose_matrix([viseme_pose_paths[track.visemes[index]] for index in columns], get_pose)
+    weights = track.weights[:, columns].astype(np.float64)
+
+    # Frames without weight on any posed viseme hold the previous frame, like gaps in the hard keys
+    total = weights.sum(axis=1)
+    covered = total > 0
+    if not covered.any():
+        return OrderedDict()
+    source = np.maximum.accumulate(np.where(covered, np.arange(len(weights)), 0))
+    source[:np.argmax(covered)] = np.argmax(covered)
+    values = (weights[source] / total[source][:, None]) @ pose_matrix.values
+
+    times = array('d', (np.arange(len(weights)) / float(track.header["fps"])).tolist())
+    curves = OrderedDict()
+    for column, name in enumerate(pose_matrix.names):
+        curves[name] = (times, array('d', values[:, column].tolist()))
+    return curves